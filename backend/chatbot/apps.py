@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class ChatbotConfig(AppConfig):
+    name = "chatbot"
+
+    def ready(self):
+        # Registers the system checks
+        from chatbot import checks  # noqa: F401
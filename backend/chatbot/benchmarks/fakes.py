@@ -0,0 +1,354 @@
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qsl, urlsplit
+
+from chatbot.services.facets import add_facets
+
+
+# Stand-in for vertexai's GenerativeModel, so the real GeminiClient (transport, retries, usage metrics) is part of
+# the measured path. Every call waits `latency` (time to first token) plus the output tokens at `tokens_per_second`,
+# and answers with canned JSON for the prompt template it was given.
+class FakeGenerativeModel:
+    initial_response = {
+        "intent": "find video",
+        "summary": "The user is looking for TED talk videos.",
+        "response": "Here are some videos I found.",
+    }
+    query_options = {
+        "topic": "ted talk",
+        "view_count": "",
+        "release_date_before": "",
+        "release_date_after": "",
+    }
+
+    def __init__(self, latency=0.3, tokens_per_second=100):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.calls = 0
+
+    def generate_content(self, prompt, stream=False):
+        text = self.respond(prompt)
+        if stream:
+            return self.stream(prompt, text)
+        time.sleep(self.duration(text))
+        return self.to_response(prompt, text)
+
+    async def generate_content_async(self, prompt):
+        text = self.respond(prompt)
+        await asyncio.sleep(self.duration(text))
+        return self.to_response(prompt, text)
+
+    def respond(self, prompt):
+        self.calls += 1
+        template = getattr(getattr(prompt, "template", None), "name", None)
+        if template == "video_search_query":
+            data = self.query_options
+        # The conversation prompt (server-side state) doesn't ask for a summary
+        elif template == "conversation":
+            data = {
+                "intent": "find video", "response": self.initial_response["response"], "query_options": self.query_options
+            }
+        elif template == "combined":
+            data = {**self.initial_response, "query_options": self.query_options}
+        else:
+            data = self.initial_response
+        return f"```json\n{json.dumps(data)}\n```"
+
+    def start_chat(self):
+        return FakeChat(self)
+
+    def stream(self, prompt, text, chunk_size=32):
+        time.sleep(self.latency)
+        for start in range(0, len(text), chunk_size):
+            chunk = text[start:start + chunk_size]
+            time.sleep(self.count_tokens(chunk) / self.tokens_per_second)
+            response = self.to_response(prompt, chunk)
+            if start + chunk_size < len(text):
+                response.usage_metadata = None
+            yield response
+
+    def duration(self, text):
+        return self.latency + self.count_tokens(text) / self.tokens_per_second
+
+    @staticmethod
+    def count_tokens(text):
+        return max(1, len(text) // 4)
+
+    def to_response(self, prompt, text):
+        return SimpleNamespace(
+            text=text,
+            candidates=[SimpleNamespace(content=SimpleNamespace(parts=[SimpleNamespace(text=text)]))],
+            usage_metadata=SimpleNamespace(
+                prompt_token_count=self.count_tokens(prompt), candidates_token_count=self.count_tokens(text)
+            ),
+        )
+
+
+class FakeChat:
+    def __init__(self, model):
+        self.model = model
+        self.history = []
+
+    def send_message(self, prompt):
+        response = self.model.generate_content(prompt)
+        self.history.append(SimpleNamespace(role="user", parts=[SimpleNamespace(text=prompt)]))
+        self.history.append(SimpleNamespace(role="model", parts=[SimpleNamespace(text=response.text)]))
+        return response
+
+
+TOPICS = [
+    "climate change", "space exploration", "machine learning", "cooking", "music", "psychology", "education",
+    "leadership", "design", "health", "history", "photography", "economics", "robotics", "travel", "art",
+]
+VERBS = ["understand", "rethink", "master", "explain", "discover", "fix", "teach", "love"]
+SPEAKERS = ["Will Stephen", "Adrien Golinelli", "Maya Chen", "Omar Haddad", "Lena Vogel", "Priya Nair", "Tom Okafor"]
+CITIES = ["NewYork", "Paris", "Berlin", "Tokyo", "Toronto", "Lagos", "Sydney"]
+
+
+# Deterministic synthetic videolists documents shaped like the real collection
+def generate_corpus(size, seed=0):
+    generator = random.Random(seed)
+    now = int(time.time())
+    documents = []
+    for number in range(size):
+        topic = generator.choice(TOPICS)
+        speaker = generator.choice(SPEAKERS)
+        documents.append(
+            {
+                "id": str(number),
+                "titles": [
+                    f"How to {generator.choice(VERBS)} {topic} | {speaker} | TEDx{generator.choice(CITIES)} {number}"
+                ],
+                "tags": [topic, generator.choice(TOPICS), "TEDx"],
+                "description": f"{speaker} talks about {topic} and {generator.choice(TOPICS)}.",
+                "view_count": int(generator.lognormvariate(9, 2)),
+                "released_date": now - generator.randrange(10 * 365 * 24 * 3600),
+                "thumbnail_url": f"https://i.ytimg.com/vi/{number}/hqdefault.jpg",
+                "thumbnail_height": 360,
+                "thumbnail_width": 480,
+            }
+        )
+        add_facets(documents[-1])
+    return documents
+
+
+FILTER_TOKEN = re.compile(r"\s*(\(|\)|&&|\|\||\w+:\s*(?:\[[^\]]*\]|(?:>=|<=|>|<|=)?\s*-?\d+))")
+CLAUSE_PATTERN = re.compile(r"^(\w+):\s*(>=|<=|>|<|=)?\s*(-?\d+)$")
+OPERATORS = {
+    ">": lambda value, target: value > target,
+    ">=": lambda value, target: value >= target,
+    "<": lambda value, target: value < target,
+    "<=": lambda value, target: value <= target,
+    "=": lambda value, target: value == target,
+}
+
+
+# Numeric filter_by expressions: field:>=1, field:[1,2,3], field:[1..5], joined with && / || and parentheses
+def parse_filter(expression):
+    tokens, position = [], 0
+    while position < len(expression.rstrip()):
+        match = FILTER_TOKEN.match(expression, position)
+        if not match:
+            raise ValueError(f"Could not parse the filter query: {expression}")
+        tokens.append(match.group(1))
+        position = match.end()
+
+    def parse_any():
+        predicates = [parse_all()]
+        while tokens and tokens[0] == "||":
+            tokens.pop(0)
+            predicates.append(parse_all())
+        return lambda document: any(predicate(document) for predicate in predicates)
+
+    def parse_all():
+        predicates = [parse_term()]
+        while tokens and tokens[0] == "&&":
+            tokens.pop(0)
+            predicates.append(parse_term())
+        return lambda document: all(predicate(document) for predicate in predicates)
+
+    def parse_term():
+        if not tokens:
+            raise ValueError(f"Could not parse the filter query: {expression}")
+        token = tokens.pop(0)
+        if token == "(":
+            predicate = parse_any()
+            if not tokens or tokens.pop(0) != ")":
+                raise ValueError(f"Could not parse the filter query: {expression}")
+            return predicate
+        return parse_clause(token)
+
+    predicate = parse_any()
+    if tokens:
+        raise ValueError(f"Could not parse the filter query: {expression}")
+    return predicate
+
+
+def parse_clause(clause):
+    field, _, value = clause.partition(":")
+    value = value.strip()
+    if value.startswith("["):
+        values = value[1:-1]
+        if ".." in values:
+            low, high = (int(bound) for bound in values.split(".."))
+            return lambda document: field in document and low <= document[field] <= high
+        targets = {int(target) for target in values.split(",")}
+        return lambda document: document.get(field) in targets
+    match = CLAUSE_PATTERN.match(clause)
+    operator, target = match.group(2) or "=", int(match.group(3))
+    return lambda document: field in document and OPERATORS[operator](document[field], target)
+
+
+def tokenize(text):
+    return re.findall(r"\w+", text.lower())
+
+
+# Small in-memory search engine covering the subset of the Typesense search API the service uses: weighted
+# token matching over query_by, numeric filter_by expressions (see parse_filter), sort_by, per_page and include_fields.
+# There is no typo tolerance, the point is realistic response shapes and sizes, not ranking quality.
+class InMemorySearchEngine:
+    def __init__(self, documents):
+        self.documents = {document["id"]: document for document in documents}
+        self.index = {}
+        for document in documents:
+            for field in ("titles", "tags", "description"):
+                value = document.get(field) or ""
+                text = " ".join(value) if isinstance(value, list) else value
+                for token in set(tokenize(text)):
+                    self.index.setdefault((field, token), set()).add(document["id"])
+
+    def search(self, params):
+        fields = [field.strip() for field in params.get("query_by", "titles").split(",")]
+        fields = [field for field in fields if field in ("titles", "tags", "description")]
+        weights = [int(weight) for weight in str(params.get("query_by_weight", "")).split(",") if weight.strip()]
+        weights = weights or [1] * len(fields)
+
+        query = params.get("q", "*")
+        if query.strip() == "*":
+            scores = dict.fromkeys(self.documents, 0)
+        else:
+            scores = {}
+            for token in tokenize(query):
+                for field, weight in zip(fields, weights):
+                    for document_id in self.index.get((field, token), ()):
+                        scores[document_id] = scores.get(document_id, 0) + weight
+
+        matches = [self.documents[document_id] for document_id in scores]
+        if (params.get("filter_by") or "").strip():
+            matches = list(filter(parse_filter(params["filter_by"]), matches))
+
+        for sort in reversed((params.get("sort_by") or "_text_match:desc").split(",")):
+            field, _, direction = sort.strip().partition(":")
+            key = (lambda document: scores[document["id"]]) if field == "_text_match" else (
+                lambda document, field=field: document.get(field, 0)
+            )
+            matches.sort(key=key, reverse=direction != "asc")
+
+        include = [field.strip() for field in params.get("include_fields", "").split(",") if field.strip()]
+        per_page = int(params.get("per_page", 10))
+        return {
+            "found": len(matches),
+            "hits": [
+                {
+                    "document": {field: document[field] for field in include if field in document} if include else document,
+                    "text_match": scores[document["id"]],
+                }
+                for document in matches[:per_page]
+            ],
+        }
+
+    def export(self):
+        return "\n".join(json.dumps(document) for document in self.documents.values())
+
+
+# Serves an InMemorySearchEngine over HTTP on a free local port, so the real Typesense clients (pooled sessions,
+# transport, httpx) are exercised. `latency` is added to every request to emulate the network and the server.
+class FakeTypesenseServer:
+    def __init__(self, documents, latency=0.0, api_key="benchmark"):
+        self.engine = InMemorySearchEngine(documents)
+        self.latency = latency
+        self.api_key = api_key
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.create_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def config(self):
+        return {
+            "nodes": [{"host": "127.0.0.1", "port": str(self.port), "protocol": "http"}],
+            "api_key": self.api_key,
+            "connection_timeout_seconds": 5,
+        }
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, method, path, query, body):
+        if self.latency:
+            time.sleep(self.latency)
+        parts = path.strip("/").split("/")
+        if path == "/health":
+            return 200, {"ok": True}
+        if method == "POST" and path == "/multi_search":
+            results = []
+            for search in body.get("searches", []):
+                try:
+                    results.append(self.engine.search(search))
+                except ValueError as error:
+                    results.append({"error": str(error), "code": 400})
+            return 200, {"results": results}
+        if method == "GET" and len(parts) == 4 and parts[0] == "collections" and parts[2] == "documents":
+            if parts[3] == "search":
+                try:
+                    return 200, self.engine.search(query)
+                except ValueError as error:
+                    return 400, {"message": str(error)}
+            if parts[3] == "export":
+                return 200, self.engine.export()
+            document = self.engine.documents.get(parts[3])
+            return (200, document) if document else (404, {"message": "Not Found"})
+        return 404, {"message": "Not Found"}
+
+    def create_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                self.respond("GET")
+
+            def do_POST(self):
+                self.respond("POST")
+
+            def respond(self, method):
+                url = urlsplit(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length) or b"{}") if length else {}
+                status, payload = fake.handle(method, url.path, dict(parse_qsl(url.query)), body)
+                data = (payload if isinstance(payload, str) else json.dumps(payload)).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
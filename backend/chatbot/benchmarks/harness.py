@@ -0,0 +1,137 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from django.test import override_settings
+
+from chatbot.benchmarks.stats import summarize
+from chatbot.clients.gemini_client import GeminiClient
+from chatbot.services.video_search import VideoSearchService
+from chatbot.views import AsyncChatAPI, ChatAPI
+
+# A mix of traffic: some prompts are answered by the fast path, the rest go through Gemini
+PROMPTS = [
+    "can you find me ted talk videos about climate change",
+    "what are some good talks on leadership?",
+    "show me cooking videos with more than 1000 views",
+    "find me videos about machine learning from 2022",
+    "who was the first person on the moon",
+    "can you recommend something about space exploration",
+    "find music videos released this year",
+    "tell me a joke",
+]
+
+
+# Builds ChatAPI / AsyncChatAPI instances wired to the fake model and the fake Typesense server through the real
+# GeminiClient and VideoSearchService. Response and search caches, and request coalescing, are off unless `caches`
+# is set, so every request pays for the full path.
+def build_views(model, typesense_config, caches=False):
+    gemini_client = GeminiClient()
+    gemini_client.model = model
+
+    overrides = {"TYPESENSE_CONFIG": typesense_config}
+    if not caches:
+        overrides["VIDEO_SEARCH_CACHE"] = {"TTL_SECONDS": 0, "MAX_ENTRIES": 0, "MAX_BYTES": None}
+    with override_settings(**overrides):
+        video_search_service = VideoSearchService()
+    if not caches:
+        video_search_service.search_flight = None
+    # Workers build the title index when they warm up
+    if video_search_service.title_index is not None:
+        video_search_service.title_index.refresh()
+
+    views = ChatAPI(), AsyncChatAPI()
+    for view in views:
+        view.gemini_client = gemini_client
+        view.video_search_service = video_search_service
+        if not caches:
+            view.response_cache = None
+            view.gemini_flight = None
+    return views
+
+
+def run_wsgi(view, requests, concurrency, prompts=PROMPTS):
+    user = SimpleNamespace(pk="benchmark")
+
+    def chat(number):
+        request = SimpleNamespace(data={"prompt": prompts[number % len(prompts)], "summary": ""}, user=user)
+        start = time.perf_counter()
+        try:
+            ok = view.post(request).status_code < 400
+        except Exception:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(chat, range(requests)))
+    return outcomes, time.perf_counter() - start
+
+
+def run_asgi(view, requests, concurrency, prompts=PROMPTS):
+    async def chat(number, semaphore):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                ok = await view.generate_response(prompts[number % len(prompts)], "") is not None
+            except Exception:
+                ok = False
+            return time.perf_counter() - start, ok
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(concurrency)
+        start = time.perf_counter()
+        outcomes = await asyncio.gather(*(chat(number, semaphore) for number in range(requests)))
+        return outcomes, time.perf_counter() - start
+
+    return asyncio.run(run_all())
+
+
+# Each scenario runs the WSGI (ChatAPI, a thread per request) or ASGI (AsyncChatAPI) path, with some settings
+# changed. "wsgi" and "asgi" keep the configured settings, the others compare the Gemini extraction modes.
+SCENARIOS = {
+    "wsgi": (run_wsgi, {}),
+    "asgi": (run_asgi, {}),
+    "single_call": (run_wsgi, {"GEMINI_SINGLE_CALL_EXTRACTION": True}),
+    "two_call": (run_wsgi, {"GEMINI_SINGLE_CALL_EXTRACTION": False}),
+}
+
+
+def run_scenario(name, views, requests, concurrency):
+    run, overrides = SCENARIOS[name]
+    view = views[0] if run is run_wsgi else views[1]
+    model = view.gemini_client.model
+    calls = model.calls
+    with override_settings(**overrides):
+        outcomes, elapsed = run(view, requests, concurrency)
+    samples = [duration for duration, ok in outcomes if ok]
+    return {
+        "scenario": name,
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": sum(1 for _, ok in outcomes if not ok),
+        "gemini_calls_per_request": round((model.calls - calls) / requests, 2) if requests else 0.0,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(samples) / elapsed, 2) if elapsed else 0.0,
+        **summarize(samples),
+    }
+
+
+# Compares a run against a stored one. A scenario regresses when its throughput drops, or its p95 latency or
+# error count grows, by more than `tolerance` (a fraction). Scenarios missing from either side are ignored.
+def find_regressions(results, baseline, tolerance=0.1):
+    previous = {(result["scenario"], result["concurrency"]): result for result in baseline["results"]}
+    regressions = []
+    for result in results["results"]:
+        base = previous.get((result["scenario"], result["concurrency"]))
+        if base is None:
+            continue
+        label = f"{result['scenario']} x{result['concurrency']}"
+        if result["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{label}: throughput {base['throughput_rps']} -> {result['throughput_rps']} rps")
+        if result["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{label}: p95 {base['p95_ms']} -> {result['p95_ms']} ms")
+        if result["errors"] > base["errors"] * (1 + tolerance):
+            regressions.append(f"{label}: errors {base['errors']} -> {result['errors']}")
+    return regressions
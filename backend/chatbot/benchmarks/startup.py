@@ -0,0 +1,87 @@
+import json
+import os
+import subprocess
+import sys
+
+from chatbot.benchmarks.stats import summarize
+
+# Runs in a fresh interpreter, like a worker booting: Django setup, the URLconf (which imports every view) and
+# optionally the client warm-up. Prints the duration of each phase as JSON on its last line.
+STARTUP_SCRIPT = """
+import json, sys, time
+timings = {}
+start = time.perf_counter()
+import django
+django.setup()
+timings["setup"] = time.perf_counter() - start
+from django.urls import get_resolver
+get_resolver().url_patterns
+timings["urls"] = time.perf_counter() - start - timings["setup"]
+if sys.argv[1:] == ["warm_up"]:
+    from django.conf import settings
+    from chatbot.utils.lazy_client import warm_up_clients
+    warm_up_clients(settings.CLIENT_WARM_UP["CLIENTS"])
+    timings["warm_up"] = time.perf_counter() - start - timings["setup"] - timings["urls"]
+timings["total"] = time.perf_counter() - start
+print(json.dumps(timings))
+"""
+
+
+# Parses the stderr of `python -X importtime` into (module, self seconds, cumulative seconds) entries
+def parse_importtime(output):
+    entries = []
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue
+        entries.append((parts[2].strip(), int(parts[0]) / 1e6, int(parts[1]) / 1e6))
+    return entries
+
+
+# Import time grouped by top-level package, most expensive first
+def summarize_imports(entries, top=10):
+    packages = {}
+    for module, self_time, _ in entries:
+        package = module.split(".")[0]
+        packages[package] = packages.get(package, 0) + self_time
+    ranked = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+    return {
+        "modules": len(entries),
+        "import_ms": round(sum(self_time for _, self_time, _ in entries) * 1000, 2),
+        "packages": [{"package": package, "ms": round(seconds * 1000, 2)} for package, seconds in ranked],
+    }
+
+
+def run_startup(warm_up=False):
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(path for path in sys.path if path)}
+    command = [sys.executable, "-X", "importtime", "-c", STARTUP_SCRIPT]
+    if warm_up:
+        command.append("warm_up")
+    process = subprocess.run(command, capture_output=True, text=True, env=env, check=True)
+    return json.loads(process.stdout.strip().splitlines()[-1]), parse_importtime(process.stderr)
+
+
+# Cold start of a worker process, `repeat` times. The first run also compiles bytecode, so it isn't counted when
+# there are several. The import profile is the one of the last run.
+def measure_startup(repeat=5, warm_up=False, top=10):
+    runs = [run_startup(warm_up) for _ in range(repeat + (repeat > 1))][-repeat:]
+    phases = runs[0][0].keys()
+    return {
+        "results": [
+            {"phase": phase, **summarize([timings[phase] for timings, _ in runs])} for phase in phases
+        ],
+        "imports": summarize_imports(runs[-1][1], top),
+    }
+
+
+# A phase regresses when its median grows by more than `tolerance` (a fraction)
+def find_startup_regressions(results, baseline, tolerance=0.1):
+    previous = {result["phase"]: result for result in baseline["results"]}
+    regressions = []
+    for result in results["results"]:
+        base = previous.get(result["phase"])
+        if base is not None and result["p50_ms"] > base["p50_ms"] * (1 + tolerance):
+            regressions.append(f"{result['phase']}: p50 {base['p50_ms']} -> {result['p50_ms']} ms")
+    return regressions
@@ -0,0 +1,90 @@
+from django.conf import settings
+from django.core import checks
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, router
+
+# Backends whose entries only exist in the process that wrote them
+LOCAL_CACHE_BACKENDS = (
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+)
+
+DATABASE_CACHE_BACKEND = "django.core.cache.backends.db.DatabaseCache"
+
+
+# (setting, cache alias) of the state that management commands and every worker must see, for the features enabled
+def shared_cache_users():
+    users = [("COLLECTION_EPOCH", settings.COLLECTION_EPOCH["CACHE_ALIAS"])]
+    if settings.CONVERSATION_STORE["ENABLED"]:
+        users.append(("CONVERSATION_STORE", settings.CONVERSATION_STORE["CACHE_ALIAS"]))
+    if settings.SINGLE_FLIGHT["ENABLED"] and settings.SINGLE_FLIGHT["SHARED"]:
+        users.append(("SINGLE_FLIGHT", settings.SINGLE_FLIGHT["CACHE_ALIAS"]))
+    if settings.GEMINI_RESPONSE_CACHE.get("BACKEND") == "django":
+        users.append(("GEMINI_RESPONSE_CACHE", settings.GEMINI_RESPONSE_CACHE["CACHE_ALIAS"]))
+    return users
+
+
+# A re-index made by a management command bumps the collection epoch in its own process only, and a conversation
+# started on one worker is unknown to the others, when their cache is local memory
+@checks.register(checks.Tags.caches)
+def check_shared_caches(app_configs=None, **kwargs):
+    errors = []
+    for setting, alias in shared_cache_users():
+        backend = settings.CACHES.get(alias, {}).get("BACKEND")
+        if backend is None:
+            errors.append(checks.Error(f"{setting} uses the cache '{alias}', which isn't in CACHES", id="chatbot.E001"))
+        elif backend in LOCAL_CACHE_BACKENDS:
+            errors.append(
+                checks.Error(
+                    f"{setting} uses the cache '{alias}' ({backend}), which isn't shared between processes",
+                    hint="Point it at a Redis or database cache (see CACHES in settings.py)",
+                    id="chatbot.E002",
+                )
+            )
+    return errors
+
+
+# The database cache's table isn't created by migrate, without it every cache read fails at request time.
+# Like Django's own database checks, only run by commands that are given databases (migrate) and by the workers.
+@checks.register(checks.Tags.database)
+def check_cache_tables(app_configs=None, databases=None, **kwargs):
+    if databases is None:
+        return []
+    errors = []
+    for alias in dict.fromkeys(alias for _, alias in shared_cache_users()):
+        config = settings.CACHES.get(alias, {})
+        if config.get("BACKEND") != DATABASE_CACHE_BACKEND:
+            continue
+        table = config["LOCATION"]
+        database = router.db_for_write(caches[alias].cache_model_class)
+        if database in databases and table not in connections[database].introspection.table_names():
+            errors.append(
+                checks.Error(
+                    f"The table '{table}' of the cache '{alias}' doesn't exist in the '{database}' database",
+                    hint="Run python manage.py createcachetable",
+                    id="chatbot.E003",
+                )
+            )
+    return errors
+
+
+# Both keep conversations that send a conversation_id, the store wins and the pool is never built
+@checks.register()
+def check_conversation_owner(app_configs=None, **kwargs):
+    if settings.CONVERSATION_STORE["ENABLED"] and settings.GEMINI_SESSION_POOL_SIZE:
+        return [
+            checks.Warning(
+                "GEMINI_SESSION_POOL_SIZE is ignored while CONVERSATION_STORE is enabled",
+                hint="Set GEMINI_SESSION_POOL_SIZE to 0, or disable CONVERSATION_STORE to use pooled chat sessions",
+                id="chatbot.W001",
+            )
+        ]
+    return []
+
+
+# Called from the WSGI/ASGI entry points, which don't run the system checks
+def ensure_shared_caches():
+    errors = check_shared_caches() or check_cache_tables(databases=settings.DATABASES)
+    if errors:
+        raise ImproperlyConfigured("\n".join(error.msg for error in errors))
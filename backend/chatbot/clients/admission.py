@@ -0,0 +1,275 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import math
+import threading
+import time
+
+from django.conf import settings
+
+from chatbot.clients.transport import TransportUnavailable
+from chatbot.utils.lazy_client import LazyClient
+from chatbot.utils.metrics import registry
+from chatbot.utils.ttl_cache import TTLCache
+
+admission_decisions = registry.counter(
+    "chatbot_admission_total",
+    "Gemini calls admitted, or rejected with a 429 (user_limit, queue_full, too_slow, expired, evicted)",
+    labels=("tier", "result"),
+)
+admission_queue_depth = registry.gauge("chatbot_admission_queue_depth", "Gemini calls waiting for quota")
+admission_wait = registry.histogram(
+    "chatbot_admission_wait_seconds", "Time admitted Gemini calls waited for quota", labels=("tier",)
+)
+
+# Async waiters can't block on the waiter's event, they check it this often
+ASYNC_POLL_INTERVAL = 0.02
+
+
+# Answered with a 429 and Retry-After. A TransportUnavailable, so batch items report it like any other outage.
+class AdmissionRejected(TransportUnavailable):
+    pass
+
+
+# Holds up to burst tokens and refills rate tokens per second. Callers hold the controller's lock.
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def refill(self, now):
+        if now > self.updated_at:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+    def take(self, now):
+        self.refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def give_back(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    # Seconds until `count` tokens are available
+    def wait_time(self, now, count=1):
+        self.refill(now)
+        return max(0.0, (count - self.tokens) / self.rate)
+
+
+# Lower priority numbers are admitted first. Each Gemini call must start within max_wait seconds of asking for
+# quota, or it is rejected instead of waiting any longer.
+class Tier:
+    def __init__(self, name, rate_per_minute, burst, priority, max_wait):
+        self.name = name
+        self.rate_per_minute = rate_per_minute
+        self.burst = burst
+        self.priority = priority
+        self.max_wait = max_wait
+
+    @classmethod
+    def from_config(cls, name, config):
+        return cls(name, config["RATE_PER_MINUTE"], config["BURST"], config["PRIORITY"], config["MAX_WAIT_SECONDS"])
+
+
+# Who a request's Gemini calls are admitted for, set when the request starts (see start_admission)
+class Ticket:
+    def __init__(self, user_key, tier):
+        self.user_key = user_key
+        self.tier = tier
+
+
+current_ticket = contextvars.ContextVar("chatbot_admission_ticket", default=None)
+
+
+class Waiter:
+    WAITING, ADMITTED, REJECTED = "waiting", "admitted", "rejected"
+
+    # The deadline is per call, a request's second call isn't penalised for the time its first call took
+    def __init__(self, ticket, user_bucket, sequence, enqueued_at):
+        self.ticket = ticket
+        self.user_bucket = user_bucket
+        self.deadline = enqueued_at + ticket.tier.max_wait
+        self.key = (ticket.tier.priority, self.deadline, sequence)
+        self.enqueued_at = enqueued_at
+        self.state = self.WAITING
+        self.reason = None
+        self.retry_after = 1
+        self.event = threading.Event()
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+
+# Token-bucket admission in front of the Gemini calls of one worker process. Each user has a bucket sized by
+# their tier, and calls that pass it take a token from the worker's share of the Vertex AI quota. When that is
+# empty, calls wait in a bounded queue ordered by tier priority, then deadline. A call whose deadline can't be
+# met, or passes while it waits, is rejected before it uses any quota, so clients get a fast 429 with
+# Retry-After instead of a timeout. Waiting calls admit each other as tokens refill, there is no dispatcher thread.
+class AdmissionController:
+    def __init__(self, rate_per_minute, burst, max_queue, tiers, default_tier="default", max_users=10000, user_ttl=300):
+        self.bucket = TokenBucket(rate_per_minute / 60, burst)
+        self.max_queue = max_queue
+        self.tiers = tiers
+        self.default_tier = tiers[default_tier]
+        self.user_buckets = TTLCache(max_entries=max_users, ttl=user_ttl)
+        self.user_tiers = TTLCache(max_entries=max_users, ttl=user_ttl)
+        self.queue = []
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        config = settings.GEMINI_ADMISSION
+        if not config["ENABLED"]:
+            return None
+        return cls(
+            config["RATE_PER_MINUTE"],
+            config["BURST"],
+            config["MAX_QUEUE"],
+            {name: Tier.from_config(name, tier) for name, tier in config["TIERS"].items()},
+            default_tier=config["DEFAULT_TIER"],
+            max_users=config["MAX_USERS"],
+        )
+
+    # The first tier (in settings order) one of the user's groups is named after, otherwise "staff" for staff
+    # users when that tier exists, otherwise the default tier. Kept for a few minutes so requests don't query the groups every time.
+    def tier_for(self, user):
+        name = self.user_tiers.get(user.pk)
+        if name is None:
+            groups = set(user.groups.filter(name__in=list(self.tiers)).values_list("name", flat=True))
+            name = next((tier for tier in self.tiers if tier in groups), None)
+            if name is None:
+                name = "staff" if user.is_staff and "staff" in self.tiers else self.default_tier.name
+            self.user_tiers.set(user.pk, name)
+        return self.tiers[name]
+
+    def ticket(self, user):
+        tier = self.tier_for(user)
+        return Ticket(user.pk, tier)
+
+    # Calls outside a request (management commands) only go through the shared quota
+    def default_ticket(self):
+        return Ticket(None, self.default_tier)
+
+    def admit(self, ticket=None):
+        waiter, timeout = self.enqueue(ticket or self.default_ticket())
+        while timeout is not None:
+            waiter.event.wait(timeout)
+            timeout = self.poll(waiter)
+        self.finish(waiter)
+
+    async def admit_async(self, ticket=None):
+        waiter, timeout = self.enqueue(ticket or self.default_ticket())
+        while timeout is not None:
+            await asyncio.sleep(min(timeout, ASYNC_POLL_INTERVAL))
+            timeout = self.poll(waiter)
+        self.finish(waiter)
+
+    # Vertex AI answered 429 anyway (quota shared with other workers or projects): stop admitting until the
+    # bucket refills instead of sending more calls into the same limit
+    def drain(self):
+        with self.lock:
+            self.bucket.refill(time.monotonic())
+            self.bucket.tokens = 0
+
+    def enqueue(self, ticket):
+        now = time.monotonic()
+        with self.lock:
+            user_bucket = self.get_user_bucket(ticket)
+            waiter = Waiter(ticket, user_bucket, next(self.sequence), now)
+            if user_bucket is not None and not user_bucket.take(now):
+                self.reject(waiter, "user_limit", user_bucket.wait_time(now), refund=False)
+                return waiter, None
+
+            ahead = sum(1 for queued in self.queue if queued.key < waiter.key)
+            wait_time = self.bucket.wait_time(now, ahead + 1)
+            if now + wait_time > waiter.deadline:
+                self.reject(waiter, "too_slow", wait_time)
+                return waiter, None
+
+            if len(self.queue) >= self.max_queue:
+                last = max(self.queue)
+                if last.key < waiter.key:
+                    self.reject(waiter, "queue_full", wait_time)
+                    return waiter, None
+                self.queue.remove(last)
+                heapq.heapify(self.queue)
+                self.reject(last, "evicted", wait_time)
+
+            heapq.heappush(self.queue, waiter)
+            self.dispatch(now)
+            return waiter, self.next_poll(waiter, now)
+
+    def poll(self, waiter):
+        now = time.monotonic()
+        with self.lock:
+            self.dispatch(now)
+            return self.next_poll(waiter, now)
+
+    # Drops the waiters whose deadline has passed, then admits from the front of the queue while there is quota
+    def dispatch(self, now):
+        expired = [waiter for waiter in self.queue if waiter.deadline <= now]
+        if expired:
+            self.queue = [waiter for waiter in self.queue if waiter.deadline > now]
+            heapq.heapify(self.queue)
+            for waiter in expired:
+                self.reject(waiter, "expired", self.bucket.wait_time(now, len(self.queue) + 1))
+        while self.queue and self.bucket.take(now):
+            waiter = heapq.heappop(self.queue)
+            waiter.state = Waiter.ADMITTED
+            waiter.event.set()
+        admission_queue_depth.set(len(self.queue))
+
+    # Wakes up when the next token is due, or at the deadline
+    def next_poll(self, waiter, now):
+        if waiter.state != Waiter.WAITING:
+            return None
+        return max(0.001, min(waiter.deadline - now, self.bucket.wait_time(now)))
+
+    # Callers hold the lock. A call rejected after passing its user's bucket gets the token back.
+    def reject(self, waiter, reason, wait_time, refund=True):
+        if refund and waiter.user_bucket is not None:
+            waiter.user_bucket.give_back()
+        waiter.state = Waiter.REJECTED
+        waiter.reason = reason
+        waiter.retry_after = max(1, math.ceil(wait_time))
+        waiter.event.set()
+
+    def finish(self, waiter):
+        tier = waiter.ticket.tier.name
+        if waiter.state == Waiter.ADMITTED:
+            admission_decisions.inc(tier=tier, result="admitted")
+            admission_wait.observe(time.monotonic() - waiter.enqueued_at, tier=tier)
+            return
+        admission_decisions.inc(tier=tier, result=waiter.reason)
+        raise AdmissionRejected(f"Gemini call rejected ({waiter.reason})", retry_after=waiter.retry_after)
+
+    # Callers hold the lock
+    def get_user_bucket(self, ticket):
+        if ticket.user_key is None:
+            return None
+        bucket = self.user_buckets.get(ticket.user_key)
+        if bucket is None:
+            bucket = TokenBucket(ticket.tier.rate_per_minute / 60, ticket.tier.burst)
+        # Set on every call so an active user's bucket isn't dropped by the TTL and handed out full again
+        self.user_buckets.set(ticket.user_key, bucket)
+        return bucket
+
+
+# One controller per process, shared by every GeminiClient and view. None when GEMINI_ADMISSION is disabled.
+admission_controller = LazyClient("admission", AdmissionController.from_settings)
+
+
+def ticket_for(user):
+    admission = admission_controller.get()
+    return None if admission is None else admission.ticket(user)
+
+
+# Called by the views once the user is authenticated, the Gemini calls made for the request read the ticket
+def start_admission(user):
+    current_ticket.set(ticket_for(user))
@@ -0,0 +1,62 @@
+import threading
+from collections import OrderedDict
+
+
+class ChatSession:
+    def __init__(self, chat):
+        self.chat = chat
+        self.lock = threading.Lock()
+
+
+# Bounded pool of Gemini chat sessions keyed by user/conversation.
+# The least recently used session is evicted once max_sessions is reached, and each history is trimmed
+# to max_history_tokens so a long conversation can't keep growing the payload of every call.
+class ChatSessionPool:
+    def __init__(self, model, max_sessions=1000, max_history_tokens=4000):
+        self.model = model
+        self.max_sessions = max_sessions
+        self.max_history_tokens = max_history_tokens
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def send_message(self, session_key, prompt):
+        session = self.get_session(session_key)
+        # A ChatSession isn't thread-safe, so concurrent requests for the same conversation are serialised
+        with session.lock:
+            response = session.chat.send_message(prompt)
+            self.trim_history(session.chat.history)
+        return response
+
+    def get_session(self, session_key):
+        with self.lock:
+            session = self.sessions.get(session_key)
+            if session is not None:
+                self.sessions.move_to_end(session_key)
+                return session
+
+            session = ChatSession(self.model.start_chat())
+            self.sessions[session_key] = session
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+            return session
+
+    def discard(self, session_key):
+        with self.lock:
+            self.sessions.pop(session_key, None)
+
+    # Drop the oldest user/model turn pairs until the history fits in the token budget
+    def trim_history(self, history):
+        while len(history) > 2 and self.count_tokens(history) > self.max_history_tokens:
+            del history[:2]
+
+    # Rough estimate (about 4 characters per token), counting locally avoids an extra count_tokens round trip
+    @staticmethod
+    def count_tokens(history):
+        characters = 0
+        for content in history:
+            for part in content.parts:
+                characters += len(getattr(part, "text", "") or "")
+        return characters // 4
+
+    def __len__(self):
+        return len(self.sessions)
@@ -1,7 +1,23 @@
+from contextlib import asynccontextmanager, contextmanager
+
 from django.conf import settings
+from google.api_core import exceptions as google_exceptions
+from vertexai.language_models import TextEmbeddingModel
 from vertexai.preview.generative_models import GenerativeModel
 import vertexai
 
+from chatbot.clients.admission import AdmissionRejected, admission_controller, current_ticket
+from chatbot.clients.chat_session_pool import ChatSessionPool
+from chatbot.clients.transport import get_transport
+from chatbot.utils.metrics import record_gemini_usage
+
+RETRYABLE_ERRORS = (
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+    google_exceptions.ResourceExhausted,
+)
+
 
 class GeminiClient:
     def __init__(self):
@@ -11,7 +27,104 @@ class GeminiClient:
         vertexai.init(project=project_id, location=location)
 
         self.model = GenerativeModel(ai_model)
-        self.chat = self.model.start_chat()
+        self.embedding_model = None
+        self.transport = get_transport("gemini", retry_on=RETRYABLE_ERRORS)
+        self.admission = admission_controller.get()
+        self.session_pool = None
+        # Conversations are kept by the conversation store when it is enabled, the pool would never be used
+        if settings.GEMINI_SESSION_POOL_SIZE and not settings.CONVERSATION_STORE["ENABLED"]:
+            self.session_pool = ChatSessionPool(
+                self.model,
+                max_sessions=settings.GEMINI_SESSION_POOL_SIZE,
+                max_history_tokens=settings.GEMINI_SESSION_MAX_HISTORY_TOKENS,
+            )
+
+    # Opens the gRPC channel and fetches the access token before the first request. Counting tokens isn't billed.
+    def warm_up(self):
+        self.model.count_tokens("warm up")
+
+    # Stateless call, the request only carries its own prompt so latency doesn't grow with the process lifetime
+    def generate_content(self, prompt):
+        with self.admitted():
+            response = self.transport.call(self.model.generate_content, prompt)
+        record_gemini_usage(response)
+        return response
+
+    # Each model call waits for quota under the current request's ticket (see chatbot.clients.admission). A 429
+    # from Vertex AI that outlasted the transport's retries is answered with a 429 too, instead of a 500.
+    @contextmanager
+    def admitted(self):
+        if self.admission is not None:
+            self.admission.admit(current_ticket.get())
+        try:
+            yield
+        except google_exceptions.ResourceExhausted as error:
+            raise self.quota_exhausted() from error
+
+    @asynccontextmanager
+    async def admitted_async(self):
+        if self.admission is not None:
+            await self.admission.admit_async(current_ticket.get())
+        try:
+            yield
+        except google_exceptions.ResourceExhausted as error:
+            raise self.quota_exhausted() from error
+
+    def quota_exhausted(self):
+        if self.admission is not None:
+            self.admission.drain()
+        return AdmissionRejected("Gemini quota exhausted", retry_after=settings.TRANSPORTS["gemini"]["BACKOFF_MAX_SECONDS"])
+
+    # Yields the text of each chunk as Gemini generates it. A stream can't be retried or hedged once it has
+    # started, so it only goes through the circuit breaker.
+    def stream_content(self, prompt):
+        chunk = None
+        with self.admitted():
+            self.transport.breaker.before_call(self.transport.name)
+            try:
+                responses = self.model.generate_content(prompt, stream=True)
+                try:
+                    for chunk in responses:
+                        if chunk.candidates and chunk.candidates[0].content.parts:
+                            yield chunk.text
+                finally:
+                    # Closing the response iterator cancels the generation when the caller stops reading early
+                    close = getattr(responses, "close", None)
+                    if close is not None:
+                        close()
+            except GeneratorExit:
+                # The caller stopped reading, Gemini was answering
+                self.transport.breaker.record_success()
+                raise
+            except BaseException as error:
+                self.transport.record_error(error)
+                raise
+            self.transport.breaker.record_success()
+        # Usage is reported on the final chunk
+        record_gemini_usage(chunk)
+
+    async def generate_content_async(self, prompt):
+        async with self.admitted_async():
+            response = await self.transport.call_async(self.model.generate_content_async, prompt)
+        record_gemini_usage(response)
+        return response
+
+    # Only used by the semantic response cache, the embedding model is loaded on first use. Like generations, the
+    # call waits for quota and goes through the transport (timeout, retries, circuit breaker).
+    def embed(self, text):
+        if self.embedding_model is None:
+            self.embedding_model = TextEmbeddingModel.from_pretrained(
+                settings.GEMINI_RESPONSE_CACHE["EMBEDDING_MODEL"]
+            )
+        with self.admitted():
+            embeddings = self.transport.call(self.embedding_model.get_embeddings, [text])
+        return embeddings[0].values
 
-    def send_message(self, prompt):
-        return self.chat.send_message(prompt)
+    # Conversations only get a chat history when the session pool is enabled and the caller passes a session key
+    def send_message(self, prompt, session_key=None):
+        if session_key is None or self.session_pool is None:
+            return self.generate_content(prompt)
+        with self.admitted():
+            response = self.transport.call(self.session_pool.send_message, session_key, prompt)
+        record_gemini_usage(response)
+        return response
@@ -0,0 +1,304 @@
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.conf import settings
+
+
+class TransportUnavailable(Exception):
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# Raised without calling the backend while its circuit is open
+class CircuitOpenError(TransportUnavailable):
+    pass
+
+
+# Raised when every concurrency slot for a backend is taken, instead of queueing more request threads behind it
+class TransportBusyError(TransportUnavailable):
+    pass
+
+
+# Opens after failure_threshold consecutive failures, then lets a single trial call through once reset_timeout
+# has passed. A successful trial closes it again, a failed one re-opens it.
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def before_call(self, name):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if self.state == self.OPEN and remaining <= 0:
+                self.state = self.HALF_OPEN
+                return
+            raise CircuitOpenError(f"{name} circuit is open", retry_after=max(1, round(remaining)))
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    # The call ended without showing whether the backend is healthy (no slot to run it, or it was cancelled).
+    # A half-open trial goes back to open, so another one is let through after reset_timeout.
+    def record_inconclusive(self):
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class TransportMetrics:
+    COUNTERS = ("calls", "successes", "failures", "timeouts", "retries", "hedges", "rejected")
+
+    def __init__(self):
+        self.counts = dict.fromkeys(self.COUNTERS, 0)
+        self.latencies = deque(maxlen=1000)
+        self.lock = threading.Lock()
+
+    def increment(self, counter):
+        with self.lock:
+            self.counts[counter] += 1
+
+    def observe(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def snapshot(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            counts = dict(self.counts)
+        for name, pct in (("latency_p50_ms", 0.5), ("latency_p95_ms", 0.95)):
+            counts[name] = round(latencies[int(pct * (len(latencies) - 1))] * 1000, 2) if latencies else 0.0
+        return counts
+
+
+# Shared call policy for the outbound clients (Typesense, Vertex AI): per-call timeout, bounded retries with
+# jittered exponential backoff, an optional hedged second attempt when the first is slow, a circuit breaker,
+# and a cap on concurrent calls so one slow node or region can't tie up every request thread.
+class Transport:
+    def __init__(
+        self,
+        name,
+        timeout=5,
+        max_retries=2,
+        backoff_base=0.1,
+        backoff_max=2,
+        hedge_after=None,
+        failure_threshold=5,
+        reset_timeout=30,
+        max_concurrency=32,
+        retry_on=(ConnectionError, TimeoutError),
+    ):
+        self.name = name
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_after = hedge_after
+        self.retry_on = tuple(retry_on) + (TimeoutError,)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.metrics = TransportMetrics()
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix=f"{name}-transport")
+
+    @classmethod
+    def from_settings(cls, name, retry_on=()):
+        config = settings.TRANSPORTS[name]
+        return cls(
+            name,
+            timeout=config["TIMEOUT_SECONDS"],
+            max_retries=config["MAX_RETRIES"],
+            backoff_base=config["BACKOFF_BASE_SECONDS"],
+            backoff_max=config["BACKOFF_MAX_SECONDS"],
+            hedge_after=config.get("HEDGE_AFTER_SECONDS"),
+            failure_threshold=config["FAILURE_THRESHOLD"],
+            reset_timeout=config["RESET_TIMEOUT_SECONDS"],
+            max_concurrency=config["MAX_CONCURRENCY"],
+            retry_on=tuple(retry_on) + (ConnectionError,),
+        )
+
+    # "Full jitter" backoff, so retries from many workers don't arrive at the backend in lockstep
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def call(self, fn, *args, **kwargs):
+        return self.run_with_retries(lambda: self.attempt(fn, args, kwargs))
+
+    async def call_async(self, fn, *args, **kwargs):
+        return await self.run_with_retries_async(lambda: self.attempt_async(fn, args, kwargs))
+
+    def run_with_retries(self, attempt):
+        self.metrics.increment("calls")
+        last_error = None
+        for retry in range(self.max_retries + 1):
+            self.breaker.before_call(self.name)
+            if retry:
+                self.metrics.increment("retries")
+                time.sleep(self.backoff(retry))
+            start = time.perf_counter()
+            try:
+                result = attempt()
+            except self.retry_on as error:
+                last_error = self.record_failure(error)
+                continue
+            except BaseException as error:
+                self.record_error(error)
+                raise
+            self.record_success(start)
+            return result
+        raise last_error
+
+    async def run_with_retries_async(self, attempt):
+        self.metrics.increment("calls")
+        last_error = None
+        for retry in range(self.max_retries + 1):
+            self.breaker.before_call(self.name)
+            if retry:
+                self.metrics.increment("retries")
+                await asyncio.sleep(self.backoff(retry))
+            start = time.perf_counter()
+            try:
+                result = await attempt()
+            except self.retry_on as error:
+                last_error = self.record_failure(error)
+                continue
+            except BaseException as error:
+                self.record_error(error)
+                raise
+            self.record_success(start)
+            return result
+        raise last_error
+
+    def record_success(self, start):
+        self.breaker.record_success()
+        self.metrics.increment("successes")
+        self.metrics.observe(time.perf_counter() - start)
+
+    def record_failure(self, error):
+        self.breaker.record_failure()
+        self.metrics.increment("timeouts" if isinstance(error, TimeoutError) else "failures")
+        return error
+
+    # Every outcome has to reach the breaker, or a half-open circuit waits for its trial call forever. A
+    # non-retryable error (a 404, an invalid request) still means the backend answered.
+    def record_error(self, error):
+        if isinstance(error, self.retry_on):
+            self.record_failure(error)
+        elif isinstance(error, TransportUnavailable) or not isinstance(error, Exception):
+            self.breaker.record_inconclusive()
+        else:
+            self.breaker.record_success()
+
+    def submit(self, fn, args, kwargs):
+        if not self.slots.acquire(blocking=False):
+            self.metrics.increment("rejected")
+            raise TransportBusyError(f"Too many concurrent {self.name} calls")
+
+        def run():
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.slots.release()
+
+        return self.executor.submit(run)
+
+    # Runs the call on the transport's own pool so the caller can stop waiting after the timeout. With hedging,
+    # a second identical call is started after hedge_after seconds and whichever succeeds first wins.
+    def attempt(self, fn, args, kwargs):
+        deadline = time.monotonic() + self.timeout
+        futures = [self.submit(fn, args, kwargs)]
+
+        if self.hedge_after is not None and self.hedge_after < self.timeout:
+            done, _ = wait(futures, timeout=self.hedge_after)
+            if not done:
+                try:
+                    futures.append(self.submit(fn, args, kwargs))
+                    self.metrics.increment("hedges")
+                except TransportBusyError:
+                    pass
+
+        last_error = None
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=max(0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                last_error = future.exception()
+        raise last_error or TimeoutError(f"{self.name} call timed out after {self.timeout}s")
+
+    async def attempt_async(self, fn, args, kwargs):
+        deadline = time.monotonic() + self.timeout
+        tasks = [asyncio.ensure_future(fn(*args, **kwargs))]
+        try:
+            if self.hedge_after is not None and self.hedge_after < self.timeout:
+                done, _ = await asyncio.wait(tasks, timeout=self.hedge_after)
+                if not done:
+                    tasks.append(asyncio.ensure_future(fn(*args, **kwargs)))
+                    self.metrics.increment("hedges")
+
+            last_error = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=max(0, deadline - time.monotonic()), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    break
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    last_error = task.exception()
+            raise last_error or TimeoutError(f"{self.name} call timed out after {self.timeout}s")
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def health(self):
+        return {"state": self.breaker.state, **self.metrics.snapshot()}
+
+
+transports = {}
+transports_lock = threading.Lock()
+
+
+# The longest a call through the named transport can take: every attempt timing out, with the longest backoffs
+def call_deadline(name):
+    config = settings.TRANSPORTS[name]
+    retries = config["MAX_RETRIES"]
+    return config["TIMEOUT_SECONDS"] * (retries + 1) + config["BACKOFF_MAX_SECONDS"] * retries
+
+
+# One transport per backend and process, shared by every client instance
+def get_transport(name, retry_on=()):
+    with transports_lock:
+        if name not in transports:
+            transports[name] = Transport.from_settings(name, retry_on)
+        return transports[name]
+
+
+def transports_health():
+    return {name: transport.health() for name, transport in transports.items()}
@@ -1,7 +1,230 @@
+import asyncio
+import itertools
+import json
+import os
+import threading
+import time
+import weakref
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
 from typesense import Client
 from django.conf import settings
 
+from chatbot.clients.transport import get_transport
+
+
+class TypesenseServerError(Exception):
+    pass
+
+
+# One search of a multi_search request failed while the others succeeded
+class TypesenseSearchError(Exception):
+    pass
+
+
+# Spreads requests over every configured node and skips a node for healthcheck_interval_seconds after it fails,
+# so one slow or dead node only costs a single attempt before the retry goes to the next one
+class TypesenseNodes:
+    def __init__(self, config):
+        self.urls = [f"{node['protocol']}://{node['host']}:{node['port']}" for node in config["nodes"]]
+        self.cooldown = config.get("healthcheck_interval_seconds", 15)
+        self.unhealthy_until = {}
+        self.counter = itertools.count()
+
+    def pick(self):
+        now = time.monotonic()
+        for _ in range(len(self.urls)):
+            url = self.urls[next(self.counter) % len(self.urls)]
+            if self.unhealthy_until.get(url, 0) <= now:
+                return url
+        # Every node is marked down, try one anyway rather than failing without a request
+        return self.urls[next(self.counter) % len(self.urls)]
+
+    def mark_down(self, url):
+        self.unhealthy_until[url] = time.monotonic() + self.cooldown
+
+
+sessions = {}
+sessions_lock = threading.Lock()
+
+
+# One keep-alive connection pool per worker process. Keyed by pid so forked workers don't share sockets.
+def get_session():
+    pid = os.getpid()
+    with sessions_lock:
+        if pid not in sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=len(settings.TYPESENSE_CONFIG["nodes"]),
+                pool_maxsize=settings.TRANSPORTS["typesense"]["POOL_SIZE"],
+                max_retries=0,  # Retries are handled by the transport
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            sessions.clear()
+            sessions[pid] = session
+        return sessions[pid]
+
+
+RETRYABLE_ERRORS = (requests.ConnectionError, requests.Timeout, httpx.TransportError, TypesenseServerError)
+
 
 class TypesenseClient:
+    # Bulk imports need a longer timeout than the 2s used for searches
+    def __init__(self, connection_timeout=None):
+        config = settings.TYPESENSE_CONFIG
+        if connection_timeout is not None:
+            config = {**config, "connection_timeout_seconds": connection_timeout}
+        # The typesense library client is used for admin and import calls, searches go through the pooled session
+        self.client = Client(config)
+        self.nodes = TypesenseNodes(config)
+        self.headers = {"X-TYPESENSE-API-KEY": config["api_key"]}
+        self.timeout = config.get("connection_timeout_seconds", 2)
+        self.transport = get_transport("typesense", retry_on=RETRYABLE_ERRORS)
+
+    # Opens a keep-alive connection to every node, so the first searches skip the TCP (and TLS) handshake
+    def warm_up(self):
+        for url in self.nodes.urls:
+            get_session().get(f"{url}/health", timeout=self.timeout).raise_for_status()
+
+    def search(self, collection, search_parameters):
+        if "vector_query" in search_parameters:
+            return first_search_result(self.multi_search([{"collection": collection, **search_parameters}]))
+        return self.transport.call(
+            self.request, "GET", f"/collections/{collection}/documents/search", params=search_parameters
+        )
+
+    # Runs several searches in one round trip. Each entry of "results" is either a search result or an error object.
+    def multi_search(self, searches):
+        return self.transport.call(self.request, "POST", "/multi_search", json={"searches": searches})
+
+    # Returns None when the document no longer exists (e.g. deleted since the title index was loaded)
+    def get_document(self, collection, document_id):
+        try:
+            return self.transport.call(self.request, "GET", f"/collections/{collection}/documents/{document_id}")
+        except requests.HTTPError as error:
+            if error.response is not None and error.response.status_code == 404:
+                return None
+            raise
+
+    # True when a collection or an alias with this name exists
+    def collection_exists(self, name):
+        for path in (f"/aliases/{name}", f"/collections/{name}"):
+            try:
+                self.transport.call(self.request, "GET", path)
+                return True
+            except requests.HTTPError as error:
+                if error.response is None or error.response.status_code != 404:
+                    raise
+        return False
+
+    # Yields the documents of a collection one at a time from the JSONL export, without holding all of it in memory.
+    # Not retried: the export is only read by background jobs, which try again later.
+    def export_documents(self, collection, params):
+        url = self.nodes.pick()
+        try:
+            response = get_session().get(
+                f"{url}/collections/{collection}/documents/export",
+                params=params,
+                headers=self.headers,
+                timeout=self.timeout,
+                stream=True,
+            )
+        except (requests.ConnectionError, requests.Timeout):
+            self.nodes.mark_down(url)
+            raise
+
+        with response:
+            check_response(self.nodes, url, response.status_code)
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
+
+    def request(self, method, path, **kwargs):
+        url = self.nodes.pick()
+        try:
+            response = get_session().request(
+                method, f"{url}{path}", headers=self.headers, timeout=self.timeout, **kwargs
+            )
+        except (requests.ConnectionError, requests.Timeout):
+            self.nodes.mark_down(url)
+            raise
+
+        check_response(self.nodes, url, response.status_code)
+        response.raise_for_status()
+        return response.json()
+
+
+def check_response(nodes, url, status_code):
+    if status_code >= 500:
+        nodes.mark_down(url)
+    if status_code >= 500 or status_code == 429:
+        raise TypesenseServerError(f"Typesense node {url} responded with {status_code}")
+
+
+# A vector_query holds hundreds of floats, more than Typesense accepts in a GET query string (4000 characters),
+# so those searches are sent in the body of a single-search multi_search request instead
+def first_search_result(response):
+    result = response["results"][0]
+    if "error" in result:
+        raise TypesenseSearchError(result["error"])
+    return result
+
+
+# Non-blocking client for the search endpoint used by the async chat view.
+# httpx clients are bound to the event loop they were opened on, so one client is kept per running loop.
+class AsyncTypesenseClient:
     def __init__(self):
-        self.client = Client(settings.TYPESENSE_CONFIG)
\ No newline at end of file
+        config = settings.TYPESENSE_CONFIG
+        self.nodes = TypesenseNodes(config)
+        self.headers = {"X-TYPESENSE-API-KEY": config["api_key"]}
+        self.timeout = config.get("connection_timeout_seconds", 2)
+        self.limits = httpx.Limits(
+            max_connections=settings.TRANSPORTS["typesense"]["POOL_SIZE"],
+            max_keepalive_connections=settings.TRANSPORTS["typesense"]["POOL_SIZE"],
+        )
+        self.transport = get_transport("typesense", retry_on=RETRYABLE_ERRORS)
+        self.clients = weakref.WeakKeyDictionary()
+
+    def get_client(self):
+        loop = asyncio.get_running_loop()
+        client = self.clients.get(loop)
+        if client is None:
+            client = httpx.AsyncClient(headers=self.headers, timeout=self.timeout, limits=self.limits)
+            self.clients[loop] = client
+        return client
+
+    async def search(self, collection, search_parameters):
+        if "vector_query" in search_parameters:
+            return first_search_result(await self.multi_search([{"collection": collection, **search_parameters}]))
+        return await self.transport.call_async(
+            self.request, "GET", f"/collections/{collection}/documents/search", params=search_parameters
+        )
+
+    async def multi_search(self, searches):
+        return await self.transport.call_async(self.request, "POST", "/multi_search", json={"searches": searches})
+
+    async def get_document(self, collection, document_id):
+        try:
+            return await self.transport.call_async(
+                self.request, "GET", f"/collections/{collection}/documents/{document_id}"
+            )
+        except httpx.HTTPStatusError as error:
+            if error.response.status_code == 404:
+                return None
+            raise
+
+    async def request(self, method, path, **kwargs):
+        url = self.nodes.pick()
+        try:
+            response = await self.get_client().request(method, f"{url}{path}", **kwargs)
+        except httpx.TransportError:
+            self.nodes.mark_down(url)
+            raise
+
+        check_response(self.nodes, url, response.status_code)
+        response.raise_for_status()
+        return response.json()
@@ -0,0 +1,80 @@
+import json
+import platform
+import sys
+from datetime import datetime, timezone
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.benchmarks.fakes import FakeGenerativeModel, FakeTypesenseServer, generate_corpus
+from chatbot.benchmarks.harness import SCENARIOS, build_views, find_regressions, run_scenario
+
+
+def comma_separated(cast):
+    return lambda value: [cast(item) for item in value.split(",") if item]
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure throughput and latency of the chat request path offline, against a fake Vertex model and a fake "
+        "Typesense server with a synthetic corpus. Scenarios cover the WSGI and ASGI paths and the single-call and "
+        "two-call Gemini extraction modes. Writes JSON results and can fail on a regression."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--scenarios", type=comma_separated(str), default=list(SCENARIOS))
+        parser.add_argument("--concurrency", type=comma_separated(int), default=[1, 8, 32])
+        parser.add_argument("--requests", type=int, default=200, help="Requests per scenario and concurrency level")
+        parser.add_argument("--corpus-size", type=int, default=10000, help="Synthetic videolists documents")
+        parser.add_argument("--gemini-latency", type=float, default=0.2, help="Seconds before the first token")
+        parser.add_argument("--tokens-per-second", type=float, default=200)
+        parser.add_argument("--search-latency", type=float, default=0.005, help="Seconds added to each Typesense request")
+        parser.add_argument("--caches", action="store_true", help="Keep the response and search caches and request coalescing enabled")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+        parser.add_argument("--baseline", help="JSON results of a previous run to compare against")
+        parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed regression as a fraction (0.1 = 10%%)")
+
+    def handle(self, *args, **options):
+        unknown = set(options["scenarios"]) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+        model = FakeGenerativeModel(latency=options["gemini_latency"], tokens_per_second=options["tokens_per_second"])
+        corpus = generate_corpus(options["corpus_size"], seed=options["seed"])
+
+        results = []
+        with FakeTypesenseServer(corpus, latency=options["search_latency"]) as server:
+            views = build_views(model, server.config(), caches=options["caches"])
+            for name in options["scenarios"]:
+                for concurrency in options["concurrency"]:
+                    result = run_scenario(name, views, options["requests"], concurrency)
+                    results.append(result)
+                    self.stderr.write(
+                        f"{name} x{concurrency}: {result['throughput_rps']} rps p50={result['p50_ms']}ms "
+                        f"p95={result['p95_ms']}ms errors={result['errors']} "
+                        f"gemini_calls/request={result['gemini_calls_per_request']}"
+                    )
+
+        report = {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "config": {
+                key: options[key]
+                for key in ("requests", "corpus_size", "gemini_latency", "tokens_per_second", "search_latency", "caches", "seed")
+            },
+            "results": results,
+        }
+
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                json.dump(report, file, indent=2)
+        else:
+            json.dump(report, sys.stdout, indent=2)
+            sys.stdout.write("\n")
+
+        if options["baseline"]:
+            with open(options["baseline"]) as file:
+                regressions = find_regressions(report, json.load(file), options["tolerance"])
+            if regressions:
+                raise CommandError("Performance regression:\n" + "\n".join(regressions))
+            self.stderr.write(self.style.SUCCESS("No regression against the baseline"))
@@ -0,0 +1,84 @@
+import time
+import uuid
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from chatbot.benchmarks.fakes import FakeGenerativeModel, FakeTypesenseServer, generate_corpus
+from chatbot.benchmarks.harness import build_views
+from chatbot.benchmarks.stats import summarize
+from chatbot.services.conversation_store import ConversationStore
+from chatbot.views import ChatAPI
+
+TURNS = [
+    "can you find me ted talk videos about climate change",
+    "only the ones from 2022",
+    "what about ones with more than 100000 views",
+    "can you find me cooking videos instead",
+    "show me podcasts about the same thing",
+    "find me videos about space exploration",
+]
+
+
+# Counts prompt and response tokens of every Gemini call from the usage metadata of the responses
+class RecordingClient:
+    def __init__(self, client):
+        self.client = client
+        self.tokens_in = 0
+        self.tokens_out = 0
+
+    def send_message(self, prompt, session_key=None):
+        response = self.client.send_message(prompt)
+        self.tokens_in += response.usage_metadata.prompt_token_count
+        self.tokens_out += response.usage_metadata.candidates_token_count
+        return response
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare tokens and latency per turn of a multi-turn chat when the client round-trips the summary "
+        "and when the conversation is kept in the server-side conversation store"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--turns", type=int, default=len(TURNS))
+        parser.add_argument("--gemini-latency", type=float, default=0.2, help="Seconds before the first token")
+        parser.add_argument("--tokens-per-second", type=float, default=100, help="Generation speed of the fake model")
+        parser.add_argument("--live", action="store_true", help="Call the configured Gemini model instead of the fake")
+
+    def handle(self, *args, **options):
+        prompts = [TURNS[turn % len(TURNS)] for turn in range(options["turns"])]
+        model = FakeGenerativeModel(latency=options["gemini_latency"], tokens_per_second=options["tokens_per_second"])
+
+        with FakeTypesenseServer(generate_corpus(1000)) as server, override_settings(FAST_PATH_ENABLED=False):
+            view = build_views(model, server.config())[0]
+            gemini_client = ChatAPI.gemini_client if options["live"] else view.gemini_client
+            for mode in ("summary", "conversation"):
+                client = RecordingClient(gemini_client)
+                view.gemini_client = client
+                view.conversation_store = ConversationStore()
+
+                samples = self.run_conversation(view, prompts, mode)
+                stats = summarize(samples)
+                self.stdout.write(
+                    f"{mode:<13} tokens in/turn={client.tokens_in / len(prompts):.0f} "
+                    f"tokens out/turn={client.tokens_out / len(prompts):.0f} "
+                    f"p50={stats['p50_ms']}ms p95={stats['p95_ms']}ms"
+                )
+
+    def run_conversation(self, view, prompts, mode):
+        conversation_id = str(uuid.uuid4())
+        user = SimpleNamespace(pk="benchmark")
+        summary = ""
+        samples = []
+        for prompt in prompts:
+            if mode == "summary":
+                data = {"prompt": prompt, "summary": summary}
+            else:
+                data = {"prompt": prompt, "conversation_id": conversation_id}
+            start = time.perf_counter()
+            response = view.post(SimpleNamespace(data=data, user=user))
+            samples.append(time.perf_counter() - start)
+            summary = response.data.get("summary", "")
+        return samples
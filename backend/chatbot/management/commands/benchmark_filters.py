@@ -0,0 +1,71 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.benchmarks.stats import summarize
+from chatbot.clients.typesense_client import TypesenseClient
+from chatbot.services.video_search import VideoSearchService
+
+# (topic, view_count, release_date_before, release_date_after), broad topics are where ranges hurt the most
+QUERIES = [
+    ("*", "", "2023-12-31", "2023-01-01"),
+    ("*", ">=100000", "2024-06-30", "2021-03-15"),
+    ("climate change", ">1000", "", "2022-01-01"),
+    ("music", "<500", "2020-12-31", ""),
+    ("cooking", "", "2024-10-29", "2024-10-22"),
+    ("*", ">1500000", "", ""),
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare Typesense search latency of the plain range filters against the bucketed facet filters "
+        "(FILTER_FACETS) on the configured collection. The collection has to be indexed with the facet fields."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--collection", default=VideoSearchService.collection)
+        parser.add_argument("--repeat", type=int, default=20, help="Searches per query and filter mode")
+
+    def handle(self, *args, **options):
+        typesense = TypesenseClient()
+        totals = {"ranges": [], "facets": []}
+
+        for topic, view_count, release_date_before, release_date_after in QUERIES:
+            found = {}
+            for mode, use_facets in (("ranges", False), ("facets", True)):
+                filters = VideoSearchService.plan_filter(view_count, release_date_before, release_date_after, use_facets)
+                samples, server_ms = [], []
+                for _ in range(options["repeat"]):
+                    start = time.perf_counter()
+                    response = typesense.search(
+                        options["collection"],
+                        {
+                            "q": topic,
+                            "query_by": "titles, tags, description",
+                            "filter_by": filters,
+                            "sort_by": "view_count:desc",
+                            "per_page": 3,
+                        },
+                    )
+                    samples.append(time.perf_counter() - start)
+                    server_ms.append(response.get("search_time_ms", 0))
+                found[mode] = response["found"]
+                totals[mode].extend(samples)
+                stats = summarize(samples)
+                self.stdout.write(
+                    f"{mode:<7} q={topic!r} views={view_count or '-'} {release_date_after or '-'}..{release_date_before or '-'}: "
+                    f"found={found[mode]} p50={stats['p50_ms']}ms p95={stats['p95_ms']}ms "
+                    f"server={sum(server_ms) / len(server_ms):.1f}ms"
+                )
+
+            # Both plans must select the same documents, otherwise the collection is missing the facet fields
+            if found["ranges"] != found["facets"]:
+                raise CommandError(
+                    f"Filters disagree for {topic!r} ({found['ranges']} vs {found['facets']} documents), "
+                    "reindex with `typesense_reindex --mode full` first"
+                )
+
+        for mode, samples in totals.items():
+            stats = summarize(samples)
+            self.stdout.write(self.style.SUCCESS(f"{mode}: p50={stats['p50_ms']}ms p95={stats['p95_ms']}ms"))
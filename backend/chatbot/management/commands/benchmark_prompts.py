@@ -0,0 +1,47 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chatbot.benchmarks.stats import summarize
+from chatbot.clients.gemini_client import GeminiClient
+from chatbot.services.prompts import Prompts, count_tokens
+
+USER_PROMPT = "can you find me cooking videos that came out last week"
+SUMMARY = "The user is looking for quick dinner recipes and asked for pasta videos before."
+
+
+class Command(BaseCommand):
+    help = (
+        "Show the static and per-request size of each prompt template. With --live, also measure Gemini latency "
+        "and the billed prompt tokens, including the ones served from Gemini's implicit prefix cache."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--live", action="store_true", help="Call Vertex AI (needs GCP credentials)")
+        parser.add_argument("--repeat", type=int, default=5, help="Calls per template")
+
+    def handle(self, *args, **options):
+        for template in Prompts.TEMPLATES:
+            prompt = template.render(USER_PROMPT, SUMMARY)
+            self.stdout.write(
+                f"{template.name:<20} instructions~{count_tokens(template.instructions)} tokens, "
+                f"request~{count_tokens(prompt.request)} tokens"
+            )
+        if not options["live"]:
+            return
+
+        client = GeminiClient()
+        for template in Prompts.TEMPLATES:
+            prompt = template.render(USER_PROMPT, SUMMARY)
+            samples, billed, cached = [], 0, 0
+            for _ in range(options["repeat"]):
+                start = time.perf_counter()
+                response = client.generate_content(prompt)
+                samples.append(time.perf_counter() - start)
+                billed += response.usage_metadata.prompt_token_count
+                cached += getattr(response.usage_metadata, "cached_content_token_count", 0) or 0
+            stats = summarize(samples)
+            self.stdout.write(
+                f"{template.name:<20} p50={stats['p50_ms']}ms p95={stats['p95_ms']}ms "
+                f"prompt_tokens={billed // options['repeat']} cached_tokens={cached // options['repeat']}"
+            )
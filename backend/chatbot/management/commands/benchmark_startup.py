@@ -0,0 +1,54 @@
+import json
+import platform
+import sys
+from datetime import datetime, timezone
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.benchmarks.startup import find_startup_regressions, measure_startup
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the cold start of a worker process: Django setup, URLconf/view imports and optionally the client "
+        "warm-up, each in a fresh interpreter, with a `-X importtime` summary of the slowest packages. Writes JSON "
+        "results and can fail on a regression."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repeat", type=int, default=5, help="Fresh interpreters to start")
+        parser.add_argument("--warm-up", action="store_true", help="Also warm up CLIENT_WARM_UP['CLIENTS'] (needs GCP and Typesense)")
+        parser.add_argument("--top", type=int, default=10, help="Packages listed in the import profile")
+        parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+        parser.add_argument("--baseline", help="JSON results of a previous run to compare against")
+        parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed regression as a fraction (0.1 = 10%%)")
+
+    def handle(self, *args, **options):
+        measured = measure_startup(options["repeat"], warm_up=options["warm_up"], top=options["top"])
+        for result in measured["results"]:
+            self.stderr.write(f"{result['phase']}: p50={result['p50_ms']}ms p95={result['p95_ms']}ms")
+        imports = measured["imports"]
+        self.stderr.write(f"{imports['modules']} modules imported in {imports['import_ms']}ms")
+        for package in imports["packages"]:
+            self.stderr.write(f"  {package['package']}: {package['ms']}ms")
+
+        report = {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "config": {key: options[key] for key in ("repeat", "warm_up")},
+            **measured,
+        }
+
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                json.dump(report, file, indent=2)
+        else:
+            json.dump(report, sys.stdout, indent=2)
+            sys.stdout.write("\n")
+
+        if options["baseline"]:
+            with open(options["baseline"]) as file:
+                regressions = find_startup_regressions(report, json.load(file), options["tolerance"])
+            if regressions:
+                raise CommandError("Startup regression:\n" + "\n".join(regressions))
+            self.stderr.write(self.style.SUCCESS("No regression against the baseline"))
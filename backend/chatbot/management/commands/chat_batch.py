@@ -0,0 +1,59 @@
+import json
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.services.batch_chat import BatchChatProcessor
+from chatbot.views import ChatAPI
+
+
+class Command(BaseCommand):
+    help = "Run a JSONL file of {prompt, summary} items through the chat pipeline and write NDJSON results in input order"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="JSONL file with one {\"prompt\": ..., \"summary\": ...} object per line")
+        parser.add_argument("--output", help="Where to write the results (defaults to stdout)")
+        parser.add_argument("--concurrency", type=int, help="Gemini calls in flight (defaults to BATCH_CHAT['CONCURRENCY'])")
+        parser.add_argument("--window-size", type=int, help="Items per Typesense multi_search (defaults to BATCH_CHAT['WINDOW_SIZE'])")
+
+    def handle(self, *args, **options):
+        items = self.read_items(options["path"])
+        processor = BatchChatProcessor(
+            ChatAPI(), concurrency=options["concurrency"], window_size=options["window_size"]
+        )
+
+        output = open(options["output"], "w") if options["output"] else sys.stdout
+        start = time.perf_counter()
+        failed = 0
+        try:
+            for result in processor.process(items):
+                failed += result["status"] == "error"
+                output.write(json.dumps(result) + "\n")
+                output.flush()
+        finally:
+            if output is not sys.stdout:
+                output.close()
+
+        elapsed = time.perf_counter() - start
+        if failed:
+            self.stderr.write(self.style.WARNING(f"{failed} of {len(items)} items failed"))
+        self.stderr.write(
+            self.style.SUCCESS(f"Processed {len(items)} items in {elapsed:.1f}s ({len(items) / elapsed:.1f} items/s)")
+        )
+
+    # Lines that aren't valid JSON are passed on as-is, so they are reported as a failed item at the right index
+    def read_items(self, path):
+        items = []
+        try:
+            with open(path) as file:
+                for line in file:
+                    if not line.strip():
+                        continue
+                    try:
+                        items.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        items.append(None)
+        except OSError as error:
+            raise CommandError(error)
+        return items
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+
+from chatbot.clients.typesense_client import TypesenseClient
+from chatbot.services.collection_epoch import bump_collection_epoch
+from chatbot.services.embeddings import LocalEmbedder
+from chatbot.services.video_indexer import VideoIndexer
+from chatbot.services.video_search import VideoSearchService
+
+
+class Command(BaseCommand):
+    help = "Stream a JSONL or CSV dataset into the videolists collection through the bulk import endpoint"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Path to a .jsonl or .csv file")
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--workers", type=int, default=4, help="Number of batches imported in parallel")
+        parser.add_argument("--max-retries", type=int, default=3, help="Retries for rows that fail to import")
+        parser.add_argument("--timeout", type=float, default=60, help="Timeout in seconds for each import request")
+        parser.add_argument("--checkpoint", help="Checkpoint file (defaults to <path>.checkpoint)")
+        parser.add_argument("--no-resume", action="store_true", help="Ignore an existing checkpoint and import everything")
+
+    def handle(self, *args, **options):
+        name = VideoSearchService.collection
+        client = TypesenseClient(connection_timeout=options["timeout"]).client
+        indexer = VideoIndexer(
+            client.collections[name],
+            batch_size=options["batch_size"],
+            workers=options["workers"],
+            max_retries=options["max_retries"],
+            checkpoint_path=options["checkpoint"] or f"{options['path']}.checkpoint",
+            failures_path=f"{options['path']}.failed.jsonl",
+            embedder=LocalEmbedder.from_settings(),
+        )
+
+        report = indexer.run(options["path"], resume=not options["no_resume"])
+        bump_collection_epoch(name)
+
+        if report.skipped:
+            self.stdout.write(f"Skipped {report.skipped} documents already imported (checkpoint)")
+        if report.failed:
+            self.stdout.write(
+                self.style.WARNING(f"{report.failed} documents failed, see {options['path']}.failed.jsonl")
+            )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Imported {report.imported} documents in {report.elapsed:.1f}s "
+                f"({report.docs_per_second:.0f} docs/sec)"
+            )
+        )
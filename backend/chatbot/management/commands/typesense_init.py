@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from typesense.exceptions import ObjectNotFound
+
+from chatbot.clients.typesense_client import TypesenseClient
+from chatbot.services.collection_epoch import bump_collection_epoch
+from chatbot.services.video_reindexer import create_versioned_collection, get_alias_target, swap_alias
+from chatbot.services.video_search import VideoSearchService
+
+
+class Command(BaseCommand):
+    help = (
+        "Create a versioned videolists collection in Typesense and point the videolists alias at it. "
+        "Does nothing when the alias (or a plain collection with its name) already exists, unless --drop is passed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--drop", action="store_true", help="Drop the collection the alias currently points at (or a plain collection with the alias name) and start over"
+        )
+
+    def handle(self, *args, **options):
+        client = TypesenseClient().client
+        alias = VideoSearchService.collection
+        # Older setups created a plain collection under the alias name, which would block the alias
+        existing = get_alias_target(client, alias) or (alias if collection_exists(client, alias) else None)
+
+        if existing and not options["drop"]:
+            self.stdout.write(f"Collection {existing} already serves {alias}, nothing to do (pass --drop to recreate it)")
+            return
+
+        if existing:
+            try:
+                client.collections[existing].delete()
+                self.stdout.write(f"Dropped collection {existing}")
+            except ObjectNotFound:
+                pass
+
+        name = create_versioned_collection(client, alias)
+        swap_alias(client, alias, name)
+        if existing:
+            bump_collection_epoch(alias)
+        self.stdout.write(self.style.SUCCESS(f"Created collection {name} with alias {alias}"))
+
+
+def collection_exists(client, name):
+    try:
+        client.collections[name].retrieve()
+        return True
+    except ObjectNotFound:
+        return False
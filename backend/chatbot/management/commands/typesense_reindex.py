@@ -0,0 +1,104 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.clients.typesense_client import TypesenseClient
+from chatbot.services.collection_epoch import bump_collection_epoch
+from chatbot.services.embeddings import LocalEmbedder
+from chatbot.services.video_indexer import VideoIndexer
+from chatbot.services.video_reindexer import (
+    ChangeTracker,
+    create_versioned_collection,
+    delete_documents,
+    get_alias_target,
+    swap_alias,
+)
+from chatbot.services.video_search import VideoSearchService
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-index videolists without a search outage. 'incremental' upserts only documents whose content hash or "
+        "updated_at changed since the last run and deletes the ones no longer in the file. 'full' builds a new "
+        "versioned collection and swaps the alias to it."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Path to a .jsonl or .csv file with the full catalogue")
+        parser.add_argument("--mode", choices=("incremental", "full"), default="incremental")
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--workers", type=int, default=4)
+        parser.add_argument("--max-retries", type=int, default=3)
+        parser.add_argument("--timeout", type=float, default=60)
+        parser.add_argument(
+            "--state-dir",
+            default=str(settings.BASE_DIR / "typesense_state" / VideoSearchService.collection),
+            help="Where the content hash manifest and updated_at watermark are kept",
+        )
+        parser.add_argument("--drop-old", action="store_true", help="Drop the previous collection after a full swap")
+        parser.add_argument(
+            "--keep-missing",
+            action="store_true",
+            help="Don't delete documents that are no longer in the file (incremental mode, e.g. for a partial file)",
+        )
+
+    def handle(self, *args, **options):
+        alias = VideoSearchService.collection
+        client = TypesenseClient(connection_timeout=options["timeout"]).client
+        live_collection = get_alias_target(client, alias)
+
+        if options["mode"] == "incremental" and live_collection is None:
+            raise CommandError(f"Alias {alias} doesn't exist yet, run a full re-index first")
+
+        full = options["mode"] == "full"
+        target = create_versioned_collection(client, alias) if full else live_collection
+        self.stdout.write(f"Indexing into {target}")
+
+        with ChangeTracker(options["state_dir"], rebuild=full) as tracker:
+            indexer = VideoIndexer(
+                client.collections[target],
+                batch_size=options["batch_size"],
+                workers=options["workers"],
+                max_retries=options["max_retries"],
+                failures_path=f"{options['path']}.failed.jsonl",
+                action="create" if full else "upsert",
+                embedder=LocalEmbedder.from_settings(),
+            )
+            report = indexer.run(options["path"], select=tracker.filter_changed)
+
+            if full and report.failed:
+                client.collections[target].delete()
+                raise CommandError(
+                    f"{report.failed} documents failed, kept {alias} on {live_collection} and dropped {target}"
+                )
+
+            deleted_ids = []
+            if full:
+                # The new manifest only describes the new collection, it's kept once the alias points at it
+                swap_alias(client, alias, target)
+                self.stdout.write(f"Alias {alias} now points at {target}")
+            elif report.unreadable:
+                self.stdout.write(
+                    self.style.WARNING(f"{report.unreadable} lines could not be read, no documents were deleted")
+                )
+            elif not options["keep_missing"]:
+                deleted_ids = list(tracker.missing_ids())
+                delete_documents(client.collections[target], deleted_ids)
+                self.stdout.write(f"Deleted {len(deleted_ids)} documents no longer in {options['path']}")
+            tracker.commit(report.failed_ids, deleted_ids)
+
+        if full and options["drop_old"] and live_collection:
+            client.collections[live_collection].delete()
+            self.stdout.write(f"Dropped {live_collection}")
+
+        bump_collection_epoch(alias)
+
+        if report.failed:
+            self.stdout.write(
+                self.style.WARNING(f"{report.failed} documents failed, they will be retried on the next run")
+            )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Indexed {report.imported} changed documents in {report.elapsed:.1f}s "
+                f"({report.docs_per_second:.0f} docs/sec)"
+            )
+        )
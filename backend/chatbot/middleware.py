@@ -0,0 +1,36 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from chatbot.utils.metrics import finish_request, start_request
+
+
+# Collects per-stage timings for every request, adds them as a Server-Timing header and counts the request.
+# Works for both the WSGI and ASGI stacks.
+class ServerTimingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.call_async(request)
+        timings = start_request()
+        response = self.get_response(request)
+        return self.finish(request, response, timings)
+
+    async def call_async(self, request):
+        timings = start_request()
+        response = await self.get_response(request)
+        return self.finish(request, response, timings)
+
+    def finish(self, request, response, timings):
+        if timings.stages:
+            response["Server-Timing"] = timings.server_timing_header()
+        # Label by route name rather than raw path to keep the number of series bounded
+        match = getattr(request, "resolver_match", None)
+        finish_request(timings, match.url_name if match else "unmatched", response.status_code)
+        return response
@@ -0,0 +1,131 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from chatbot.clients.admission import AdmissionRejected, current_ticket
+from chatbot.clients.transport import TransportUnavailable
+from chatbot.clients.typesense_client import TypesenseSearchError
+from chatbot.services.search_collections import is_search_intent
+from chatbot.utils.batching import batched
+from chatbot.utils.metrics import registry
+from chatbot.utils.response_parser import ResponseFormatError
+
+logger = logging.getLogger(__name__)
+
+batch_items = registry.counter(
+    "chatbot_batch_items_total", "Prompts processed by the batch chat endpoint", labels=("status",)
+)
+
+GENERATION_ERROR = "There was an error in generating a response"
+UNAVAILABLE_ERROR = "The service is temporarily unavailable, please try again shortly"
+TOO_MANY_REQUESTS_ERROR = "Too many requests, please try again shortly"
+
+
+class BatchItemError(Exception):
+    pass
+
+
+# Runs many {prompt, summary} items through the same steps as ChatAPI (fast path, Gemini, query options) with at
+# most CONCURRENCY Gemini calls in flight. Items are handled in windows: the video searches of a window go to
+# Typesense as one multi_search, and its results are yielded in input order while the next window is generating.
+# Every item yields exactly one result, failures are reported on the item instead of failing the whole batch.
+class BatchChatProcessor:
+    def __init__(self, chat, concurrency=None, window_size=None):
+        config = settings.BATCH_CHAT
+        self.chat = chat
+        self.concurrency = concurrency or config["CONCURRENCY"]
+        self.window_size = window_size or config["WINDOW_SIZE"]
+
+    def process(self, items):
+        ticket = current_ticket.get()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            previous = None
+            for window in batched(enumerate(items), self.window_size):
+                submitted = [(index, executor.submit(self.analyze_for, ticket, item)) for index, item in window]
+                if previous:
+                    yield from self.complete(previous)
+                previous = submitted
+            if previous:
+                yield from self.complete(previous)
+
+    # Pool threads don't inherit the request's context. Each item's Gemini calls are admitted for the caller
+    # (their rate limit and tier).
+    def analyze_for(self, ticket, item):
+        current_ticket.set(ticket)
+        return self.analyze(item)
+
+    # Everything up to (but not including) the video search for one item
+    def analyze(self, item):
+        if not isinstance(item, dict) or not isinstance(item.get("prompt"), str) or not item["prompt"]:
+            raise BatchItemError("No prompt provided")
+        user_prompt = item["prompt"]
+        chat_summary = item.get("summary") or ""
+
+        formatted_response = self.chat.classify_locally(user_prompt, chat_summary)
+        if formatted_response is None:
+            prompt = self.chat.create_prompt(user_prompt, chat_summary)
+            gemini_response = self.chat.send_prompt(prompt, user_prompt, chat_summary)
+            if not gemini_response:
+                raise BatchItemError(GENERATION_ERROR)
+            formatted_response = self.chat.parse_response.convert_to_python_object(gemini_response)
+
+        response_data = self.chat.create_response_data(formatted_response)
+        search = None
+        intent = formatted_response.get("intent", "")
+        if is_search_intent(intent):
+            search = intent, formatted_response.get("query_options") or self.chat.get_typesense_query_options(
+                response_data["summary"], user_prompt
+            )
+        return response_data, search
+
+    def complete(self, window):
+        results = {}
+        searches = []
+        for index, future in window:
+            try:
+                results[index] = future.result()
+            except Exception as error:
+                results[index] = self.describe_error(index, error)
+                continue
+            if results[index][1] is not None:
+                searches.append(index)
+
+        if searches:
+            try:
+                video_results = self.chat.video_search_service.find_related_results_batch(
+                    [results[index][1] for index in searches]
+                )
+            except Exception as error:
+                video_results = [error] * len(searches)
+            for index, videos in zip(searches, video_results):
+                if isinstance(videos, Exception):
+                    results[index] = self.describe_error(index, videos)
+                    continue
+                self.chat.add_video_results(results[index][0], videos)
+
+        for index, _ in window:
+            result = results[index]
+            if isinstance(result, dict):
+                batch_items.inc(status="error")
+                yield result
+            else:
+                batch_items.inc(status="ok")
+                yield {"index": index, "status": "ok", **result[0]}
+
+    @staticmethod
+    def describe_error(index, error):
+        if isinstance(error, BatchItemError):
+            message = str(error)
+        elif isinstance(error, ResponseFormatError):
+            message = GENERATION_ERROR
+        elif isinstance(error, TypesenseSearchError):
+            message = f"The video search failed: {error}"
+        elif isinstance(error, AdmissionRejected):
+            message = TOO_MANY_REQUESTS_ERROR
+        elif isinstance(error, TransportUnavailable):
+            message = UNAVAILABLE_ERROR
+        else:
+            logger.exception("Batch item %s failed", index, exc_info=error)
+            message = GENERATION_ERROR
+        return {"index": index, "status": "error", "error": message}
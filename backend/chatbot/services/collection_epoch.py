@@ -0,0 +1,28 @@
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from chatbot.utils.ttl_cache import TTLCache
+
+# Epochs this process read recently, so a search doesn't cost a round trip to the shared cache per collection
+recent_epochs = TTLCache(max_entries=1000)
+
+
+# Every (re-)index of a Typesense collection bumps its epoch. Search caches include the epoch in their keys,
+# so results from before the re-index are never served again. Stored in the COLLECTION_EPOCH cache, which has to
+# be shared so the workers see the bumps made by the management commands.
+def get_collection_epoch(collection):
+    epoch = recent_epochs.get(collection)
+    if epoch is None:
+        config = settings.COLLECTION_EPOCH
+        epoch = caches[config["CACHE_ALIAS"]].get(f"typesense-epoch:{collection}", 0)
+        recent_epochs.set(collection, epoch, ttl=config["REFRESH_SECONDS"])
+    return epoch
+
+
+def bump_collection_epoch(collection):
+    epoch = time.time_ns()
+    caches[settings.COLLECTION_EPOCH["CACHE_ALIAS"]].set(f"typesense-epoch:{collection}", epoch, timeout=None)
+    recent_epochs.delete(collection)
+    return epoch
@@ -0,0 +1,71 @@
+from django.conf import settings
+from django.core.cache import caches
+
+ENTITY_FIELDS = ("topic", "title", "view_count", "release_date_before", "release_date_after")
+
+
+# Compact state of one conversation: the last few user requests (with their intent) and the search entities of
+# the latest video search. This replaces the free-text summary clients used to send back on every turn, so
+# Gemini no longer has to rewrite that summary and each prompt only carries the new request plus this state.
+class Conversation:
+    def __init__(self, key, conversation_id, turns=None, entities=None):
+        self.key = key
+        self.id = conversation_id
+        self.turns = turns or []
+        self.entities = entities or {}
+
+    def add_turn(self, user_prompt, intent, query_options, max_turns, max_prompt_chars):
+        self.turns = (self.turns + [[user_prompt[:max_prompt_chars], intent]])[-max_turns:]
+        if query_options:
+            self.entities = {field: query_options[field] for field in ENTITY_FIELDS if query_options.get(field)}
+
+    def context(self):
+        if not self.turns:
+            return ""
+        requests = "; ".join(f"'{prompt}' ({intent})" for prompt, intent in self.turns)
+        context = f"Previous requests: {requests}"
+        if self.entities:
+            entities = ", ".join(f"{field}={value}" for field, value in self.entities.items())
+            context += f". Last video search: {entities}"
+        return context
+
+    def to_dict(self):
+        return {"turns": self.turns, "entities": self.entities}
+
+
+# Conversations live in a Django cache (CACHE_ALIAS, e.g. Redis in production so every worker sees them) and expire
+# TTL_SECONDS after their last turn. Keys include the user, so a conversation id can't be read by anyone else.
+class ConversationStore:
+    def __init__(self, cache_alias="default", ttl=86400, max_turns=5, max_prompt_chars=200):
+        self.cache_alias = cache_alias
+        self.ttl = ttl
+        self.max_turns = max_turns
+        self.max_prompt_chars = max_prompt_chars
+
+    @classmethod
+    def from_settings(cls):
+        config = settings.CONVERSATION_STORE
+        if not config["ENABLED"]:
+            return None
+        return cls(
+            cache_alias=config["CACHE_ALIAS"],
+            ttl=config["TTL_SECONDS"],
+            max_turns=config["MAX_TURNS"],
+            max_prompt_chars=config["MAX_PROMPT_CHARS"],
+        )
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def load(self, user_id, conversation_id):
+        key = f"conversation:{user_id}:{conversation_id}"
+        state = self.cache.get(key) or {}
+        return Conversation(key, conversation_id, state.get("turns"), state.get("entities"))
+
+    def add_turn(self, conversation, user_prompt, intent, query_options):
+        conversation.add_turn(user_prompt, intent, query_options, self.max_turns, self.max_prompt_chars)
+        self.cache.set(conversation.key, conversation.to_dict(), timeout=self.ttl)
+
+    def delete(self, conversation):
+        self.cache.delete(conversation.key)
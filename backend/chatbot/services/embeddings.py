@@ -0,0 +1,93 @@
+import re
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from chatbot.utils.metrics import registry, stage
+from chatbot.utils.ttl_cache import TTLCache
+
+query_embeddings = registry.counter(
+    "chatbot_query_embeddings_total",
+    "Query embeddings served from the LRU (hit) or computed by the local model (miss)",
+    labels=("result",),
+)
+
+
+def normalize_query(text):
+    return re.sub(r"\s+", " ", text.strip().lower())
+
+
+# The text a document is embedded from at index time
+def document_text(document):
+    return " ".join(
+        [*(document.get("titles") or []), *(document.get("tags") or []), document.get("description") or ""]
+    ).strip()
+
+
+# Local sentence embedding model for hybrid search (sentence-transformers, small enough to run on CPU).
+# Documents are embedded at index time, and query embeddings are kept in an LRU so popular topics never
+# reach the model again. The model is only loaded on first use, so workers that never embed don't pay for it.
+class LocalEmbedder:
+    def __init__(self, model_name, batch_size=64, query_cache_size=10000, query_cache_ttl=86400):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.model = None
+        self.lock = threading.Lock()
+        self.query_cache = TTLCache(max_entries=query_cache_size, ttl=query_cache_ttl)
+
+    @classmethod
+    def from_settings(cls):
+        config = settings.VECTOR_SEARCH
+        if not config["ENABLED"]:
+            return None
+        return cls(
+            config["MODEL"],
+            batch_size=config["BATCH_SIZE"],
+            query_cache_size=config["QUERY_CACHE_SIZE"],
+            query_cache_ttl=config["QUERY_CACHE_TTL_SECONDS"],
+        )
+
+    def get_model(self):
+        if self.model is None:
+            with self.lock:
+                if self.model is None:
+                    try:
+                        from sentence_transformers import SentenceTransformer
+                    except ImportError as exc:
+                        raise ImproperlyConfigured(
+                            "VECTOR_SEARCH is enabled but sentence-transformers isn't installed"
+                        ) from exc
+                    self.model = SentenceTransformer(self.model_name, device="cpu")
+        return self.model
+
+    def encode(self, texts):
+        vectors = self.get_model().encode(
+            texts, batch_size=self.batch_size, normalize_embeddings=True, convert_to_numpy=True
+        )
+        # Six decimals keep the vector_query (and the import payload) small without changing the ranking
+        return [[round(float(value), 6) for value in vector] for vector in vectors]
+
+    def cached_query(self, text):
+        return self.query_cache.get(normalize_query(text))
+
+    def embed_query(self, text):
+        key = normalize_query(text)
+        vector = self.query_cache.get(key)
+        if vector is not None:
+            query_embeddings.inc(result="hit")
+            return vector
+
+        query_embeddings.inc(result="miss")
+        with stage("query_embedding"):
+            vector = self.encode([key])[0]
+        self.query_cache.set(key, vector)
+        return vector
+
+    # Fills the "embedding" field of documents that don't already have one
+    def add_embeddings(self, documents):
+        missing = [document for document in documents if "embedding" not in document]
+        if not missing:
+            return
+        for document, vector in zip(missing, self.encode([document_text(document) for document in missing])):
+            document["embedding"] = vector
@@ -0,0 +1,127 @@
+import bisect
+from datetime import datetime, timezone
+
+from django.conf import settings
+
+# Low-cardinality copies of released_date and view_count, filled at index time. Filters on them are equality
+# matches on a handful of values instead of open-ended numeric ranges over the whole collection.
+FACET_FIELDS = [
+    {"name": "release_year", "type": "int32", "optional": True},
+    {"name": "release_month", "type": "int32", "optional": True},
+    {"name": "view_tier", "type": "int32", "optional": True},
+]
+
+# Above this many values a bucket filter is written as a (still low-cardinality) range
+MAX_BUCKET_VALUES = 12
+
+
+def month_index(timestamp):
+    date = datetime.fromtimestamp(timestamp, timezone.utc)
+    return date.year * 12 + date.month - 1
+
+
+def month_start(index):
+    return int(datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc).timestamp())
+
+
+# release_month is YYYYMM so a month can be matched without pairing it with its year
+def month_value(index):
+    return (index // 12) * 100 + index % 12 + 1
+
+
+# View tier 0 is below the first bound, tier n is from the n-th bound up to the next one
+def view_tier(view_count):
+    return bisect.bisect_right(settings.FILTER_FACETS["VIEW_TIER_BOUNDS"], view_count)
+
+
+def tier_start(tier):
+    return settings.FILTER_FACETS["VIEW_TIER_BOUNDS"][tier - 1] if tier else 0
+
+
+def add_facets(document):
+    if isinstance(document.get("released_date"), int):
+        index = month_index(document["released_date"])
+        document["release_year"] = index // 12
+        document["release_month"] = month_value(index)
+    if isinstance(document.get("view_count"), int):
+        document["view_tier"] = view_tier(document["view_count"])
+    return document
+
+
+def equals_any(field, values):
+    values = list(values)
+    if len(values) > MAX_BUCKET_VALUES:
+        return f"{field}:[{values[0]}..{values[-1]}]"
+    return f"{field}:[{','.join(str(value) for value in values)}]"
+
+
+def any_of(clauses):
+    return clauses[0] if len(clauses) == 1 else "(" + " || ".join(clauses) + ")"
+
+
+# Filter on released_date in [start, end) (unix seconds, None for an open side). Whole years become release_year
+# matches, whole months around them release_month matches, and released_date ranges are only kept for the
+# partial months at the edges.
+def plan_release_date_filter(start, end):
+    if start is None and end is None:
+        return ""
+
+    first_month = None
+    if start is not None:
+        first_month = month_index(start)
+        if month_start(first_month) < start:
+            first_month += 1
+    last_month = month_index(end) if end is not None else None
+    if first_month is not None and last_month is not None and first_month >= last_month:
+        return f"released_date:>={start} && released_date:<{end}"
+
+    clauses = []
+    if start is not None and start < month_start(first_month):
+        clauses.append(f"released_date:[{start}..{month_start(first_month) - 1}]")
+
+    first_year = -(-first_month // 12) if first_month is not None else None
+    last_year = last_month // 12 if last_month is not None else None
+    if first_year is not None and last_year is not None and first_year >= last_year:
+        clauses.append(equals_any("release_month", map(month_value, range(first_month, last_month))))
+    else:
+        if first_month is not None and first_month < first_year * 12:
+            clauses.append(equals_any("release_month", map(month_value, range(first_month, first_year * 12))))
+        if first_year is None:
+            clauses.append(f"release_year:<{last_year}")
+        elif last_year is None:
+            clauses.append(f"release_year:>={first_year}")
+        else:
+            clauses.append(equals_any("release_year", range(first_year, last_year)))
+        if last_month is not None and last_year * 12 < last_month:
+            clauses.append(equals_any("release_month", map(month_value, range(last_year * 12, last_month))))
+
+    if end is not None and month_start(last_month) < end:
+        clauses.append(f"released_date:[{month_start(last_month)}..{end - 1}]")
+    return any_of(clauses)
+
+
+# Same for a view count comparison ('>1000', '<=500'). An exact count stays an equality on view_count.
+def plan_view_count_filter(view_count):
+    operator = view_count.rstrip("0123456789")
+    value = int(view_count[len(operator):])
+    if not operator:
+        return f"view_count:{value}"
+
+    tiers = len(settings.FILTER_FACETS["VIEW_TIER_BOUNDS"]) + 1
+    if operator.startswith(">"):
+        start = value + 1 if operator == ">" else value
+        first_tier = view_tier(start - 1) + 1 if start else 0
+        if first_tier == tiers:
+            return f"view_count:>={start}"
+        clauses = [equals_any("view_tier", range(first_tier, tiers))]
+        if start < tier_start(first_tier):
+            clauses.insert(0, f"view_count:[{start}..{tier_start(first_tier) - 1}]")
+    else:
+        end = value + 1 if operator == "<=" else value
+        last_tier = view_tier(end)
+        clauses = [equals_any("view_tier", range(last_tier))] if last_tier else []
+        if tier_start(last_tier) < end:
+            clauses.append(f"view_count:[{tier_start(last_tier)}..{end - 1}]")
+        if not clauses:
+            return "view_count:<0"
+    return any_of(clauses)
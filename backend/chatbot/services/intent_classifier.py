@@ -0,0 +1,280 @@
+import calendar
+import re
+from datetime import date, timedelta
+
+from django.utils import timezone
+
+from chatbot.utils.metrics import registry, stage_duration
+
+fast_path_requests = registry.counter(
+    "chatbot_fast_path_requests_total",
+    "Requests answered by the rule-based fast path (hit) or sent to Gemini (fallback)",
+    labels=("result",),
+)
+fast_path_latency_saved = registry.counter(
+    "chatbot_fast_path_latency_saved_seconds_total",
+    "Estimated Gemini latency saved by the fast path, using the average duration of the gemini_initial stage",
+)
+
+MONTHS = {name.lower(): number for number, name in enumerate(calendar.month_name) if name}
+MONTHS.update({name.lower(): number for number, name in enumerate(calendar.month_abbr) if name})
+NUMBER_WORDS = {
+    "a": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5,
+    "six": 6, "seven": 7, "eight": 8, "nine": 9, "ten": 10,
+}
+MULTIPLIERS = {"k": 1_000, "thousand": 1_000, "m": 1_000_000, "million": 1_000_000, "b": 1_000_000_000, "billion": 1_000_000_000}
+
+# Only explicit searches take the fast path: a search verb followed, within a few words, by a video noun
+SEARCH_PATTERN = re.compile(
+    r"\b(?:find|show|search|look(?:ing)?\s+for)\b(?:\W+[\w'-]+){0,6}?\W+(?:videos?|clips?|talks?|vids?)\b",
+    re.IGNORECASE,
+)
+PODCAST_PATTERN = re.compile(r"\bpodcasts?\b", re.IGNORECASE)
+QUESTION_PATTERN = re.compile(
+    r"^(who|what|why|how|when|where|which|is|are|do|does|did|tell|explain|write|summari[sz]e)\b", re.IGNORECASE
+)
+EXACT_TITLE_PATTERN = re.compile(
+    r"\b(?:find|show|get)(?: me)? (?:this |the |a )?video(?: called| titled| named)?:? ?[\"'“‘](?P<title>.+)[\"'”’]\s*\??$",
+    re.IGNORECASE,
+)
+# References to earlier turns only make sense with the summary, which the rules can't interpret
+FOLLOW_UP_PATTERN = re.compile(
+    r"\b(more|those|them|these|that one|another|again|similar|same|instead|else|also)\b", re.IGNORECASE
+)
+# Requests with exclusions or several conditions are left to the model
+COMPLEX_PATTERN = re.compile(r"\b(not|without|except|but|or|between|unless)\b", re.IGNORECASE)
+# "I don't want to watch videos", "I can't play videos"
+NEGATION_PATTERN = re.compile(r"\b(?:not|no|never|cannot|\w+n['’]t|dont|cant|wont|doesnt|didnt|isnt)\b", re.IGNORECASE)
+# Making or fixing a video, or asking for help with one, isn't a search
+ACTION_PATTERN = re.compile(
+    r"\b(?:create|make|making|edit|editing|editor|record|recording|film|shoot|upload|download|convert|render|play|"
+    r"playing|stream|help|fix|problem|issue|error|broken|feedback|advice)\b",
+    re.IGNORECASE,
+)
+# Nouns where "video" is part of something else ("video games", "video call")
+COMPOUND_PATTERN = re.compile(r"\bvideo\s+(?:games?|gaming|calls?|chat|cameras?|cards?|players?)\b", re.IGNORECASE)
+# Conditions the search parameters can't express (duration, ranking) must not end up in the topic
+UNSUPPORTED_WORDS = {
+    "than", "longer", "shorter", "long", "short", "hour", "hours", "minute", "minutes", "second", "seconds",
+    "duration", "length", "most", "least", "top",
+}
+# Words that show up in anything that can end in a search; used to decide whether a speculative query options
+# call is worth making before the intent is known
+SEARCH_HINT_PATTERN = re.compile(
+    r"\b(?:find|show|search|look(?:ing)?|recommend|suggest|watch|videos?|clips?|talks?|vids?|podcasts?|episodes?)\b",
+    re.IGNORECASE,
+)
+# Requests to do something with a video (summarise it, translate it...) rather than find one
+TASK_PATTERN = re.compile(
+    r"\b(summary|summari[sz]e|transcripts?|transcribe|translate|translation|explain|review|lyrics|meaning)\b",
+    re.IGNORECASE,
+)
+
+NUMBER = r"(?P<number>\d[\d,]*(?:\.\d+)?)\s*(?:(?P<multiplier>k|m|b|thousand|million|billion)\b)?"
+# "views" has to be said, "under 5 minutes" is about duration
+VIEW_COUNT_PATTERNS = (
+    (re.compile(rf"\b(?:more than|over|above|greater than)\s+{NUMBER}\s+views?\b", re.IGNORECASE), ">"),
+    (re.compile(rf"\b(?:at least|minimum of)\s+{NUMBER}\s+views?\b", re.IGNORECASE), ">="),
+    (re.compile(rf"\b(?:less than|under|fewer than|below)\s+{NUMBER}\s+views?\b", re.IGNORECASE), "<"),
+    (re.compile(rf"\b(?:at most|maximum of)\s+{NUMBER}\s+views?\b", re.IGNORECASE), "<="),
+    (re.compile(rf"\b{NUMBER}\s*\+\s*views?", re.IGNORECASE), ">="),
+    (re.compile(rf"\b{NUMBER}\s+views?", re.IGNORECASE), ""),
+)
+
+RELATIVE_AMOUNT = r"(?P<amount>\d+|a|one|two|three|four|five|six|seven|eight|nine|ten)"
+FILLER_WORDS = {
+    "can", "could", "would", "you", "please", "me", "i", "some", "a", "an", "the", "of", "about", "on", "with",
+    "related", "to", "for", "find", "show", "search", "get", "give", "recommend", "looking", "look", "want",
+    "watch", "need", "any", "videos", "video", "clips", "clip", "vids", "vid", "that", "which", "were", "was",
+    "are", "is", "came", "come", "out", "released", "release", "uploaded", "published", "from", "in", "have",
+    "has", "views", "view", "there", "what", "like", "us", "my", "and",
+}
+
+
+# Cheap check run before Gemini: False means the request almost certainly won't be a search. Follow-ups
+# ("more like those") are only searches if there is a conversation to follow up on.
+def may_be_search(user_prompt, chat_summary=""):
+    if SEARCH_HINT_PATTERN.search(user_prompt):
+        return True
+    return bool(chat_summary) and bool(FOLLOW_UP_PATTERN.search(user_prompt))
+
+
+def to_iso(day):
+    return day.strftime("%Y-%m-%d")
+
+
+def year_range(year):
+    return {"release_date_after": f"{year}-01-01", "release_date_before": f"{year}-12-31"}
+
+
+def month_range(year, month):
+    last_day = calendar.monthrange(year, month)[1]
+    return {
+        "release_date_after": to_iso(date(year, month, 1)),
+        "release_date_before": to_iso(date(year, month, last_day)),
+    }
+
+
+# Local pre-classifier for simple, self-contained searches such as "find me videos from 2023", "show me cooking
+# videos with more than 1000 views" or "find me this video 'X'". It produces the same structure as the combined
+# Gemini prompt (intent, summary, response, query_options). Anything that isn't an explicit search for a plain
+# topic (negations, making or fixing a video, duration or ranking conditions...) returns None and goes to Gemini.
+class IntentClassifier:
+    def classify(self, user_prompt, chat_summary="", today=None):
+        today = today or timezone.now().date()
+        prompt = " ".join(user_prompt.split())
+
+        # Follow-ups depend on the conversation, which only the model can interpret
+        if chat_summary and FOLLOW_UP_PATTERN.search(prompt):
+            return self.fallback()
+
+        title_match = EXACT_TITLE_PATTERN.search(prompt)
+        if title_match:
+            title = title_match.group("title").strip()
+            return self.hit(
+                "find video",
+                self.summarize(chat_summary, f"The user is looking for the video '{title}'."),
+                "Here is the video you are looking for.",
+                {"topic": "", "title": title, "view_count": "", "release_date_before": "", "release_date_after": ""},
+            )
+
+        if not SEARCH_PATTERN.search(prompt) or QUESTION_PATTERN.search(prompt):
+            return self.fallback()
+        for pattern in (NEGATION_PATTERN, ACTION_PATTERN, COMPOUND_PATTERN, COMPLEX_PATTERN, PODCAST_PATTERN, TASK_PATTERN):
+            if pattern.search(prompt):
+                return self.fallback()
+
+        remaining = prompt
+        view_count, remaining = self.extract_view_count(remaining)
+        dates, remaining = self.extract_dates(remaining, today)
+        if dates is None:
+            return self.fallback()
+        topic = self.extract_topic(remaining)
+
+        if topic is None or not (topic or view_count or dates):
+            return self.fallback()
+
+        query_options = {
+            "topic": topic,
+            "title": "",
+            "view_count": view_count,
+            "release_date_before": dates.get("release_date_before", ""),
+            "release_date_after": dates.get("release_date_after", ""),
+        }
+        return self.hit(
+            "find video",
+            self.summarize(chat_summary, f"The user is looking for {topic + ' ' if topic else ''}videos: {prompt}"),
+            "Here are some videos I found.",
+            query_options,
+        )
+
+    # The caller's summary is kept and the new request added to it, like Gemini does
+    @staticmethod
+    def summarize(chat_summary, request):
+        return f"{chat_summary} {request}" if chat_summary else request
+
+    def hit(self, intent, summary, response, query_options):
+        fast_path_requests.inc(result="hit")
+        fast_path_latency_saved.inc(stage_duration.average(stage="gemini_initial"))
+        return {"intent": intent, "summary": summary, "response": response, "query_options": query_options}
+
+    def fallback(self):
+        fast_path_requests.inc(result="fallback")
+        return None
+
+    def extract_view_count(self, prompt):
+        for pattern, operator in VIEW_COUNT_PATTERNS:
+            match = pattern.search(prompt)
+            if match:
+                number = float(match.group("number").replace(",", ""))
+                number *= MULTIPLIERS.get((match.group("multiplier") or "").lower(), 1)
+                return f"{operator}{int(number)}", prompt[:match.start()] + " " + prompt[match.end():]
+        return "", prompt
+
+    # Returns ({} if no date is mentioned, None if a date-like phrase couldn't be understood) and the rest
+    # of the prompt. All ranges are inclusive, matching the examples given to Gemini in Prompts.
+    def extract_dates(self, prompt, today):
+        parsers = (
+            (r"\b(?:on\s+)?(?P<month>[a-z]+)\.?\s+(?P<day>\d{1,2})(?:st|nd|rd|th)?,?\s+(?P<year>\d{4})\b", self.parse_full_date),
+            (r"\b(?:on\s+)?(?P<iso>\d{4}-\d{2}-\d{2})\b", self.parse_iso_date),
+            (r"\b(?:in\s+|from\s+)?(?P<month>[a-z]+)\s+(?P<year>\d{4})\b", self.parse_month),
+            (r"\bbefore\s+(?P<year>\d{4})\b", lambda match, today: {"release_date_before": f"{int(match['year']) - 1}-12-31"}),
+            (r"\b(?:after)\s+(?P<year>\d{4})\b", lambda match, today: {"release_date_after": f"{int(match['year']) + 1}-01-01"}),
+            (r"\bsince\s+(?P<year>\d{4})\b", lambda match, today: {"release_date_after": f"{match['year']}-01-01"}),
+            # A bare year is usually part of the topic ("the 2008 financial crisis"), it's left in the topic and
+            # the digits send the request to Gemini
+            (r"\b(?:in|from|released(?:\s+in)?|came\s+out(?:\s+in)?)\s+(?P<year>(?:19|20)\d{2})\b", lambda match, today: year_range(int(match["year"]))),
+            (r"\btoday\b", lambda match, today: {"release_date_after": to_iso(today), "release_date_before": to_iso(today)}),
+            (r"\byesterday\b", lambda match, today: {"release_date_after": to_iso(today - timedelta(days=1)), "release_date_before": to_iso(today - timedelta(days=1))}),
+            (r"\b(?:this|the current)\s+week\b", lambda match, today: {"release_date_after": to_iso(today - timedelta(days=today.weekday())), "release_date_before": to_iso(today)}),
+            (r"\b(?:last|past|previous)\s+week\b", lambda match, today: {"release_date_after": to_iso(today - timedelta(days=7)), "release_date_before": to_iso(today)}),
+            (r"\b(?:this|the current)\s+month\b", lambda match, today: month_range(today.year, today.month)),
+            (r"\b(?:last|previous)\s+month\b", lambda match, today: month_range(*(today.replace(day=1) - timedelta(days=1)).timetuple()[:2])),
+            (r"\b(?:this|the current)\s+year\b", lambda match, today: year_range(today.year)),
+            (r"\b(?:last|previous)\s+year\b", lambda match, today: year_range(today.year - 1)),
+            (rf"\b(?:in\s+the\s+)?(?:last|past)\s+{RELATIVE_AMOUNT}\s+(?P<unit>day|week|month|year)s?\b", self.parse_last_period),
+            (rf"\b{RELATIVE_AMOUNT}\s+(?P<unit>day|week|month|year)s?\s+ago\b", self.parse_ago),
+        )
+        for pattern, parse in parsers:
+            for match in re.finditer(pattern, prompt, re.IGNORECASE):
+                dates = parse(match, today)
+                if dates is not None:
+                    return dates, prompt[:match.start()] + " " + prompt[match.end():]
+
+        if re.search(r"\b(ago|recent|recently|latest|newest|new|old|oldest|week|month|year|decade)\b", prompt, re.IGNORECASE):
+            return None, prompt
+        return {}, prompt
+
+    def parse_full_date(self, match, today):
+        month = MONTHS.get(match["month"].lower())
+        if not month:
+            return None
+        try:
+            day = date(int(match["year"]), month, int(match["day"]))
+        except ValueError:
+            return None
+        return {"release_date_after": to_iso(day), "release_date_before": to_iso(day)}
+
+    def parse_iso_date(self, match, today):
+        try:
+            day = date.fromisoformat(match["iso"])
+        except ValueError:
+            return None
+        return {"release_date_after": to_iso(day), "release_date_before": to_iso(day)}
+
+    def parse_month(self, match, today):
+        month = MONTHS.get(match["month"].lower())
+        return month_range(int(match["year"]), month) if month else None
+
+    def parse_last_period(self, match, today):
+        return {"release_date_after": to_iso(self.shift(today, match)), "release_date_before": to_iso(today)}
+
+    def parse_ago(self, match, today):
+        day = self.shift(today, match)
+        if match["unit"].lower() == "year":
+            return year_range(day.year)
+        if match["unit"].lower() == "month":
+            return month_range(day.year, day.month)
+        return {"release_date_after": to_iso(day), "release_date_before": to_iso(day)}
+
+    def shift(self, today, match):
+        amount = match["amount"].lower()
+        amount = int(amount) if amount.isdigit() else NUMBER_WORDS[amount]
+        unit = match["unit"].lower()
+        if unit == "day":
+            return today - timedelta(days=amount)
+        if unit == "week":
+            return today - timedelta(weeks=amount)
+        months = today.year * 12 + today.month - 1 - (amount if unit == "month" else amount * 12)
+        year, month = divmod(months, 12)
+        return date(year, month + 1, min(today.day, calendar.monthrange(year, month + 1)[1]))
+
+    # What is left once the request phrasing, dates and view counts are removed is the topic. Leftover
+    # digits, or words about duration or ranking, mean part of the request wasn't understood, so the model handles it.
+    def extract_topic(self, remaining):
+        words = re.findall(r"[\w'&+#.-]+", remaining.lower())
+        topic = [word.strip(".") for word in words if word.strip(".") not in FILLER_WORDS]
+        topic = [word for word in topic if word]
+        if any(word.isdigit() or word in UNSUPPORTED_WORDS for word in topic):
+            return None
+        return " ".join(topic)
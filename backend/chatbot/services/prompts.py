@@ -1,45 +1,194 @@
+from datetime import date, timedelta
+
+from django.conf import settings
+
+
+# Rough estimate (about 4 characters per token), like the session pool's history budget
+def count_tokens(text):
+    return len(text) // 4
+
+
+# Cuts text to about max_tokens, on a word boundary
+def truncate_to_tokens(text, max_tokens):
+    if count_tokens(text) <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+    return text[:max_tokens * 4 - 3].rsplit(" ", 1)[0] + "..."
+
+
+# Relative date examples built from the day the prompt is rendered, so they don't go stale like hard-coded dates
+def create_video_search_examples(today):
+    year = today.year
+    return (
+        f"'can you find me videos that came out two years ago': release_date_before:'{year - 2}-12-31', release_date_after:'{year - 2}-01-01',"
+        f"'can you find me cooking videos that came out last week': release_date_before:'{today.isoformat()}', release_date_after:'{(today - timedelta(days=7)).isoformat()}',"
+        f"'can you find videos released this year': release_date_before:'{year}-12-31', release_date_after:'{year}-01-01',"
+        f"'can you find music videos released in {year - 3}': release_date_before:'{year - 3}-12-31', release_date_after:'{year - 3}-01-01',"
+        f"'can you find me videos from {year - 1}': release_date_before:'{year - 1}-12-31', release_date_after:'{year - 1}-01-01',"
+        f"'can you find me a video that came out on May 12, {year - 1}': release_date_before:'{year - 1}-05-12', release_date_after:'{year - 1}-05-12'"
+    )
+
+
+# Stands in for the relative date examples in the instructions until a prompt is rendered
+VIDEO_SEARCH_EXAMPLES = "{video_search_examples}"
+
+
+# The text sent to Gemini for one call: the instructions of its template followed by the request part
+class Prompt(str):
+    def __new__(cls, template, instructions, request):
+        prompt = super().__new__(cls, instructions + request)
+        prompt.template = template
+        prompt.request = request
+        return prompt
+
+
+# Instructions only change with the date (the relative date examples), they are built once per day. The request
+# part (today's date, the summary and the user's request) changes per call, and it comes last so the instructions
+# are a prefix Gemini can cache.
+class PromptTemplate:
+    def __init__(self, name, instructions, request_format):
+        self.name = name
+        self.instruction_format = instructions
+        self.request_format = request_format
+        self.built_instructions = (None, "")
+
+    def instructions_for(self, today):
+        day, instructions = self.built_instructions
+        if day != today:
+            instructions = self.instruction_format.replace(VIDEO_SEARCH_EXAMPLES, create_video_search_examples(today))
+            self.built_instructions = (today, instructions)
+        return instructions
+
+    @property
+    def instructions(self):
+        return self.instructions_for(date.today())
+
+    # The summary is cut so the whole prompt stays within GEMINI_PROMPT_TOKEN_BUDGET
+    def render(self, user_prompt, summary):
+        today = date.today()
+        instructions = self.instructions_for(today)
+        values = {"today": today.isoformat(), "user_prompt": user_prompt, "summary": ""}
+        # One token of slack for the rounding of the estimate
+        available = (
+            settings.GEMINI_PROMPT_TOKEN_BUDGET
+            - count_tokens(instructions + self.request_format.format(**values))
+            - 1
+        )
+        values["summary"] = truncate_to_tokens(summary or "", available)
+        return Prompt(self, instructions, self.request_format.format(**values))
+
+
 # PROMPTS
 class Prompts:
+    # Bump whenever a template changes so cached Gemini responses built from the old wording are ignored
+    TEMPLATE_VERSION = 4
+
+    RESPONSE_INSTRUCTIONS = (
+        "Return a generic response based on the identified intent in less than 100 words. For example, if the intent is to recommend videos, "
+        "the response could be 'Here are some videos I found.' If the intent is to recommend podcasts, the response could be 'Here are some podcasts I found.' "
+        "If the user's request is to find a specific video, for example 'can you find me this video 'La photographie pour déjouer clichés et représentations: Adrien Golinelli at TEDxParis',"
+        "return a generic response 'Here is the video you are looking for.'"
+        "If the response you were planning on generating has more than 100 words and the intent you found matched to 'others', "
+        "return the response: 'Sorry, I am unable to process queries with outputs over 100 words at this time. Please try another query.'. "
+    )
+
+    # Exact titles are resolved through the title index instead of a full-text search
+    TITLE_INSTRUCTIONS = (
+        "If the user is looking for one specific video by its title, set title to the exact title as written by the user "
+        "and leave topic empty. Otherwise leave title empty. "
+    )
+
+    INTENT_INSTRUCTIONS = (
+        "You will be given today's date, a summary of the previous messages and a user's request. "
+        "From what you determined was the intent based on both the user's request and summary, match it to one of these options: 'find video', 'find podcast'. "
+        "If the intent does not match any of the options provided, set the intent to 'others'. "
+        "Determine if the user's request is related or unrelated to the summary."
+        "If the user's request is unrelated, create a new summary focusing solely on the current request. "
+        "Otherwise, update the summary based on the new request in less than 100 words. "
+        "For instance, if the previous summary is about TED Talks and the new request is about 'videos with Jenna Ortega,' "
+        "treat these as unrelated and create a new summary. "
+        f"{RESPONSE_INSTRUCTIONS}"
+    )
+
+    QUERY_OPTIONS_INSTRUCTIONS = (
+        "If there is a released date mentioned, return it in this format: Year-Month-Day, relative to today's date. Here are some phrases that may be found in the user prompt "
+        f"and the results I expect: {VIDEO_SEARCH_EXAMPLES}.  If a view count is mentioned, format it like "
+        "these examples:'1000000' -> '1000000''less than 23495' -> '<23495''more than 1240' -> '>1240'. "
+        f"{TITLE_INSTRUCTIONS}"
+    )
+
+    REQUEST_FORMAT = "\nToday's date: {today}. Summary of the previous messages: {summary}. User's request: {user_prompt}"
+
+    INITIAL_TEMPLATE = PromptTemplate(
+        "initial",
+        f"{INTENT_INSTRUCTIONS}"
+        "Return only the analysis in a well-structured JSON format. The JSON should include the following fields: "
+        '{"intent": "string", "summary": "string", "response": "string"} '
+        "No additional text or explanations should be included, just the JSON.",
+        REQUEST_FORMAT,
+    )
+
+    # Same analysis as the initial template, but also extracts the Typesense query options so search requests only need one Gemini call
+    COMBINED_TEMPLATE = PromptTemplate(
+        "combined",
+        f"{INTENT_INSTRUCTIONS}"
+        "If the intent is 'find video' or 'find podcast', also fill a query_options object using any of these values mentioned in the user's request or summary: "
+        "{ topic: string, title: string, view_count: string, release_date_before: string, release_date_after: string }. "
+        f"{QUERY_OPTIONS_INSTRUCTIONS}"
+        "If the intent is 'others', set query_options to null. "
+        "Return only the analysis in a well-structured JSON format. The JSON should include the following fields: "
+        '{"intent": "string", "summary": "string", "response": "string", '
+        '"query_options": {"topic": "string", "title": "string", "view_count": "string", "release_date_before": "string", "release_date_after": "string"}} '
+        "No additional text or explanations should be included, just the JSON.",
+        REQUEST_FORMAT,
+    )
+
+    # Used when the conversation is kept server-side (see chatbot.services.conversation_store). The prompt only has the
+    # new request and the compact conversation state, and no summary is generated, which keeps tokens in and out flat.
+    CONVERSATION_TEMPLATE = PromptTemplate(
+        "conversation",
+        "You will be given today's date, the state of the conversation so far and a user's request. "
+        "Match the intent of the request to one of these options: 'find video', 'find podcast'. "
+        "If the intent does not match any of the options provided, set the intent to 'others'. "
+        f"{RESPONSE_INSTRUCTIONS}"
+        "If the intent is 'find video' or 'find podcast', also fill a query_options object using any of these values mentioned in the user's request: "
+        "{ topic: string, title: string, view_count: string, release_date_before: string, release_date_after: string }. "
+        "If the request refines the last video search (for example 'only the ones from 2022'), keep its other values, "
+        "otherwise ignore them. "
+        f"{QUERY_OPTIONS_INSTRUCTIONS}"
+        "If the intent is 'others', set query_options to null. "
+        "Return only the analysis in a well-structured JSON format. The JSON should include the following fields: "
+        '{"intent": "string", "response": "string", '
+        '"query_options": {"topic": "string", "title": "string", "view_count": "string", "release_date_before": "string", "release_date_after": "string"}} '
+        "No additional text or explanations should be included, just the JSON.",
+        "\nToday's date: {today}. State of the conversation so far: {summary}. User's request: {user_prompt}",
+    )
+
+    VIDEO_SEARCH_QUERY_TEMPLATE = PromptTemplate(
+        "video_search_query",
+        "You will be given today's date, a summary and a user prompt. The intent of this is to find videos or podcasts. Based off the summary and user "
+        "prompt I would like you to create a JSON Object with these fields and fill any of the values if it's mentioned in the sentence: "
+        "{ topic: string, title: string, view_count: string, release_date_before: string, release_date_after: string } "
+        f"{QUERY_OPTIONS_INSTRUCTIONS}"
+        "No additional text or explanations should be included, just the JSON.",
+        "\nToday's date: {today}. summary: {summary}. User Prompt: {user_prompt}",
+    )
+
+    TEMPLATES = (INITIAL_TEMPLATE, COMBINED_TEMPLATE, CONVERSATION_TEMPLATE, VIDEO_SEARCH_QUERY_TEMPLATE)
+
     @staticmethod
     def create_initial_prompt(user_prompt, chat_summary):
-        return (
-            f"Here is a user's request: {user_prompt}. "
-            f"Here is a summary of the previous messages: {chat_summary}. "
-            "From what you determined was the intent based on both the user's request and summary, match it to one of these options: 'find video', 'find podcast'. "
-            "If the intent does not match any of the options provided, set the intent to 'others'. "
-            "Determine if the user's request is related or unrelated to the summary."
-            "If the user's request is unrelated, create a new summary focusing solely on the current request. "
-            "Otherwise, update the summary based on the new request in less than 100 words. "
-            "For instance, if the previous summary is about TED Talks and the new request is about 'videos with Jenna Ortega,' "
-            "treat these as unrelated and create a new summary. "
-            "Return a generic response based on the identified intent in less than 100 words. For example, if the intent is to recommend videos, "
-            "the response could be 'Here are some videos I found.' If the intent is to recommend podcasts, the response could be 'Here are some podcasts I found.' "
-            "If the user's request is to find a specific video, for example 'can you find me this video 'La photographie pour déjouer clichés et représentations: Adrien Golinelli at TEDxParis',"
-            "return a generic response 'Here is the video you are looking for.'"
-            "If the response you were planning on generating has more than 100 words and the intent you found matched to 'others', "
-            "return the response: 'Sorry, I am unable to process queries with outputs over 100 words at this time. Please try another query.'. "
-            "Return only the analysis in a well-structured JSON format. The JSON should include the following fields: "
-            '{"intent": "string", "summary": "string", "response": "string"} '
-            "No additional text or explanations should be included, just the JSON."
-        )
-    
+        return Prompts.INITIAL_TEMPLATE.render(user_prompt, chat_summary)
+
     @staticmethod
-    def create_video_search_query_prompt(chat_summary, user_prompt):
-        examples = (
-            "'can you find me videos that came out two years ago': release_date_before:'2022-12-31', release_date_after:'2022-01-01',"
-            "'can you find me cooking videos that came out last week': release_date_before:'2024-10-29', release_date_after:'2024-10-22',"
-            "'can you find videos released this year': release_date_before:'2024-12-31', release_date_after:'2024-01-01',"
-            "'can you find music videos released in 2022': release_date_before:'2023-12-31', release_date_after:'2023-01-01'"
-            "'can you find me videos from 2023': release_date_before:'2023-12-31', release_date_after:'2023-01-01',"
-            "'can you find me a video that came out on May 12, 2023': release_date_before:'2023-05-12', release_date_after:'2023-05-12'"
-        )
+    def create_combined_prompt(user_prompt, chat_summary):
+        return Prompts.COMBINED_TEMPLATE.render(user_prompt, chat_summary)
 
-        return (
-            f"summary: {chat_summary}. User Prompt: {user_prompt}. The intent of this is to find videos. Based off the summary and user "
-            "prompt I would like you to create a JSON Object with these fields and fill any of the values if it's mentioned in the sentence: "
-            "{ topic: string, view_count: string, release_date_before: string, release_date_after: string } "
-            "If there is a released date mentioned, return it in this format: Year-Month-Day. Here are some phrases that may be found in the user prompt "
-            f"and the results I expect: {examples}.  If a view count is mentioned, format it like "
-            "these examples:'1000000' -> '1000000''less than 23495' -> '<23495''more than 1240' -> '>1240'"
-            "No additional text or explanations should be included, just the JSON."
-        )
+    @staticmethod
+    def create_conversation_prompt(user_prompt, conversation_context):
+        return Prompts.CONVERSATION_TEMPLATE.render(user_prompt, conversation_context or "this is the first request")
+
+    @staticmethod
+    def create_video_search_query_prompt(chat_summary, user_prompt):
+        return Prompts.VIDEO_SEARCH_QUERY_TEMPLATE.render(user_prompt, chat_summary)
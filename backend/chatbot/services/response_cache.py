@@ -0,0 +1,215 @@
+import hashlib
+import re
+import threading
+import time
+from datetime import date
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+
+from chatbot.services.prompts import Prompts
+from chatbot.utils.ttl_cache import TTLCache
+
+
+# Case, whitespace and trailing punctuation don't change what the user is asking for
+def normalize(text):
+    return re.sub(r"\s+", " ", (text or "").strip().lower()).rstrip(" ?!.")
+
+
+# What a response depends on besides the prompt: the template version, the extraction mode and today's date (the
+# prompts give Gemini the date, so "videos from last week" means something else tomorrow)
+def response_scope():
+    return "|".join(
+        (
+            str(Prompts.TEMPLATE_VERSION),
+            "combined" if settings.GEMINI_SINGLE_CALL_EXTRACTION else "initial",
+            date.today().isoformat(),
+        )
+    )
+
+
+# Identifies a stateless generation. The scope is part of the key so a prompt change never serves stale output.
+# Also used to coalesce identical in-flight generations.
+def response_key(user_prompt, chat_summary):
+    raw = "|".join((response_scope(), normalize(user_prompt), normalize(chat_summary)))
+    return "gemini-response:" + hashlib.sha256(raw.encode()).hexdigest()
+
+
+# Stands in for the Gemini response object, ResponseParser only reads .text
+class CachedResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class InProcessCacheBackend:
+    def __init__(self, max_entries, ttl):
+        self.cache = TTLCache(max_entries=max_entries, ttl=ttl)
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value):
+        self.cache.set(key, value)
+
+
+# Shares cached responses between workers. Size is bounded by the Django cache's own MAX_ENTRIES option.
+class DjangoCacheBackend:
+    def __init__(self, alias, ttl):
+        self.cache = caches[alias]
+        self.ttl = ttl
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value):
+        self.cache.set(key, value, timeout=self.ttl)
+
+
+# Maps prompt embeddings to exact cache keys so near-identical prompts can reuse a response. Unit vectors are kept
+# in one matrix, so a lookup is a single matrix-vector product. Slots are reused oldest first once max_entries are
+# held. Entries belong to one scope (see response_scope), the index starts over when it changes (e.g. at midnight).
+class SemanticIndex:
+    def __init__(self, embed, threshold, max_entries, ttl):
+        self.embed = embed
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.matrix = None
+        self.keys = [None] * max_entries
+        self.expires_at = np.zeros(max_entries)
+        self.scope = None
+        self.next_slot = 0
+        self.lock = threading.Lock()
+
+    def lookup(self, text, scope=""):
+        vector = self.embed(text)
+        query = self.unit(vector)
+        with self.lock:
+            if self.scope != scope or self.matrix is None or self.matrix.shape[1] != len(query):
+                return None, vector
+            scores = self.matrix @ query
+            scores[self.expires_at < time.monotonic()] = -1
+            slot = int(np.argmax(scores))
+            return (self.keys[slot] if scores[slot] >= self.threshold else None), vector
+
+    def add(self, key, vector, scope=""):
+        unit = self.unit(vector)
+        with self.lock:
+            if self.scope != scope or self.matrix is None or self.matrix.shape[1] != len(unit):
+                self.matrix = np.zeros((self.max_entries, len(unit)), dtype=np.float32)
+                self.keys = [None] * self.max_entries
+                self.expires_at[:] = 0
+                self.scope = scope
+                self.next_slot = 0
+            slot = self.next_slot
+            self.next_slot = (slot + 1) % self.max_entries
+            self.matrix[slot] = unit
+            self.keys[slot] = key
+            self.expires_at[slot] = time.monotonic() + self.ttl
+
+    @staticmethod
+    def unit(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+class ResponseCache:
+    def __init__(self, backend, semantic_index=None):
+        self.backend = backend
+        self.semantic_index = semantic_index
+        self.lock = threading.Lock()
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.miss_latency = 0.0
+
+    @classmethod
+    def from_settings(cls, embed=None):
+        config = settings.GEMINI_RESPONSE_CACHE
+        if not config.get("BACKEND"):
+            return None
+
+        if config["BACKEND"] == "django":
+            backend = DjangoCacheBackend(config.get("CACHE_ALIAS", "default"), config["TTL_SECONDS"])
+        else:
+            backend = InProcessCacheBackend(config["MAX_ENTRIES"], config["TTL_SECONDS"])
+
+        semantic_index = None
+        if config.get("SEMANTIC_THRESHOLD") and embed is not None:
+            semantic_index = SemanticIndex(
+                embed, config["SEMANTIC_THRESHOLD"], config["SEMANTIC_MAX_ENTRIES"], config["TTL_SECONDS"]
+            )
+        return cls(backend, semantic_index)
+
+    def make_key(self, user_prompt, chat_summary):
+        return response_key(user_prompt, chat_summary)
+
+    def get(self, user_prompt, chat_summary):
+        return self.lookup(user_prompt, chat_summary)[0]
+
+    # Returns the cached response (or None) and the prompt embedding, so a miss doesn't embed the prompt twice
+    def lookup(self, user_prompt, chat_summary):
+        key = self.make_key(user_prompt, chat_summary)
+        text = self.backend.get(key)
+        if text is not None:
+            self.record("exact_hits")
+            return CachedResponse(text), None
+
+        vector = None
+        if self.semantic_index is not None:
+            similar_key, vector = self.semantic_index.lookup(
+                self.semantic_text(user_prompt, chat_summary), response_scope()
+            )
+            text = self.backend.get(similar_key) if similar_key else None
+            if text is not None:
+                self.record("semantic_hits")
+                return CachedResponse(text), vector
+
+        self.record("misses")
+        return None, vector
+
+    def set(self, user_prompt, chat_summary, response, latency=0.0, vector=None):
+        key = self.make_key(user_prompt, chat_summary)
+        self.backend.set(key, response.text)
+        with self.lock:
+            self.miss_latency += latency
+
+        if self.semantic_index is not None:
+            if vector is None:
+                vector = self.semantic_index.embed(self.semantic_text(user_prompt, chat_summary))
+            self.semantic_index.add(key, vector, response_scope())
+
+    def get_or_generate(self, user_prompt, chat_summary, generate):
+        cached_response, vector = self.lookup(user_prompt, chat_summary)
+        if cached_response is not None:
+            return cached_response
+
+        start = time.perf_counter()
+        response = generate()
+        if response:
+            self.set(user_prompt, chat_summary, response, time.perf_counter() - start, vector)
+        return response
+
+    def semantic_text(self, user_prompt, chat_summary):
+        return f"{normalize(chat_summary)}\n{normalize(user_prompt)}"
+
+    def record(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    # Saved time is estimated from the average latency of the Gemini calls made on a miss
+    def stats(self):
+        with self.lock:
+            hits = self.exact_hits + self.semantic_hits
+            lookups = hits + self.misses
+            average_miss_latency = self.miss_latency / self.misses if self.misses else 0.0
+            return {
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+                "average_miss_latency_ms": round(average_miss_latency * 1000, 2),
+                "estimated_latency_saved_ms": round(hits * average_miss_latency * 1000, 2),
+            }
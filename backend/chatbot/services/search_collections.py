@@ -0,0 +1,78 @@
+import logging
+
+from django.conf import settings
+
+from chatbot.clients.typesense_client import TypesenseSearchError
+
+logger = logging.getLogger(__name__)
+
+# Reciprocal rank fusion constant, text match scores of different collections aren't comparable but ranks are
+RANK_CONSTANT = 60
+
+
+# A Typesense collection that answers some intents, and how to query it (see SEARCH_COLLECTIONS in settings)
+class SearchCollection:
+    def __init__(self, name, intents, query_by, query_by_weight, search_cutoff_ms=None, weight=1.0, facets=False):
+        self.name = name
+        self.intents = tuple(intents)
+        self.query_by = query_by
+        self.query_by_weight = query_by_weight
+        self.search_cutoff_ms = search_cutoff_ms
+        self.weight = weight
+        self.facets = facets
+
+    @classmethod
+    def from_config(cls, name, config):
+        return cls(
+            name,
+            config["INTENTS"],
+            config["QUERY_BY"],
+            config["QUERY_BY_WEIGHT"],
+            search_cutoff_ms=config.get("SEARCH_CUTOFF_MS"),
+            weight=config.get("WEIGHT", 1.0),
+            facets=config.get("FACETS", False),
+        )
+
+    def search_parameters(self, search_parameters, filters):
+        parameters = {
+            **search_parameters,
+            "collection": self.name,
+            "query_by": self.query_by,
+            "query_by_weight": self.query_by_weight,
+            "filter_by": filters,
+        }
+        if self.search_cutoff_ms:
+            parameters["search_cutoff_ms"] = self.search_cutoff_ms
+        return parameters
+
+
+def collections_for_intent(intent):
+    return [
+        SearchCollection.from_config(name, config)
+        for name, config in settings.SEARCH_COLLECTIONS.items()
+        if intent in config["INTENTS"]
+    ]
+
+
+def is_search_intent(intent):
+    return any(intent in config["INTENTS"] for config in settings.SEARCH_COLLECTIONS.values())
+
+
+# Merges the multi_search results of several collections by weighted reciprocal rank, most viewed first on a tie.
+# A collection whose search failed (e.g. it hasn't been created yet) is left out, unless they all failed.
+def merge_results(collections, results, limit):
+    scored = []
+    errors = []
+    for collection, result in zip(collections, results):
+        if "error" in result:
+            logger.warning("Search in %s failed: %s", collection.name, result["error"])
+            errors.append(result["error"])
+            continue
+        for rank, hit in enumerate(result["hits"], start=1):
+            document = {**hit["document"], "collection": collection.name}
+            scored.append((collection.weight / (RANK_CONSTANT + rank), document.get("view_count", 0), document))
+
+    if errors and len(errors) == len(collections):
+        raise TypesenseSearchError(errors[0])
+    scored.sort(key=lambda item: (item[0], item[1]), reverse=True)
+    return [document for _, _, document in scored[:limit]]
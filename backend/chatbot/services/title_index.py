@@ -0,0 +1,128 @@
+import logging
+import re
+import threading
+import time
+import unicodedata
+
+from django.conf import settings
+
+from chatbot.services.collection_epoch import get_collection_epoch
+from chatbot.utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+title_lookups = registry.counter(
+    "chatbot_title_index_lookups_total",
+    "Exact title lookups answered from the in-process title index (hit), sent to full-text search (miss) or sent "
+    "there because the index is still loading (not_ready)",
+    labels=("result",),
+)
+title_index_size = registry.gauge("chatbot_title_index_titles", "Normalised titles held in the title index")
+
+
+# Casing, accents, punctuation and spacing differ between what users type and the stored titles
+def normalize_title(title):
+    title = unicodedata.normalize("NFKD", title)
+    title = "".join(character for character in title if not unicodedata.combining(character))
+    title = re.sub(r"[^\w\s]", " ", title.casefold())
+    return " ".join(title.split())
+
+
+# In-process map of normalised title -> document id(s), built from a documents export of the collection.
+# Requests for one specific video resolve with a dictionary lookup and a single document fetch instead of a
+# typo-tolerant full-text search. The index is built when the worker warms up, or in a background thread on the
+# first lookup, and lookups fall back to search until it is ready. It reloads (again in the background, the
+# current index keeps serving) when the collection epoch changes (every re-index) or after MAX_AGE_SECONDS, and a
+# failed load is retried after RETRY_SECONDS. `client` is a TypesenseClient.
+class TitleIndex:
+    def __init__(self, client, collection, max_age=3600, retry_after=30):
+        self.client = client
+        self.collection = collection
+        self.max_age = max_age
+        self.retry_after = retry_after
+        self.titles = {}
+        self.epoch = None
+        self.loaded_at = None
+        self.next_attempt = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        self.thread_lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, client, collection):
+        config = settings.TITLE_INDEX
+        if not config["ENABLED"]:
+            return None
+        return cls(client, collection, max_age=config["MAX_AGE_SECONDS"], retry_after=config["RETRY_SECONDS"])
+
+    @property
+    def ready(self):
+        return self.loaded_at is not None
+
+    # Never waits for a load, so a request can't be held up by the export
+    def lookup(self, title):
+        if self.is_stale():
+            self.refresh_in_background()
+        if not self.ready:
+            title_lookups.inc(result="not_ready")
+            return []
+        document_ids = self.titles.get(normalize_title(title))
+        title_lookups.inc(result="hit" if document_ids else "miss")
+        if document_ids is None:
+            return []
+        return [document_ids] if isinstance(document_ids, str) else list(document_ids)
+
+    def is_stale(self):
+        if time.monotonic() < self.next_attempt:
+            return False
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > self.max_age:
+            return True
+        return get_collection_epoch(self.collection) != self.epoch
+
+    def refresh_in_background(self):
+        with self.thread_lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self.refresh, name=f"title-index-{self.collection}", daemon=True)
+            self.thread.start()
+
+    # Called by the worker's warm-up and the background thread. Only one load runs at a time.
+    def refresh(self):
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            if not self.is_stale():
+                return
+            epoch = get_collection_epoch(self.collection)
+            try:
+                titles = self.load()
+            except Exception:
+                logger.exception("Could not load the title index for %s", self.collection)
+                self.next_attempt = time.monotonic() + self.retry_after
+                return
+            self.titles = titles
+            self.epoch = epoch
+            self.loaded_at = time.monotonic()
+            title_index_size.set(len(titles))
+        finally:
+            self.lock.release()
+
+    # The export is read one document at a time, only the index itself is held in memory
+    def load(self):
+        titles = {}
+        for document in self.client.export_documents(self.collection, {"include_fields": "id,titles"}):
+            for title in document.get("titles") or []:
+                self.add(titles, normalize_title(title), document["id"])
+        return titles
+
+    # Most titles are unique, so ids are stored as plain strings and only become tuples on a collision
+    @staticmethod
+    def add(titles, key, document_id):
+        existing = titles.get(key)
+        if existing is None:
+            titles[key] = document_id
+        elif isinstance(existing, str):
+            if existing != document_id:
+                titles[key] = (existing, document_id)
+        elif document_id not in existing:
+            titles[key] = existing + (document_id,)
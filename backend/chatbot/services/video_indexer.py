@@ -0,0 +1,336 @@
+import csv
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import httpx
+import requests
+from django.conf import settings
+from typesense import exceptions as typesense_exceptions
+
+from chatbot.services.facets import FACET_FIELDS, add_facets
+from chatbot.utils.batching import batched
+
+logger = logging.getLogger(__name__)
+
+VIDEOLISTS_FIELDS = [
+    {"name": "titles", "type": "string[]"},
+    {"name": "tags", "type": "string[]", "optional": True},
+    {"name": "description", "type": "string", "optional": True},
+    {"name": "view_count", "type": "int64"},
+    {"name": "released_date", "type": "int64"},
+    {"name": "thumbnail_url", "type": "string", "index": False, "optional": True},
+    {"name": "thumbnail_height", "type": "int32", "index": False, "optional": True},
+    {"name": "thumbnail_width", "type": "int32", "index": False, "optional": True},
+]
+
+LIST_FIELDS = {"titles", "tags"}
+INT_FIELDS = {"view_count", "released_date", "thumbnail_height", "thumbnail_width"}
+
+
+def create_videolists_schema(name):
+    # The bucket fields are always indexed, FILTER_FACETS only decides whether searches use them
+    fields = VIDEOLISTS_FIELDS + FACET_FIELDS
+    # Filled by the local embedding model at index time (see chatbot.services.embeddings)
+    if settings.VECTOR_SEARCH["ENABLED"]:
+        fields.append(
+            {"name": "embedding", "type": "float[]", "num_dim": settings.VECTOR_SEARCH["DIMENSIONS"], "optional": True}
+        )
+    return {
+        "name": name,
+        "fields": fields,
+        "default_sorting_field": "view_count",
+    }
+
+
+# Streams documents from a JSONL or CSV file one row at a time so memory doesn't grow with the dataset.
+# In CSV files the titles/tags columns hold "|" separated values. A line that can't be parsed is passed to
+# on_error(line_number, text, error) and skipped, or raises if there is no on_error.
+def read_documents(path, on_error=None):
+    with open(path, newline="", encoding="utf-8") as file:
+        if path.endswith(".csv"):
+            reader = csv.DictReader(file)
+            for row in reader:
+                try:
+                    document = convert_csv_row(row)
+                except ValueError as error:
+                    if on_error is None:
+                        raise
+                    on_error(reader.line_num, json.dumps(row), error)
+                    continue
+                yield document
+        else:
+            for line_number, line in enumerate(file, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    document = json.loads(line)
+                    if not isinstance(document, dict):
+                        raise ValueError("Expected a JSON object")
+                except ValueError as error:
+                    if on_error is None:
+                        raise
+                    on_error(line_number, line.rstrip("\n"), error)
+                    continue
+                yield document
+
+
+def convert_csv_row(row):
+    document = {}
+    for field, value in row.items():
+        if value in ("", None):
+            continue
+        if field in LIST_FIELDS:
+            document[field] = [item.strip() for item in value.split("|") if item.strip()]
+        elif field in INT_FIELDS:
+            document[field] = int(float(value))
+        else:
+            document[field] = value
+    return document
+
+
+# Rate limiting and server or network failures can succeed on a later attempt. Anything else (a malformed
+# document, a schema mismatch, a bad request) fails the same way every time and isn't retried.
+def is_transient_status(code):
+    return code == 429 or 500 <= code <= 599
+
+
+TRANSIENT_ERRORS = (
+    ConnectionError,
+    TimeoutError,
+    requests.ConnectionError,
+    requests.Timeout,
+    httpx.TransportError,
+    typesense_exceptions.Timeout,
+    typesense_exceptions.HTTPStatus0Error,
+    typesense_exceptions.ServerError,
+    typesense_exceptions.ServiceUnavailable,
+)
+
+
+def is_transient_error(error):
+    if isinstance(error, TRANSIENT_ERRORS):
+        return True
+    # Other Typesense errors carry the HTTP status as their first argument
+    if isinstance(error, typesense_exceptions.TypesenseClientError) and error.args and isinstance(error.args[0], int):
+        return is_transient_status(error.args[0])
+    return False
+
+
+# Keeps track of the highest batch number below which every batch has been imported, so an interrupted import can
+# resume without re-sending what is already in Typesense. Removed once an import completes.
+class ImportCheckpoint:
+    def __init__(self, path, source, batch_size):
+        self.path = path
+        self.source = source
+        self.batch_size = batch_size
+        self.completed_batches = 0
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    # Size and modification time of the source, so a file replaced or edited under the same name starts over
+    def fingerprint(self):
+        try:
+            stat = os.stat(self.source)
+        except OSError:
+            return None
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        with open(self.path) as file:
+            state = json.load(file)
+        # A checkpoint is only valid for the same file, unchanged, read with the same batch size
+        if (
+            state.get("source") == self.source
+            and state.get("batch_size") == self.batch_size
+            and state.get("fingerprint") == self.fingerprint()
+        ):
+            self.completed_batches = state["completed_batches"]
+
+    def mark_done(self, batch_number):
+        with self.lock:
+            self.pending.add(batch_number)
+            while self.completed_batches in self.pending:
+                self.pending.remove(self.completed_batches)
+                self.completed_batches += 1
+            self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, "w") as file:
+            json.dump(
+                {
+                    "source": self.source,
+                    "fingerprint": self.fingerprint(),
+                    "batch_size": self.batch_size,
+                    "completed_batches": self.completed_batches,
+                },
+                file,
+            )
+        os.replace(temporary_path, self.path)
+
+    def clear(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ImportReport:
+    def __init__(self):
+        self.imported = 0
+        self.failed = 0
+        self.unreadable = 0
+        self.skipped = 0
+        self.elapsed = 0.0
+        self.failed_ids = set()
+        self.lock = threading.Lock()
+
+    def add(self, imported, failed_documents):
+        with self.lock:
+            self.imported += imported
+            self.failed += len(failed_documents)
+            self.failed_ids.update(document.get("id") for document in failed_documents)
+
+    # A line of the source that couldn't be parsed, so there is no document id to retry
+    def add_unreadable(self):
+        with self.lock:
+            self.failed += 1
+            self.unreadable += 1
+
+    @property
+    def docs_per_second(self):
+        return self.imported / self.elapsed if self.elapsed else 0.0
+
+
+# Imports documents through Typesense's bulk import endpoint. Batches are sent by a pool of workers with a
+# bounded number of batches in memory at once, rows that fail transiently are retried with backoff, and progress
+# is checkpointed after every batch. Rows that can't be parsed or that Typesense rejects for good (schema or
+# validation errors) go straight to failures_path and the import carries on.
+class VideoIndexer:
+    def __init__(
+        self,
+        collection,
+        batch_size=1000,
+        workers=4,
+        max_retries=3,
+        checkpoint_path=None,
+        failures_path=None,
+        action="upsert",
+        embedder=None,
+    ):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.workers = workers
+        self.max_retries = max_retries
+        self.checkpoint_path = checkpoint_path
+        self.failures_path = failures_path
+        self.action = action
+        self.embedder = embedder
+        self.failures_lock = threading.Lock()
+
+    # `select` filters the documents read from the source, e.g. down to the ones that changed
+    def run(self, source, documents=None, resume=True, select=None):
+        checkpoint = ImportCheckpoint(self.checkpoint_path, os.path.abspath(source), self.batch_size)
+        if resume:
+            checkpoint.load()
+
+        report = ImportReport()
+        start = time.perf_counter()
+        in_flight = set()
+        if documents is None:
+            documents = read_documents(
+                source, on_error=lambda line_number, text, error: self.record_unreadable(report, line_number, text, error)
+            )
+        if select is not None:
+            documents = select(documents)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for batch_number, batch in enumerate(batched(documents, self.batch_size)):
+                if batch_number < checkpoint.completed_batches:
+                    report.skipped += len(batch)
+                    continue
+
+                if len(in_flight) >= self.workers * 2:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+
+                in_flight.add(
+                    executor.submit(self.import_batch, batch_number, batch, checkpoint, report)
+                )
+
+            for future in in_flight:
+                future.result()
+
+        # Every batch went through (failed rows are in failures_path), the next run starts from the beginning
+        checkpoint.clear()
+        report.elapsed = time.perf_counter() - start
+        return report
+
+    def import_batch(self, batch_number, batch, checkpoint, report):
+        for document in batch:
+            add_facets(document)
+        if self.embedder is not None:
+            self.embedder.add_embeddings(batch)
+
+        pending = batch
+        errors = []
+        failed = []
+        imported = 0
+
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(min(2 ** attempt, 30) * random.uniform(0.5, 1.0))
+            try:
+                results = self.collection.documents.import_(pending, {"action": self.action})
+            except Exception as error:
+                logger.warning("Batch %s failed on attempt %s: %s", batch_number, attempt + 1, error)
+                errors = [str(error)] * len(pending)
+                if not is_transient_error(error):
+                    break
+                continue
+
+            # Only the rows Typesense rejected with a transient error are sent again
+            still_pending, errors = [], []
+            for document, result in zip(pending, results):
+                if result.get("success"):
+                    imported += 1
+                elif is_transient_status(result.get("code", 0)):
+                    still_pending.append(document)
+                    errors.append(result.get("error"))
+                else:
+                    failed.append((document, result.get("error")))
+
+            pending = still_pending
+            if not pending:
+                break
+
+        failed.extend(zip(pending, errors))
+        if failed:
+            self.record_failures(failed)
+
+        report.add(imported, [document for document, _ in failed])
+        checkpoint.mark_done(batch_number)
+
+    def record_failures(self, failed):
+        logger.warning("%s documents could not be imported", len(failed))
+        if not self.failures_path:
+            return
+        with self.failures_lock, open(self.failures_path, "a", encoding="utf-8") as file:
+            for document, error in failed:
+                file.write(json.dumps({"error": error, "document": document}) + "\n")
+
+    def record_unreadable(self, report, line_number, text, error):
+        logger.warning("Line %s of the source could not be read: %s", line_number, error)
+        report.add_unreadable()
+        if not self.failures_path:
+            return
+        with self.failures_lock, open(self.failures_path, "a", encoding="utf-8") as file:
+            file.write(json.dumps({"error": str(error), "line": line_number, "text": text}) + "\n")
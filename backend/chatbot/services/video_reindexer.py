@@ -0,0 +1,153 @@
+import dbm
+import hashlib
+import json
+import os
+import shutil
+from datetime import datetime, timezone
+
+from typesense.exceptions import ObjectNotFound
+
+from chatbot.services.video_indexer import create_videolists_schema
+from chatbot.utils.batching import batched
+
+
+# The search service always queries the alias (e.g. "videolists"), which points at a versioned collection
+# ("videolists_20241107120000"). A full re-index builds the next version next to the live one and only swaps
+# the alias once it is complete, so searches never hit a missing or half-built collection.
+def create_versioned_collection(client, alias):
+    name = f"{alias}_{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')}"
+    client.collections.create(create_videolists_schema(name))
+    return name
+
+
+def get_alias_target(client, alias):
+    try:
+        return client.aliases[alias].retrieve()["collection_name"]
+    except ObjectNotFound:
+        return None
+
+
+def swap_alias(client, alias, collection):
+    previous = get_alias_target(client, alias)
+    client.aliases.upsert(alias, {"collection_name": collection})
+    return previous
+
+
+# Deletes by id in chunks, ids are quoted with backticks so commas in them don't split the filter
+def delete_documents(collection, ids, batch_size=100):
+    deleted = 0
+    for chunk in batched(ids, batch_size):
+        id_filter = ",".join(f"`{document_id}`" for document_id in chunk)
+        deleted += collection.documents.delete({"filter_by": f"id:[{id_filter}]"})["num_deleted"]
+    return deleted
+
+
+def content_hash(document):
+    content = {field: value for field, value in document.items() if field != "updated_at"}
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+# Depending on the dbm backend a database is one file or several with these suffixes
+DBM_SUFFIXES = ("", ".db", ".dat", ".dir", ".bak")
+
+
+def remove_dbm(path):
+    for suffix in DBM_SUFFIXES:
+        if os.path.exists(f"{path}{suffix}"):
+            os.remove(f"{path}{suffix}")
+
+
+# Remembers the content hash of every indexed document (in an on-disk dbm file, so memory stays flat for
+# millions of ids) and the newest updated_at seen, so an incremental run only sends what actually changed.
+# Hashes are only committed after the import, leaving rows that failed to be picked up by the next run.
+# Incremental runs also note every id of the source (in a second dbm file), ids of the manifest that weren't
+# seen are documents removed from the catalogue. A full rebuild's manifest only holds the new collection's ids.
+class ChangeTracker:
+    def __init__(self, state_dir, rebuild=False):
+        self.state_dir = state_dir
+        self.rebuild = rebuild
+        self.manifest_path = os.path.join(state_dir, "manifest")
+        self.watermark_path = os.path.join(state_dir, "watermark.json")
+        self.seen_path = os.path.join(state_dir, "seen")
+        self.pending = {}
+        self.watermark = None
+        self.next_watermark = None
+
+    def __enter__(self):
+        os.makedirs(self.state_dir, exist_ok=True)
+        if self.rebuild:
+            # A full rebuild writes a fresh manifest next to the old one and only replaces it on commit
+            self.manifest = dbm.open(f"{self.manifest_path}.rebuild", "n")
+        else:
+            self.manifest = dbm.open(self.manifest_path, "c")
+            self.seen = dbm.open(self.seen_path, "n")
+            if os.path.exists(self.watermark_path):
+                with open(self.watermark_path) as file:
+                    self.watermark = json.load(file).get("updated_at")
+        self.next_watermark = self.watermark
+        return self
+
+    def __exit__(self, *exc_info):
+        self.manifest.close()
+        if not self.rebuild:
+            self.seen.close()
+            remove_dbm(self.seen_path)
+
+    def filter_changed(self, documents):
+        for document in documents:
+            if self.is_changed(document):
+                yield document
+
+    def is_changed(self, document):
+        key = str(document["id"])
+        if not self.rebuild:
+            self.seen[key] = b""
+
+        updated_at = document.get("updated_at")
+        if updated_at is not None:
+            if self.next_watermark is None or updated_at > self.next_watermark:
+                self.next_watermark = updated_at
+            # Only for documents already indexed, a deleted one that comes back keeps its old updated_at
+            if self.watermark is not None and updated_at <= self.watermark and key in self.manifest:
+                return False
+
+        document_hash = content_hash(document)
+        if self.rebuild:
+            self.manifest[key] = document_hash
+            return True
+        if key in self.manifest and self.manifest[key].decode() == document_hash:
+            return False
+        self.pending[key] = document_hash
+        return True
+
+    # Ids of the manifest that weren't in the source, only complete once filter_changed has been consumed
+    def missing_ids(self):
+        for key in self.manifest.keys():
+            if key not in self.seen:
+                yield key.decode()
+
+    def commit(self, failed_ids=(), deleted_ids=()):
+        failed_ids = {str(document_id) for document_id in failed_ids}
+        for key in deleted_ids:
+            if key in self.manifest:
+                del self.manifest[key]
+        for key, document_hash in self.pending.items():
+            if key not in failed_ids:
+                self.manifest[key] = document_hash
+        for key in failed_ids:
+            if self.rebuild and key in self.manifest:
+                del self.manifest[key]
+        self.pending.clear()
+
+        # Moving the watermark past failed rows would skip them forever, so it only moves on a clean run
+        if not failed_ids and self.next_watermark is not None:
+            with open(self.watermark_path, "w") as file:
+                json.dump({"updated_at": self.next_watermark}, file)
+
+        if self.rebuild:
+            self.manifest.close()
+            for suffix in DBM_SUFFIXES:
+                if os.path.exists(f"{self.manifest_path}.rebuild{suffix}"):
+                    shutil.move(f"{self.manifest_path}.rebuild{suffix}", f"{self.manifest_path}{suffix}")
+            self.manifest = dbm.open(self.manifest_path, "c")
+
@@ -1,22 +1,415 @@
-from vosyn_assist.clients.typesense_client import TypesenseClient
-from datetime import datetime
+from chatbot.clients.typesense_client import TypesenseClient, AsyncTypesenseClient, TypesenseSearchError
+from chatbot.services.collection_epoch import get_collection_epoch
+from chatbot.services.embeddings import LocalEmbedder
+from chatbot.services.facets import plan_release_date_filter, plan_view_count_filter
+from chatbot.services.search_collections import collections_for_intent, merge_results
+from chatbot.services.title_index import TitleIndex
+from chatbot.utils.batching import batched
+from chatbot.utils.metrics import stage
+from chatbot.utils.single_flight import SingleFlight
+from chatbot.utils.ttl_cache import TTLCache
+from django.conf import settings
+from datetime import datetime, timezone
+from functools import lru_cache
+from asgiref.sync import sync_to_async
+import json
+import logging
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+RESULT_FIELDS = ("id", "titles", "thumbnail_height", "thumbnail_width", "thumbnail_url", "view_count", "released_date")
 
 
 class VideoSearchService:
+    collection = "videolists"
+    # Typesense rejects multi_search requests with more searches than its limit_multi_searches (50 by default)
+    max_multi_searches = 50
+    # How often the SEARCH_COLLECTIONS that didn't exist are looked up again, so one created later is picked up
+    collection_check_seconds = 300
+
     def __init__(self):
         self.typesense = TypesenseClient()
+        self.async_typesense = AsyncTypesenseClient()
+        self.title_index = TitleIndex.from_settings(self.typesense, self.collection)
+        self.embedder = LocalEmbedder.from_settings()
+        self.search_flight = SingleFlight.from_settings("typesense_search")
+        self.missing_collections = set()
+        self.collections_checked_at = None
+
+        cache_config = settings.VIDEO_SEARCH_CACHE
+        self.result_cache = None
+        if cache_config["MAX_ENTRIES"]:
+            self.result_cache = TTLCache(
+                max_entries=cache_config["MAX_ENTRIES"],
+                ttl=cache_config["TTL_SECONDS"],
+                max_bytes=cache_config["MAX_BYTES"],
+                sizeof=lambda documents: len(json.dumps(documents)),
+            )
+
+    # Everything a first search would otherwise wait for: Typesense connections, the title index and the local
+    # embedding model. The async client's connections are bound to the request's event loop, so they aren't opened.
+    def warm_up(self):
+        self.typesense.warm_up()
+        self.check_collections()
+        if self.title_index is not None:
+            self.title_index.refresh()
+        if self.embedder is not None:
+            self.embedder.get_model()
 
     # Utilize Typesense to search for video data based on the entities we retrieved from Gemini
     def find_related_videos(self, query_options):
-        topic = query_options.get('topic', "")
+        search_parameters = self.build_search_parameters(query_options)
+
+        if not search_parameters:
+            return []
+
+        cache_key = self.get_cache_key(query_options)
+        videos = self.get_cached_videos(cache_key)
+        if videos is not None:
+            return videos
+
+        if self.search_flight is None:
+            return self.search_videos(query_options, search_parameters, cache_key)
+        # The cache key covers everything the search parameters are built from, including the collection epoch
+        return self.search_flight.do(
+            cache_key, lambda: self.search_videos(query_options, search_parameters, cache_key)
+        )
+
+    def search_videos(self, query_options, search_parameters, cache_key):
+        videos = self.find_video_by_title(query_options)
+        if videos:
+            self.cache_videos(cache_key, videos)
+            return videos
+
+        if self.uses_vector_search(search_parameters):
+            self.add_vector_query(search_parameters, self.embedder.embed_query(search_parameters["q"]))
+
+        with stage("typesense_search"):
+            search_results = self.typesense.search(self.collection, search_parameters)
+
+        videos = [hit["document"] for hit in search_results["hits"]]
+        self.cache_videos(cache_key, videos)
+        return videos
+
+    # Same search as find_related_videos, but over the non-blocking HTTP client for the async chat endpoint
+    async def find_related_videos_async(self, query_options):
+        search_parameters = self.build_search_parameters(query_options)
+
+        if not search_parameters:
+            return []
+
+        cache_key = self.get_cache_key(query_options)
+        videos = self.get_cached_videos(cache_key)
+        if videos is not None:
+            return videos
+
+        if self.search_flight is None:
+            return await self.search_videos_async(query_options, search_parameters, cache_key)
+        return await self.search_flight.do_async(
+            cache_key, lambda: self.search_videos_async(query_options, search_parameters, cache_key)
+        )
+
+    async def search_videos_async(self, query_options, search_parameters, cache_key):
+        videos = await self.find_video_by_title_async(query_options)
+        if videos:
+            self.cache_videos(cache_key, videos)
+            return videos
+
+        if self.uses_vector_search(search_parameters):
+            # Only a query embedding that isn't in the LRU yet runs the (CPU bound) model, off the event loop
+            query_vector = self.embedder.cached_query(search_parameters["q"]) or await sync_to_async(
+                self.embedder.embed_query, thread_sensitive=False
+            )(search_parameters["q"])
+            self.add_vector_query(search_parameters, query_vector)
+
+        with stage("typesense_search"):
+            search_results = await self.async_typesense.search(self.collection, search_parameters)
+
+        videos = [hit["document"] for hit in search_results["hits"]]
+        self.cache_videos(cache_key, videos)
+        return videos
+
+    # Searches every collection registered for the intent (see SEARCH_COLLECTIONS). An intent only served by
+    # videolists is a plain find_related_videos, otherwise all its collections are searched in one multi_search
+    # and the results merged by rank, each tagged with the collection it came from.
+    def find_related_results(self, intent, query_options):
+        collections = self.collections_for(intent)
+        if self.only_searches_videos(collections):
+            return self.find_related_videos(query_options)
+
+        search_parameters = self.build_search_parameters(query_options)
+        if not collections or not search_parameters:
+            return []
+
+        cache_key = self.get_federated_cache_key(intent, collections, query_options)
+        results = self.get_cached_videos(cache_key)
+        if results is not None:
+            return results
+
+        if self.search_flight is None:
+            return self.search_collections(collections, query_options, search_parameters, cache_key)
+        return self.search_flight.do(
+            cache_key, lambda: self.search_collections(collections, query_options, search_parameters, cache_key)
+        )
+
+    def search_collections(self, collections, query_options, search_parameters, cache_key):
+        with stage("typesense_multi_search"):
+            response = self.typesense.multi_search(
+                self.build_federated_searches(collections, query_options, search_parameters)
+            )
+        results = merge_results(collections, response["results"], search_parameters["per_page"])
+        self.cache_videos(cache_key, results)
+        return results
+
+    async def find_related_results_async(self, intent, query_options):
+        collections = await self.collections_for_async(intent)
+        if self.only_searches_videos(collections):
+            return await self.find_related_videos_async(query_options)
+
+        search_parameters = self.build_search_parameters(query_options)
+        if not collections or not search_parameters:
+            return []
+
+        cache_key = self.get_federated_cache_key(intent, collections, query_options)
+        results = self.get_cached_videos(cache_key)
+        if results is not None:
+            return results
+
+        if self.search_flight is None:
+            return await self.search_collections_async(collections, query_options, search_parameters, cache_key)
+        return await self.search_flight.do_async(
+            cache_key, lambda: self.search_collections_async(collections, query_options, search_parameters, cache_key)
+        )
+
+    async def search_collections_async(self, collections, query_options, search_parameters, cache_key):
+        with stage("typesense_multi_search"):
+            response = await self.async_typesense.multi_search(
+                self.build_federated_searches(collections, query_options, search_parameters)
+            )
+        results = merge_results(collections, response["results"], search_parameters["per_page"])
+        self.cache_videos(cache_key, results)
+        return results
+
+    # Batch version of find_related_results for (intent, query_options) pairs. Searches that only need videolists
+    # share find_related_videos_batch's multi_search requests, the others run one multi_search each.
+    def find_related_results_batch(self, searches):
+        results = [None] * len(searches)
+        video_searches = []
+        for position, (intent, query_options) in enumerate(searches):
+            if self.only_searches_videos(self.collections_for(intent)):
+                video_searches.append(position)
+                continue
+            try:
+                results[position] = self.find_related_results(intent, query_options)
+            except TypesenseSearchError as error:
+                results[position] = error
+
+        if video_searches:
+            videos = self.find_related_videos_batch([searches[position][1] for position in video_searches])
+            for position, result in zip(video_searches, videos):
+                results[position] = result
+        return results
+
+    # Looks up the SEARCH_COLLECTIONS other than videolists, a registered collection that hasn't been created yet
+    # is left out of searches instead of failing its half of every multi_search. When Typesense can't be reached
+    # nothing is left out and the lookup runs again on the next search.
+    def check_collections(self):
+        try:
+            missing = {
+                name
+                for name in settings.SEARCH_COLLECTIONS
+                if name != self.collection and not self.typesense.collection_exists(name)
+            }
+        except Exception as error:
+            logger.warning("Could not check the search collections: %s", error)
+            return
+        for name in missing - self.missing_collections:
+            logger.warning("Search collection %s doesn't exist in Typesense, it is left out of searches", name)
+        self.missing_collections = missing
+        self.collections_checked_at = time.monotonic()
+
+    def collections_are_stale(self):
+        return (
+            self.collections_checked_at is None
+            or time.monotonic() - self.collections_checked_at > self.collection_check_seconds
+        )
+
+    def existing_collections(self, intent):
+        return [
+            collection for collection in collections_for_intent(intent)
+            if collection.name not in self.missing_collections
+        ]
+
+    def collections_for(self, intent):
+        if self.collections_are_stale():
+            self.check_collections()
+        return self.existing_collections(intent)
+
+    async def collections_for_async(self, intent):
+        if self.collections_are_stale():
+            await sync_to_async(self.check_collections, thread_sensitive=False)()
+        return self.existing_collections(intent)
+
+    def only_searches_videos(self, collections):
+        return [collection.name for collection in collections] == [self.collection]
+
+    # Bucketed filters are only used on the collections indexed with the bucket fields
+    def build_federated_searches(self, collections, query_options, search_parameters):
+        searches = []
+        for collection in collections:
+            filters = self.plan_filter(
+                query_options.get("view_count") or "",
+                query_options.get("release_date_before") or "",
+                query_options.get("release_date_after") or "",
+                settings.FILTER_FACETS["ENABLED"] and collection.facets,
+            )
+            searches.append(collection.search_parameters(search_parameters, filters))
+        return searches
+
+    def get_federated_cache_key(self, intent, collections, query_options):
+        epochs = tuple(get_collection_epoch(collection.name) for collection in collections)
+        return (intent, epochs) + self.get_cache_key(query_options)[1:]
+
+    # Batch version of find_related_videos for the batch chat endpoint. Identical searches are only run once and
+    # the rest are sent through multi_search, so a whole window of chats costs one Typesense round trip.
+    # Returns one entry per query: a list of videos, or a TypesenseSearchError when only that search failed.
+    def find_related_videos_batch(self, query_options_list):
+        results = [[] for _ in query_options_list]
+        pending = {}
+
+        for position, query_options in enumerate(query_options_list):
+            search_parameters = self.build_search_parameters(query_options)
+            if not search_parameters:
+                continue
+
+            cache_key = self.get_cache_key(query_options)
+            if cache_key in pending:
+                pending[cache_key][1].append(position)
+                continue
+            videos = self.get_cached_videos(cache_key)
+            if videos is None:
+                videos = self.find_video_by_title(query_options)
+            if videos:
+                self.cache_videos(cache_key, videos)
+                results[position] = videos
+                continue
+            if self.uses_vector_search(search_parameters):
+                self.add_vector_query(search_parameters, self.embedder.embed_query(search_parameters["q"]))
+            pending[cache_key] = (search_parameters, [position])
+
+        for chunk in batched(pending.items(), self.max_multi_searches):
+            with stage("typesense_multi_search"):
+                response = self.typesense.multi_search(
+                    [{"collection": self.collection, **search_parameters} for _, (search_parameters, _) in chunk]
+                )
+            for (cache_key, (_, positions)), search_result in zip(chunk, response["results"]):
+                if "error" in search_result:
+                    videos = TypesenseSearchError(search_result["error"])
+                else:
+                    videos = [hit["document"] for hit in search_result["hits"]]
+                    self.cache_videos(cache_key, videos)
+                for position in positions:
+                    results[position] = videos if isinstance(videos, Exception) else list(videos)
+
+        return results
+
+    # A request for one specific video resolves through the title index: a dictionary lookup and a fetch of the
+    # matching document(s) instead of a ranked full-text search. Date and view count filters still apply.
+    def find_video_by_title(self, query_options):
+        document_ids = self.lookup_title(query_options)
+        if not document_ids:
+            return []
+        with stage("title_lookup"):
+            documents = [self.typesense.get_document(self.collection, document_id) for document_id in document_ids]
+        return self.filter_title_matches(query_options, documents)
 
-        if not topic:
+    async def find_video_by_title_async(self, query_options):
+        if not self.title_index or not query_options.get("title"):
             return []
-        
-        filters = self.build_filter(query_options)
+        # Lookups never wait for the index to load, so they stay on the event loop
+        document_ids = self.lookup_title(query_options)
+        if not document_ids:
+            return []
+        with stage("title_lookup"):
+            documents = [
+                await self.async_typesense.get_document(self.collection, document_id) for document_id in document_ids
+            ]
+        return self.filter_title_matches(query_options, documents)
+
+    def lookup_title(self, query_options):
+        if not self.title_index or not query_options.get("title"):
+            return []
+        return self.title_index.lookup(query_options["title"])[:3]
+
+    def filter_title_matches(self, query_options, documents):
+        start, end = self.get_release_range(query_options)
+        view_count = self.parse_view_count(query_options.get("view_count") or "")
+        videos = []
+        for document in documents:
+            if document is None:
+                continue
+            released_date = document.get("released_date", 0)
+            if end is not None and released_date >= end:
+                continue
+            if start is not None and released_date < start:
+                continue
+            if view_count and not view_count(document.get("view_count", 0)):
+                continue
+            videos.append({field: document[field] for field in RESULT_FIELDS if field in document})
+        return sorted(videos, key=lambda video: video.get("view_count", 0), reverse=True)
+
+    # Turns a Typesense style view count filter ('>1000', '<=500', '1000') into a predicate
+    @staticmethod
+    def parse_view_count(view_count):
+        match = re.fullmatch(r"\s*(>=|<=|>|<|=)?\s*(\d+)\s*", view_count)
+        if not match:
+            return None
+        operator, value = match.group(1) or "=", int(match.group(2))
+        return {
+            ">": lambda count: count > value,
+            ">=": lambda count: count >= value,
+            "<": lambda count: count < value,
+            "<=": lambda count: count <= value,
+            "=": lambda count: count == value,
+        }[operator]
+
+    # Searches that only differ in casing/whitespace share an entry. The collection epoch changes on every
+    # re-index, so results cached before it are simply never looked up again and age out.
+    def get_cache_key(self, query_options):
+        return (
+            get_collection_epoch(self.collection),
+            re.sub(r"\s+", " ", (query_options.get("topic") or "").strip().lower()),
+            re.sub(r"\s+", " ", (query_options.get("title") or "").strip().lower()),
+            re.sub(r"\s+", "", query_options.get("view_count") or ""),
+            (query_options.get("release_date_before") or "").strip(),
+            (query_options.get("release_date_after") or "").strip(),
+        )
+
+    def get_cached_videos(self, cache_key):
+        if self.result_cache is None:
+            return None
+        videos = self.result_cache.get(cache_key)
+        return list(videos) if videos is not None else None
+
+    def cache_videos(self, cache_key, videos):
+        if self.result_cache is not None:
+            self.result_cache.set(cache_key, list(videos))
+
+    def build_search_parameters(self, query_options):
+        # A title that isn't in the index is still searched for, as a regular topic
+        topic = query_options.get('topic') or query_options.get('title') or ""
 
-        search_parameters = {
-            "q": topic,
+        with stage("filter_build"):
+            filters = self.build_filter(query_options)
+
+        # Without a topic, a date or view count filter alone still narrows down the results ("videos from 2023")
+        if not topic and not filters:
+            return None
+
+        return {
+            "q": topic or "*",
             "query_by": "titles, tags, description",
             "query_by_weight": "3, 2, 1",
             "split_join_tokens": "true",
@@ -24,47 +417,87 @@ class VideoSearchService:
             "sort_by": "view_count:desc",
             "num_typos": 2,
             "per_page": 3,
-            "include_fields": "id, titles, thumbnail_height, thumbnail_width, thumbnail_url, view_count, released_date",
+            "include_fields": ", ".join(RESULT_FIELDS),
         }
-        search_results = self.typesense.client.collections["videolists"].documents.search(
-            search_parameters
+
+    def uses_vector_search(self, search_parameters):
+        return self.embedder is not None and search_parameters["q"] != "*"
+
+    # Hybrid search: Typesense ranks by keywords and by distance to the topic's embedding and fuses both scores
+    # (alpha is the weight of the vector side), so related videos that don't share a keyword still match.
+    # The fused score then decides the order instead of the view count alone.
+    @staticmethod
+    def add_vector_query(search_parameters, query_vector):
+        config = settings.VECTOR_SEARCH
+        vector = ",".join(str(value) for value in query_vector)
+        search_parameters["vector_query"] = (
+            f"embedding:([{vector}], k: {config['K']}, alpha: {config['ALPHA']}, "
+            f"distance_threshold: {config['DISTANCE_THRESHOLD']})"
         )
+        search_parameters["sort_by"] = "_text_match:desc,view_count:desc"
 
-        return [hit["document"] for hit in search_results["hits"]]
-    
     def build_filter(self, query_options):
+        return self.plan_filter(
+            query_options.get("view_count") or "",
+            query_options.get("release_date_before") or "",
+            query_options.get("release_date_after") or "",
+            settings.FILTER_FACETS["ENABLED"],
+        )
+
+    # The filter only depends on these values, so the string (and its date parsing) is memoized. With facets the
+    # ranges are mostly turned into equality filters on the bucket fields (see chatbot.services.facets).
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def plan_filter(view_count, release_date_before, release_date_after, use_facets=False):
         filter_parts = []
+        start, end = VideoSearchService.get_release_range(
+            {
+                "release_date_before": release_date_before,
+                "release_date_after": release_date_after,
+            }
+        )
 
-        if query_options["view_count"]:
-            filter_parts.append(f'view_count:{query_options['view_count']}')
-        
-        unix_time = self.convert_to_unix_timestamp(query_options)
+        if use_facets:
+            if view_count:
+                filter_parts.append(plan_view_count_filter(view_count))
+            if start is not None or end is not None:
+                filter_parts.append(plan_release_date_filter(start, end))
+            return " && ".join(filter_parts)
 
-        if unix_time:
-            filter_parts.append(
-                f'released_date:<={unix_time['release_date_before']}'
-            )
-            filter_parts.append(
-                f'released_date:>={unix_time['release_date_after']}'
-            )
+        if view_count:
+            filter_parts.append(f'view_count:{view_count}')
+        if end is not None:
+            filter_parts.append(f'released_date:<{end}')
+        if start is not None:
+            filter_parts.append(f'released_date:>={start}')
 
         return " && ".join(filter_parts)
 
+    # Release dates are whole days: a video matches from the start of release_date_after up to the end of
+    # release_date_before, as a [start, end) range in unix seconds (None for an open side)
+    @staticmethod
+    def get_release_range(query_options):
+        unix_time = VideoSearchService.convert_to_unix_timestamp(query_options)
+        end = unix_time.get("release_date_before")
+        return unix_time.get("release_date_after"), end + 24 * 60 * 60 if end is not None else None
+
     # Typesense is currently storing release_date value as UNIX so we need to convert the ISO time we're receiving from Gemini into UNIX with this method.
     # I'm not expliciting asking Gemini to return the query dates as UNIX because the prompt is not providing accurate UNIX time.
-    def convert_to_unix_timestamp(self, time):
+    # released_date holds UTC timestamps, so the dates are read as UTC midnight whatever the server's time zone is.
+    @staticmethod
+    def convert_to_unix_timestamp(time):
         formatted_time = {}
-        if time["release_date_before"]:
+        if time.get("release_date_before"):
             formatted_time["release_date_before"] = int(
                 datetime.strptime(
                     f'{time['release_date_before']} 00:00:00', "%Y-%m-%d %H:%M:%S"
-                ).timestamp()
+                ).replace(tzinfo=timezone.utc).timestamp()
             )
-        if time["release_date_after"]:
+        if time.get("release_date_after"):
             formatted_time["release_date_after"] = int(
                 datetime.strptime(
                     f'{time['release_date_after']} 00:00:00', "%Y-%m-%d %H:%M:%S"
-                ).timestamp()
+                ).replace(tzinfo=timezone.utc).timestamp()
             )
 
         return formatted_time
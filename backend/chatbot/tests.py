@@ -2,11 +2,109 @@ from django.urls import reverse
 from rest_framework.test import APITestCase, APIClient
 from knox.auth import AuthToken
 from rest_framework import status
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 from django.contrib.auth import get_user_model
+from django.conf import settings
+from django.test import SimpleTestCase, override_settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from typesense.exceptions import ObjectNotFound, RequestMalformed, ServiceUnavailable
+from types import SimpleNamespace
+from google.api_core import exceptions as google_exceptions
+import asyncio
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+import numpy as np
+from datetime import date
+
+from chatbot.clients.admission import AdmissionController, AdmissionRejected, Tier, current_ticket
+from chatbot.clients.chat_session_pool import ChatSessionPool
+from chatbot.clients.gemini_client import GeminiClient
+from chatbot.clients.transport import CircuitOpenError, Transport, TransportBusyError, TransportUnavailable, transports
+from chatbot.clients.typesense_client import TypesenseClient, TypesenseSearchError
+from chatbot.services.intent_classifier import IntentClassifier
+from chatbot.services.prompts import Prompts, count_tokens, create_video_search_examples
+from chatbot.services.collection_epoch import bump_collection_epoch
+from chatbot.services.conversation_store import ConversationStore
+from chatbot.services.embeddings import LocalEmbedder
+from chatbot.services.facets import add_facets
+from chatbot.services.title_index import TitleIndex
+from chatbot.services.video_search import VideoSearchService
+from chatbot.services.video_indexer import VideoIndexer, create_videolists_schema
+from chatbot.services.video_reindexer import ChangeTracker, delete_documents
+from chatbot.services.response_cache import InProcessCacheBackend, ResponseCache, SemanticIndex
+from chatbot.benchmarks.fakes import FakeGenerativeModel, FakeTypesenseServer, InMemorySearchEngine, generate_corpus
+from chatbot.benchmarks.harness import build_views, find_regressions, run_scenario
+from chatbot.benchmarks.startup import parse_importtime, summarize_imports
+from chatbot.checks import check_cache_tables, check_conversation_owner, check_shared_caches, ensure_shared_caches
+from chatbot.services.batch_chat import BatchChatProcessor
+from chatbot.views import ChatAPI, ChatStreamAPI, AsyncChatAPI
+from chatbot.utils.response_parser import JSONObjectExtractor, ResponseFormatError, ResponseParser
+from chatbot.utils.lazy_client import LazyClient, clients, warm_up_clients
+from chatbot.utils.single_flight import SingleFlight
 
 User = get_user_model()
 
+# SimpleTestCases can't use the database cache, and the tests run in one process anyway
+LOCAL_CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "shared": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "shared"},
+}
+
+
+# The fake model used as the Gemini client itself, for views tested without the transport and admission
+class StubGeminiClient(FakeGenerativeModel):
+    def __init__(self, delay=0.5):
+        super().__init__(latency=delay, tokens_per_second=float("inf"))
+
+    def send_message(self, prompt, session_key=None):
+        return self.generate_content(prompt)
+
+    # Splits the canned response into a few chunks spread over the delay
+    def stream_content(self, prompt, chunks=4):
+        text = self.respond(prompt)
+        size = -(-len(text) // chunks)
+        for start in range(0, len(text), size):
+            time.sleep(self.latency / chunks)
+            yield text[start:start + size]
+
+
+class StubVideoSearchService:
+    documents = [
+        {
+            "id": "9d2ecec7-aa6a-4f95-9f5d-9f57fe2a7e3e",
+            "released_date": 1712192027,
+            "thumbnail_height": 360,
+            "thumbnail_url": "https://i.ytimg.com/vi/8S0FDjFBj8o/hqdefault.jpg",
+            "thumbnail_width": 480,
+            "titles": ["How to sound smart in your TEDx Talk | Will Stephen | TEDxNewYork"],
+            "view_count": 13854313,
+        }
+    ]
+
+    def find_related_videos(self, query_options):
+        return list(self.documents)
+
+    async def find_related_videos_async(self, query_options):
+        return list(self.documents)
+
+    def find_related_videos_batch(self, query_options_list):
+        return [list(self.documents) for _ in query_options_list]
+
+    def find_related_results(self, intent, query_options):
+        return self.find_related_videos(query_options)
+
+    async def find_related_results_async(self, intent, query_options):
+        return await self.find_related_videos_async(query_options)
+
+    def find_related_results_batch(self, searches):
+        return self.find_related_videos_batch([query_options for _, query_options in searches])
+
 
 class VosynAssist(APITestCase):
     @classmethod
@@ -128,7 +226,7 @@ class VosynAssist(APITestCase):
             },
         ]
 
-    @patch("vosyn_assist.clients.typesense_client.TypesenseClient")
+    @patch("chatbot.clients.typesense_client.TypesenseClient")
     def test_retrieve_response_from_vosyn_assist(self, mock_typesense_client):
         self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token)
 
@@ -163,3 +261,1774 @@ class VosynAssist(APITestCase):
         self.assertIsInstance(response.data["text_response"], str)
         self.assertTrue(len(response.data["text_response"]) > 0)
         self.assertEqual(response.data["video_results"], [])
+
+
+@override_settings(FAST_PATH_ENABLED=False)
+class SingleCallExtraction(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="b@b.com", password="b@b12345")
+        cls.token = AuthToken.objects.create(cls.user)[1]
+
+    def setUp(self):
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token)
+        self.gemini_client = StubGeminiClient(delay=0)
+
+    @patch.object(ChatAPI, "response_cache", None)
+    @patch.object(ChatAPI, "video_search_service", StubVideoSearchService())
+    def test_find_video_uses_one_gemini_call(self):
+        with patch.object(ChatAPI, "gemini_client", self.gemini_client), override_settings(
+            GEMINI_SINGLE_CALL_EXTRACTION=True
+        ):
+            response = self.client.post(
+                reverse("chat"), {"prompt": "can you find me ted talk videos"}, format="json"
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.gemini_client.calls, 1)
+        self.assertTrue(response.data["video_results"])
+
+    @patch.object(ChatAPI, "response_cache", None)
+    @patch.object(ChatAPI, "video_search_service", StubVideoSearchService())
+    def test_two_call_mode_still_available(self):
+        with patch.object(ChatAPI, "gemini_client", self.gemini_client), override_settings(
+            GEMINI_SINGLE_CALL_EXTRACTION=False
+        ):
+            response = self.client.post(
+                reverse("chat"), {"prompt": "can you find me ted talk videos"}, format="json"
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.gemini_client.calls, 2)
+
+
+class FakeChat:
+    def __init__(self):
+        self.history = []
+
+    def send_message(self, prompt):
+        part = SimpleNamespace(text=prompt)
+        self.history += [SimpleNamespace(parts=[part]), SimpleNamespace(parts=[part])]
+        return part
+
+
+class ChatSessionPoolTests(SimpleTestCase):
+    def setUp(self):
+        self.model = SimpleNamespace(start_chat=FakeChat)
+
+    def test_evicts_least_recently_used_session(self):
+        pool = ChatSessionPool(self.model, max_sessions=2)
+        pool.send_message("a", "hi")
+        pool.send_message("b", "hi")
+        pool.send_message("a", "hi again")
+        pool.send_message("c", "hi")
+
+        self.assertEqual(list(pool.sessions), ["a", "c"])
+
+    def test_history_is_trimmed_to_token_budget(self):
+        pool = ChatSessionPool(self.model, max_history_tokens=50)
+        for _ in range(10):
+            pool.send_message("a", "x" * 40)
+
+        history = pool.sessions["a"].chat.history
+        self.assertLessEqual(ChatSessionPool.count_tokens(history), 50)
+        self.assertEqual(len(history) % 2, 0)
+
+
+@override_settings(FAST_PATH_ENABLED=False)
+class AsyncChatTests(SimpleTestCase):
+    def setUp(self):
+        self.view = AsyncChatAPI()
+        self.view.gemini_client = StubGeminiClient(delay=0)
+        self.view.video_search_service = StubVideoSearchService()
+        self.view.response_cache = None
+
+    async def test_find_video_returns_results(self):
+        response_data = await self.view.generate_response("can you find me ted talk videos", "")
+
+        self.assertTrue(response_data["video_results"])
+        self.assertTrue(len(response_data["text_response"]) > 0)
+
+    @override_settings(GEMINI_SINGLE_CALL_EXTRACTION=False)
+    async def test_two_call_mode_requests_query_options_concurrently(self):
+        response_data = await self.view.generate_response("can you find me ted talk videos", "")
+
+        self.assertEqual(self.view.gemini_client.calls, 2)
+        self.assertTrue(response_data["video_results"])
+
+    @override_settings(GEMINI_SINGLE_CALL_EXTRACTION=False)
+    async def test_two_call_mode_skips_the_speculative_call_for_prompts_that_cannot_be_searches(self):
+        self.view.gemini_client.initial_response = {"intent": "chat", "summary": "A joke.", "response": "Knock knock."}
+
+        response_data = await self.view.generate_response("tell me a joke", "")
+
+        self.assertEqual(self.view.gemini_client.calls, 1)
+        self.assertEqual(response_data["text_response"], "Knock knock.")
+
+    @override_settings(GEMINI_SINGLE_CALL_EXTRACTION=False)
+    async def test_the_speculative_call_is_cancelled_when_the_initial_call_fails(self):
+        async def fail(*args):
+            raise TransportUnavailable(1)
+
+        self.view.send_prompt = fail
+        with self.assertRaises(TransportUnavailable):
+            await self.view.generate_response("can you find me ted talk videos", "")
+
+        pending = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        self.assertEqual(pending, [])
+
+
+class ResponseCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = ResponseCache(InProcessCacheBackend(max_entries=10, ttl=60))
+        self.gemini_client = StubGeminiClient(delay=0)
+
+    def generate(self):
+        return self.gemini_client.generate_content("find me ted talks about ai")
+
+    def test_normalised_prompts_share_an_entry(self):
+        self.cache.get_or_generate("Find me TED talks about AI", "", self.generate)
+        response = self.cache.get_or_generate("  find me ted talks   about ai? ", "", self.generate)
+
+        self.assertEqual(self.gemini_client.calls, 1)
+        self.assertIn("find video", response.text)
+        self.assertEqual(self.cache.stats()["exact_hits"], 1)
+        self.assertEqual(self.cache.stats()["misses"], 1)
+
+    def test_semantic_lookup_reuses_similar_prompt(self):
+        embeddings = {"\nfind me ted talks about ai": [1.0, 0.0], "\nfind ted talks about ai": [0.99, 0.05]}
+        self.cache.semantic_index = SemanticIndex(embeddings.get, 0.95, max_entries=10, ttl=60)
+
+        self.cache.get_or_generate("find me ted talks about AI", "", self.generate)
+        self.cache.get_or_generate("find ted talks about AI", "", self.generate)
+
+        self.assertEqual(self.gemini_client.calls, 1)
+        self.assertEqual(self.cache.stats()["semantic_hits"], 1)
+
+    def test_entries_do_not_outlive_the_day(self):
+        with patch("chatbot.services.response_cache.date") as today:
+            today.today.return_value = date(2024, 10, 29)
+            self.cache.get_or_generate("find me videos from last week", "", self.generate)
+            today.today.return_value = date(2024, 10, 30)
+            self.cache.get_or_generate("find me videos from last week", "", self.generate)
+
+        self.assertEqual(self.gemini_client.calls, 2)
+
+    def test_semantic_index_finds_the_closest_prompt_among_many(self):
+        vectors = np.random.default_rng(0).normal(size=(3000, 768))
+        index = SemanticIndex(lambda text: vectors[int(text)], 0.95, max_entries=2000, ttl=60)
+        for number, vector in enumerate(vectors):
+            index.add(f"key-{number}", vector)
+
+        start = time.perf_counter()
+        key, _ = index.lookup("2500")
+
+        self.assertEqual(key, "key-2500")
+        self.assertLess(time.perf_counter() - start, 0.05)
+        # The oldest entries made room for the newest
+        self.assertIsNone(index.lookup("10")[0])
+        self.assertIsNone(index.lookup("2500", scope="tomorrow")[0])
+
+    def test_embeddings_are_admitted_and_go_through_the_transport(self):
+        client = GeminiClient.__new__(GeminiClient)
+        client.embedding_model = MagicMock()
+        client.admission = make_admission_controller(burst=10)
+        client.transport = MagicMock()
+        client.transport.call.return_value = [SimpleNamespace(values=[0.1, 0.2])]
+
+        self.assertEqual(client.embed("find me ted talks"), [0.1, 0.2])
+        client.transport.call.assert_called_once_with(client.embedding_model.get_embeddings, ["find me ted talks"])
+        self.assertLess(client.admission.bucket.tokens, 10)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class VideoSearchCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.service = VideoSearchService()
+        self.service.typesense = MagicMock()
+        self.search = self.service.typesense.search
+        self.search.return_value = {"hits": [{"document": {"id": "1", "titles": ["TED"]}}]}
+        self.query_options = {"topic": "TED talks", "view_count": "", "release_date_before": "", "release_date_after": ""}
+
+    def test_repeated_search_is_served_from_cache(self):
+        self.service.find_related_videos(self.query_options)
+        videos = self.service.find_related_videos({**self.query_options, "topic": "  ted   TALKS "})
+
+        self.assertEqual(self.search.call_count, 1)
+        self.assertEqual(videos, [{"id": "1", "titles": ["TED"]}])
+
+    def test_reindex_invalidates_cached_results(self):
+        self.service.find_related_videos(self.query_options)
+        bump_collection_epoch("videolists")
+        self.service.find_related_videos(self.query_options)
+
+        self.assertEqual(self.search.call_count, 2)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class FederatedSearchTests(SimpleTestCase):
+    def setUp(self):
+        self.service = VideoSearchService()
+        self.service.result_cache = None
+        self.service.typesense = MagicMock()
+        self.query_options = {"topic": str(uuid.uuid4()), "view_count": ">1000", "release_date_before": "", "release_date_after": ""}
+
+    def hits(self, *ids):
+        return {"hits": [{"document": {"id": document_id, "view_count": 10}} for document_id in ids]}
+
+    def test_podcast_requests_search_every_collection_in_one_request(self):
+        self.service.typesense.multi_search.return_value = {"results": [self.hits("v1", "v2"), self.hits("p1")]}
+
+        results = self.service.find_related_results("find podcast", self.query_options)
+
+        searches = self.service.typesense.multi_search.call_args[0][0]
+        self.assertEqual([search["collection"] for search in searches], ["videolists", "podcasts"])
+        self.assertTrue(all(search["search_cutoff_ms"] == 200 for search in searches))
+        # The podcasts collection is weighted up, so its first hit goes before the first video
+        self.assertEqual([(result["collection"], result["id"]) for result in results], [
+            ("podcasts", "p1"), ("videolists", "v1"), ("videolists", "v2"),
+        ])
+        self.service.typesense.search.assert_not_called()
+
+    @override_settings(FILTER_FACETS={**settings.FILTER_FACETS, "ENABLED": True})
+    def test_bucketed_filters_are_only_used_on_collections_with_facets(self):
+        self.service.typesense.multi_search.return_value = {"results": [self.hits("v1"), self.hits()]}
+
+        self.service.find_related_results("find podcast", self.query_options)
+
+        searches = self.service.typesense.multi_search.call_args[0][0]
+        self.assertEqual(searches[0]["filter_by"], "(view_count:[1001..9999] || view_tier:[2,3,4,5])")
+        self.assertEqual(searches[1]["filter_by"], "view_count:>1000")
+
+    def test_a_failed_collection_is_left_out(self):
+        self.service.typesense.multi_search.return_value = {
+            "results": [self.hits("v1"), {"error": "Not found.", "code": 404}]
+        }
+
+        results = self.service.find_related_results("find podcast", self.query_options)
+
+        self.assertEqual([result["id"] for result in results], ["v1"])
+
+        self.service.typesense.multi_search.return_value = {
+            "results": [{"error": "Not found.", "code": 404}, {"error": "Not found.", "code": 404}]
+        }
+        with self.assertRaises(TypesenseSearchError):
+            self.service.find_related_results("find podcast", {**self.query_options, "topic": "other"})
+
+    def test_collections_that_dont_exist_are_left_out_until_they_are_created(self):
+        self.service.typesense.collection_exists.return_value = False
+        self.service.typesense.search.return_value = self.hits("v1")
+
+        self.assertEqual(self.service.find_related_results("find podcast", self.query_options), [{"id": "v1", "view_count": 10}])
+        self.service.typesense.collection_exists.assert_called_once_with("podcasts")
+        self.service.typesense.multi_search.assert_not_called()
+
+        self.service.typesense.collection_exists.return_value = True
+        self.service.typesense.multi_search.return_value = {"results": [self.hits("v1"), self.hits("p1")]}
+        self.service.collections_checked_at -= self.service.collection_check_seconds + 1
+
+        results = self.service.find_related_results("find podcast", {**self.query_options, "topic": "other"})
+
+        self.assertEqual([result["id"] for result in results], ["p1", "v1"])
+
+    def test_video_requests_keep_the_single_collection_search(self):
+        self.service.typesense.search.return_value = self.hits("v1")
+
+        self.assertEqual(self.service.find_related_results("find video", self.query_options), [{"id": "v1", "view_count": 10}])
+        self.service.typesense.multi_search.assert_not_called()
+
+    def test_podcast_intent_returns_results(self):
+        view = ChatAPI()
+        view.video_search_service = StubVideoSearchService()
+        response = view.build_response(
+            {"intent": "find podcast", "summary": "", "response": "Here are some podcasts I found.", "query_options": self.query_options},
+            "find me podcasts about space",
+        )
+
+        self.assertEqual(response.data["text_response"], "Here are some podcasts I found.")
+        self.assertEqual(response.data["video_results"], StubVideoSearchService.documents)
+
+
+class FilterFacetsTests(SimpleTestCase):
+    def plan(self, view_count="", before="", after=""):
+        return VideoSearchService.plan_filter(view_count, before, after, True)
+
+    def test_dates_are_read_as_utc(self):
+        self.assertEqual(
+            VideoSearchService.convert_to_unix_timestamp({"release_date_after": "2023-01-01"}),
+            {"release_date_after": 1672531200},
+        )
+        self.assertEqual(
+            VideoSearchService.plan_filter("", "2023-12-31", "2023-01-01"),
+            "released_date:<1704067200 && released_date:>=1672531200",
+        )
+
+    def test_documents_get_bucket_fields(self):
+        document = add_facets({"released_date": 1710460800, "view_count": 25000})
+
+        self.assertEqual((document["release_year"], document["release_month"], document["view_tier"]), (2024, 202403, 2))
+
+    def test_whole_years_and_months_become_equality_filters(self):
+        self.assertEqual(self.plan(before="2023-12-31", after="2023-01-01"), "release_year:[2023]")
+        self.assertEqual(
+            self.plan(before="2023-04-30", after="2021-11-01"),
+            "(release_month:[202111,202112] || release_year:[2022] || release_month:[202301,202302,202303,202304])",
+        )
+        self.assertEqual(
+            self.plan(after="2021-03-15"),
+            "(released_date:[1615766400..1617235199] || release_month:[202104,202105,202106,202107,202108,202109,"
+            "202110,202111,202112] || release_year:>=2022)",
+        )
+        self.assertEqual(self.plan(before="2024-10-29", after="2024-10-22"), "released_date:>=1729555200 && released_date:<1730246400")
+
+    def test_view_counts_use_tiers(self):
+        self.assertEqual(self.plan(">=1000"), "view_tier:[1,2,3,4,5]")
+        self.assertEqual(self.plan(">1500000"), "(view_count:[1500001..9999999] || view_tier:[5])")
+        self.assertEqual(self.plan("<500"), "view_count:[0..499]")
+        self.assertEqual(self.plan("<=100000"), "(view_tier:[0,1,2] || view_count:[100000..100000])")
+        self.assertEqual(self.plan("1000"), "view_count:1000")
+
+    def test_facet_filters_match_the_same_documents_as_ranges(self):
+        engine = InMemorySearchEngine(generate_corpus(2000, seed=1))
+        today = date.today()
+        cases = [
+            (">1000", "", ""),
+            ("<=25000", "", ""),
+            ("", f"{today.year - 2}-12-31", f"{today.year - 2}-01-01"),
+            (">=100000", f"{today.year - 1}-06-30", f"{today.year - 5}-03-15"),
+            ("<5000", f"{today.year - 3}-02-10", ""),
+            ("", "", f"{today.year - 1}-07-04"),
+        ]
+        for view_count, before, after in cases:
+            found = [
+                engine.search({"q": "*", "filter_by": VideoSearchService.plan_filter(view_count, before, after, use_facets)})["found"]
+                for use_facets in (False, True)
+            ]
+            self.assertEqual(found[0], found[1], (view_count, before, after))
+            self.assertTrue(found[0])
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class SingleFlightTests(SimpleTestCase):
+    def run_concurrently(self, count, target):
+        results = [None] * count
+
+        def run(number):
+            try:
+                results[number] = target(number)
+            except Exception as error:
+                results[number] = error
+
+        threads = [threading.Thread(target=run, args=(number,)) for number in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def wait_for_followers(self, flight, count):
+        deadline = time.monotonic() + 5
+        while flight.stats()["coalesced"] < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_concurrent_calls_share_one_execution(self):
+        flight = SingleFlight("test")
+        release = threading.Event()
+        calls = []
+
+        def call():
+            calls.append(1)
+            release.wait(5)
+            return {"videos": [1, 2]}
+
+        threads, results = self.run_concurrently(6, lambda number: flight.do("key", call))
+        self.wait_for_followers(flight, 5)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"videos": [1, 2]}] * 6)
+        self.assertEqual(flight.stats(), {"calls": 6, "coalesced": 5, "coalescing_ratio": 0.8333})
+        # The key is released once the call is done, a later call runs again
+        flight.do("key", call)
+        self.assertEqual(len(calls), 2)
+
+    def test_followers_get_the_leaders_exception(self):
+        flight = SingleFlight("test")
+        release = threading.Event()
+
+        def call():
+            release.wait(5)
+            raise TypesenseSearchError("search failed")
+
+        threads, results = self.run_concurrently(3, lambda number: flight.do("key", call))
+        self.wait_for_followers(flight, 2)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertTrue(all(isinstance(result, TypesenseSearchError) for result in results))
+
+    def test_followers_run_the_call_themselves_when_the_leader_was_rejected_by_admission(self):
+        flight = SingleFlight("test", unshared_errors=(AdmissionRejected,))
+        release = threading.Event()
+        calls = []
+
+        def call():
+            calls.append(1)
+            if len(calls) == 1:
+                release.wait(5)
+                raise AdmissionRejected("leader's quota", retry_after=3)
+            # The follower that took over waits for the other one to follow it
+            self.wait_for_followers(flight, 3)
+            return "response"
+
+        leader, results = self.run_concurrently(1, lambda number: flight.do("key", call))
+        while not calls:
+            time.sleep(0.01)
+        followers, follower_results = self.run_concurrently(2, lambda number: flight.do("key", call))
+        self.wait_for_followers(flight, 2)
+        release.set()
+        for thread in leader + followers:
+            thread.join()
+
+        self.assertIsInstance(results[0], AdmissionRejected)
+        self.assertEqual(follower_results, ["response", "response"])
+        # One of the followers took over as leader, the other shared its call
+        self.assertEqual(len(calls), 2)
+
+    def test_followers_stop_waiting_at_their_deadline(self):
+        flight = SingleFlight("test")
+        release = threading.Event()
+        started = threading.Event()
+
+        def call():
+            started.set()
+            release.wait(5)
+            return "response"
+
+        leader = threading.Thread(target=flight.do, args=("key", call))
+        leader.start()
+        started.wait(5)
+        try:
+            start = time.monotonic()
+            with self.assertRaises(TimeoutError):
+                flight.do("key", call, timeout=0.05)
+            self.assertLess(time.monotonic() - start, 1)
+        finally:
+            release.set()
+            leader.join()
+
+    async def test_coroutine_followers_run_the_call_themselves_when_the_leader_was_rejected(self):
+        flight = SingleFlight("test", unshared_errors=(AdmissionRejected,))
+        calls = []
+
+        async def call():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            if len(calls) == 1:
+                raise AdmissionRejected("leader's quota", retry_after=3)
+            return "response"
+
+        results = await asyncio.gather(*(flight.do_async("key", call) for _ in range(3)), return_exceptions=True)
+
+        self.assertIsInstance(results[0], AdmissionRejected)
+        self.assertEqual(results[1:], ["response", "response"])
+        self.assertEqual(len(calls), 2)
+
+    async def test_coroutine_followers_stop_waiting_at_their_deadline(self):
+        flight = SingleFlight("test")
+        release = asyncio.Event()
+
+        async def call():
+            await release.wait()
+            return "response"
+
+        leader = asyncio.ensure_future(flight.do_async("key", call))
+        await asyncio.sleep(0)
+        with self.assertRaises(TimeoutError):
+            await flight.do_async("key", call, timeout=0.05)
+        # The leader's call isn't cancelled by the follower giving up
+        release.set()
+        self.assertEqual(await leader, "response")
+
+    async def test_concurrent_coroutines_share_one_execution(self):
+        flight = SingleFlight("test")
+        calls = []
+
+        async def call():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "response"
+
+        results = await asyncio.gather(*(flight.do_async("key", call) for _ in range(4)))
+
+        self.assertEqual(results, ["response"] * 4)
+        self.assertEqual(len(calls), 1)
+
+    def test_shared_mode_reuses_another_workers_result(self):
+        # Two instances stand in for two worker processes sharing the Django cache
+        key = str(uuid.uuid4())
+        worker, other_worker = SingleFlight("test", shared=True), SingleFlight("test", shared=True, poll_interval=0.01)
+        release = threading.Event()
+        calls = []
+
+        def call():
+            calls.append(1)
+            release.wait(5)
+            return "response"
+
+        leader = threading.Thread(target=worker.do, args=(key, call))
+        leader.start()
+        while not calls:
+            time.sleep(0.01)
+        threads, results = self.run_concurrently(1, lambda number: other_worker.do(key, call))
+        time.sleep(0.05)
+        release.set()
+        leader.join()
+        threads[0].join()
+
+        self.assertEqual(results, ["response"])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(other_worker.stats()["coalesced"], 1)
+
+    def test_identical_chat_requests_share_one_generation(self):
+        view = ChatAPI()
+        view.gemini_client = StubGeminiClient(delay=0.1)
+        view.response_cache = None
+        view.gemini_flight = SingleFlight("test")
+        prompts = ["find me ted talks about AI", "  Find me TED talks about ai? "]
+
+        threads, results = self.run_concurrently(
+            4, lambda number: view.send_prompt("prompt", prompts[number % 2], "")
+        )
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(view.gemini_client.calls, 1)
+        self.assertEqual(len({id(result) for result in results}), 1)
+
+    def test_identical_searches_share_one_typesense_call(self):
+        service = VideoSearchService()
+        service.result_cache = None
+        service.search_flight = SingleFlight("test")
+        service.typesense = MagicMock()
+
+        def search(collection, parameters):
+            time.sleep(0.1)
+            return {"hits": [{"document": {"id": "1"}}]}
+
+        service.typesense.search.side_effect = search
+        query_options = {"topic": str(uuid.uuid4()), "view_count": "", "release_date_before": "", "release_date_after": ""}
+
+        threads, results = self.run_concurrently(4, lambda number: service.find_related_videos(query_options))
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(service.typesense.search.call_count, 1)
+        self.assertEqual(results, [[{"id": "1"}]] * 4)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class TitleIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.documents = [
+            {"id": "1", "titles": ["How to sound smart in your TEDx Talk | Will Stephen | TEDxNewYork"]},
+            {"id": "2", "titles": ["La photographie pour déjouer clichés et représentations"]},
+        ]
+        self.client = MagicMock()
+        self.export = self.client.export_documents
+        self.export.side_effect = lambda collection, params: iter(self.documents)
+        self.service = VideoSearchService()
+        self.service.result_cache = None
+        self.service.title_index = TitleIndex(self.client, "videolists")
+        self.service.title_index.refresh()
+        self.service.typesense = MagicMock()
+        self.service.typesense.get_document.return_value = {"id": "1", "titles": ["TEDx"], "view_count": 10, "description": "..."}
+
+    def test_exact_title_skips_full_text_search(self):
+        videos = self.service.find_related_videos(
+            {"topic": "", "title": "how to sound smart in your tedx talk  will stephen tedxnewyork"}
+        )
+
+        self.service.typesense.search.assert_not_called()
+        self.service.typesense.get_document.assert_called_once_with("videolists", "1")
+        self.assertEqual(videos, [{"id": "1", "titles": ["TEDx"], "view_count": 10}])
+
+    def test_titles_are_normalised(self):
+        self.assertEqual(self.service.title_index.lookup("la PHOTOGRAPHIE pour dejouer clichés et representations!"), ["2"])
+
+    def test_unknown_title_falls_back_to_search(self):
+        self.service.typesense.search.return_value = {"hits": []}
+
+        self.service.find_related_videos({"topic": "", "title": "Some other video"})
+
+        self.assertEqual(self.service.typesense.search.call_args[0][1]["q"], "Some other video")
+
+    def test_index_reloads_after_reindex(self):
+        self.service.title_index.lookup("anything")
+        bump_collection_epoch("videolists")
+        self.service.title_index.lookup("anything")
+        self.service.title_index.thread.join()
+
+        self.assertEqual(self.export.call_count, 2)
+
+    def test_lookups_use_search_while_the_index_loads(self):
+        loading = threading.Event()
+
+        def export(collection, params):
+            loading.wait()
+            return iter(self.documents)
+
+        self.export.side_effect = export
+        title_index = self.service.title_index = TitleIndex(self.client, "videolists")
+        self.service.typesense.search.return_value = {"hits": []}
+
+        self.service.find_related_videos({"topic": "", "title": "How to sound smart in your TEDx Talk"})
+        loading.set()
+        title_index.thread.join()
+
+        self.service.typesense.search.assert_called_once()
+        self.assertTrue(title_index.ready)
+        self.assertEqual(title_index.lookup("How to sound smart in your TEDx Talk | Will Stephen | TEDxNewYork"), ["1"])
+
+    def test_export_is_streamed_from_typesense(self):
+        documents = generate_corpus(50)
+        with FakeTypesenseServer(documents) as server, override_settings(TYPESENSE_CONFIG=server.config()):
+            exported = list(TypesenseClient().export_documents("videolists", {"include_fields": "id,titles"}))
+
+        self.assertEqual([document["id"] for document in exported], [document["id"] for document in documents])
+
+
+@override_settings(FAST_PATH_ENABLED=False)
+class ConversationStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.view = ChatAPI()
+        self.view.gemini_client = StubGeminiClient(delay=0)
+        self.view.gemini_client.send_message = MagicMock(wraps=self.view.gemini_client.send_message)
+        self.view.video_search_service = StubVideoSearchService()
+        self.view.response_cache = None
+        self.view.conversation_store = ConversationStore(max_turns=2)
+        self.user = SimpleNamespace(pk=1)
+        self.conversation_id = str(uuid.uuid4())
+
+    def chat(self, prompt, summary=""):
+        data = {"prompt": prompt, "conversation_id": self.conversation_id, "summary": summary}
+        return self.view.post(SimpleNamespace(data=data, user=self.user))
+
+    def test_prompts_carry_the_stored_state_instead_of_the_summary(self):
+        self.chat("can you find me ted talk videos")
+        response = self.chat("only the ones from 2022", summary="a summary the client kept")
+
+        prompt = self.view.gemini_client.send_message.call_args[0][0]
+        self.assertIn("Previous requests: 'can you find me ted talk videos' (find video)", prompt)
+        self.assertIn("Last video search: topic=ted talk", prompt)
+        self.assertNotIn("a summary the client kept", prompt)
+        self.assertEqual(self.view.gemini_client.calls, 2)
+        self.assertEqual(response.data["conversation_id"], self.conversation_id)
+        self.assertTrue(response.data["video_results"])
+
+    def test_only_the_last_turns_are_kept(self):
+        for prompt in ("first request", "second request", "third request"):
+            self.chat(prompt)
+
+        conversation = self.view.conversation_store.load(1, self.conversation_id)
+        self.assertEqual([prompt for prompt, _ in conversation.turns], ["second request", "third request"])
+
+    def test_conversations_are_scoped_to_the_user(self):
+        self.chat("can you find me ted talk videos")
+
+        self.assertEqual(self.view.conversation_store.load(2, self.conversation_id).turns, [])
+
+    @override_settings(FAST_PATH_ENABLED=False, GEMINI_SESSION_POOL_SIZE=10)
+    def test_the_store_owns_conversations_while_it_is_enabled(self):
+        self.chat("can you find me ted talk videos")
+
+        self.assertIsNone(self.view.gemini_client.send_message.call_args.kwargs.get("session_key"))
+        self.assertEqual(len(self.view.conversation_store.load(1, self.conversation_id).turns), 1)
+        self.assertEqual([warning.id for warning in check_conversation_owner()], ["chatbot.W001"])
+
+    @override_settings(FAST_PATH_ENABLED=False, GEMINI_SESSION_POOL_SIZE=10)
+    def test_pooled_sessions_keep_conversations_without_the_store(self):
+        self.view.conversation_store = None
+        self.chat("can you find me ted talk videos")
+
+        self.assertEqual(self.view.gemini_client.send_message.call_args.kwargs["session_key"], f"1:{self.conversation_id}")
+        with override_settings(CONVERSATION_STORE={**settings.CONVERSATION_STORE, "ENABLED": False}):
+            self.assertEqual(check_conversation_owner(), [])
+
+
+@override_settings(FAST_PATH_ENABLED=False)
+class SharedCacheCheckTests(SimpleTestCase):
+    databases = {"default"}
+
+    @override_settings(CACHES=LOCAL_CACHES, SINGLE_FLIGHT={**settings.SINGLE_FLIGHT, "SHARED": True})
+    def test_local_memory_caches_are_rejected(self):
+        errors = check_shared_caches()
+
+        self.assertEqual(
+            [error.msg.split(" ")[0] for error in errors], ["COLLECTION_EPOCH", "CONVERSATION_STORE", "SINGLE_FLIGHT"]
+        )
+        self.assertEqual({error.id for error in errors}, {"chatbot.E002"})
+        with self.assertRaises(ImproperlyConfigured):
+            ensure_shared_caches()
+
+    @override_settings(
+        CACHES={
+            "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+            "shared": {"BACKEND": "django.core.cache.backends.db.DatabaseCache", "LOCATION": "chatbot_shared_cache"},
+        }
+    )
+    def test_a_shared_cache_passes(self):
+        self.assertEqual(check_shared_caches(), [])
+        ensure_shared_caches()
+
+    @override_settings(
+        CACHES={
+            "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+            "shared": {"BACKEND": "django.core.cache.backends.db.DatabaseCache", "LOCATION": "missing_cache_table"},
+        }
+    )
+    def test_a_missing_cache_table_is_reported(self):
+        self.assertEqual(check_cache_tables(), [])
+        self.assertEqual([error.id for error in check_cache_tables(databases=["default"])], ["chatbot.E003"])
+        with self.assertRaisesMessage(ImproperlyConfigured, "missing_cache_table"):
+            ensure_shared_caches()
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class BatchChatTests(SimpleTestCase):
+    def setUp(self):
+        self.chat = ChatAPI()
+        self.chat.gemini_client = StubGeminiClient(delay=0)
+        self.chat.video_search_service = StubVideoSearchService()
+        self.chat.response_cache = None
+
+    def test_results_are_in_input_order_with_per_item_errors(self):
+        items = [{"prompt": f"can you find me ted talk videos {number}"} for number in range(5)]
+        items.insert(2, {"summary": "no prompt"})
+        self.chat.video_search_service.find_related_videos_batch = MagicMock(
+            side_effect=lambda options: [[{"id": "1"}]] * (len(options) - 1) + [TypesenseSearchError("bad filter")]
+        )
+
+        results = list(BatchChatProcessor(self.chat, concurrency=3, window_size=4).process(items))
+
+        self.assertEqual([result["index"] for result in results], list(range(6)))
+        self.assertEqual(
+            [result["status"] for result in results], ["ok", "ok", "error", "error", "ok", "error"]
+        )
+        self.assertEqual(results[2]["error"], "No prompt provided")
+        self.assertEqual(results[0]["video_results"], [{"id": "1"}])
+        # One multi_search per window
+        self.assertEqual(self.chat.video_search_service.find_related_videos_batch.call_count, 2)
+
+    @override_settings(FAST_PATH_ENABLED=False)
+    def test_items_use_up_the_callers_rate_limit(self):
+        admission = make_admission_controller(rate_per_minute=6000, burst=100)
+        gemini_client = self.chat.gemini_client
+        send_message = gemini_client.send_message
+
+        def admitted_send_message(prompt, session_key=None):
+            admission.admit(current_ticket.get())
+            return send_message(prompt, session_key)
+
+        gemini_client.send_message = admitted_send_message
+        self.chat.gemini_flight = None
+        items = [{"prompt": f"can you find me ted talk videos {number}"} for number in range(5)]
+
+        current_ticket.set(admission.ticket(make_user("batch-user")))
+        results = list(BatchChatProcessor(self.chat, concurrency=1).process(items))
+
+        # The default tier's bucket holds 2 calls
+        self.assertEqual([result["status"] for result in results], ["ok", "ok", "error", "error", "error"])
+        self.assertEqual(results[2]["error"], "Too many requests, please try again shortly")
+
+    def test_identical_searches_share_one_multi_search_entry(self):
+        service = VideoSearchService()
+        service.result_cache = None
+        service.typesense = MagicMock()
+        service.typesense.multi_search.return_value = {
+            "results": [{"hits": [{"document": {"id": "1"}}]}, {"error": "Could not parse the filter query", "code": 400}]
+        }
+        options = {"topic": "TED talks", "view_count": "", "release_date_before": "", "release_date_after": ""}
+
+        results = service.find_related_videos_batch(
+            [options, {**options, "topic": "ted TALKS"}, {**options, "view_count": "bad"}]
+        )
+
+        self.assertEqual(len(service.typesense.multi_search.call_args[0][0]), 2)
+        self.assertEqual(results[0], [{"id": "1"}])
+        self.assertEqual(results[1], [{"id": "1"}])
+        self.assertIsInstance(results[2], TypesenseSearchError)
+
+
+@override_settings(FAST_PATH_ENABLED=False)
+class ChatStreamTests(SimpleTestCase):
+    def setUp(self):
+        self.view = ChatStreamAPI()
+        self.view.gemini_client = StubGeminiClient(delay=0)
+        self.view.video_search_service = StubVideoSearchService()
+        self.view.response_cache = None
+
+    def test_text_is_streamed_before_video_results(self):
+        events = [
+            event.split("\n")[0].removeprefix("event: ")
+            for event in self.view.stream_events("can you find me ted talk videos", "")
+        ]
+
+        self.assertIn("token", events)
+        self.assertLess(events.index("message"), events.index("video_results"))
+        self.assertEqual(events[-1], "done")
+
+    def test_extract_partial_field(self):
+        partial = ResponseParser.extract_partial_field(
+            '```json\n{"intent": "others", "response": "Here are \\"some', "response"
+        )
+
+        self.assertEqual(partial, 'Here are "some')
+
+    def test_generation_stops_once_the_json_object_is_complete(self):
+        consumed = []
+
+        def stream_content(prompt):
+            for chunk in ('```json\n{"intent": "others", ', '"response": "Hi"}', "\n```\n", "Some extra text"):
+                consumed.append(chunk)
+                yield chunk
+
+        self.view.gemini_client.stream_content = stream_content
+        events = list(self.view.stream_events("hello", ""))
+
+        self.assertEqual(len(consumed), 2)
+        self.assertIn('"text_response": "Hi"', events[-2])
+
+
+class ResponseParserTests(SimpleTestCase):
+    def setUp(self):
+        self.parser = ResponseParser()
+
+    def parse(self, text):
+        return self.parser.convert_to_python_object(SimpleNamespace(text=text))
+
+    def test_object_is_found_with_or_without_fences(self):
+        for text in (
+            '```json\n{"intent": "find video", "summary": "TED", "response": "Here"}\n```',
+            'Sure! {"intent": "find video", "summary": "TED", "response": "Here"} Let me know if you need more.',
+            '```json\n{"intent": "find video", "summary": "TED", "response": "Here"}```',
+        ):
+            with self.subTest(text=text):
+                self.assertEqual(
+                    self.parse(text),
+                    {"intent": "find video", "summary": "TED", "response": "Here", "query_options": None},
+                )
+
+    def test_extractor_handles_chunks_and_braces_in_strings(self):
+        extractor = JSONObjectExtractor()
+        chunks = ['Fields: { topic: string }. ```json\n{"response": "use {curly', ' braces} \\" here", ', '"intent": "others"}', "\n```"]
+
+        results = [extractor.feed(chunk) for chunk in chunks]
+
+        self.assertEqual(results[:2], [None, None])
+        self.assertEqual(results[2], {"response": 'use {curly braces} " here', "intent": "others"})
+
+    def test_invalid_json_raises_instead_of_returning_a_set(self):
+        with self.assertRaises(ResponseFormatError):
+            self.parse('```json\n{"intent": "others", "response": 42}\n```')
+
+    def test_plain_text_becomes_a_text_response(self):
+        self.assertEqual(self.parse("I can only help with videos.")["response"], "I can only help with videos.")
+
+    def test_query_options_are_validated(self):
+        options = self.parser.convert_to_query_options(
+            SimpleNamespace(text='{"topic": "cats", "view_count": "more than 5", "release_date_after": "2023-01-01", "release_date_before": "last week", "extra": 1}')
+        )
+
+        self.assertEqual(
+            options,
+            {"topic": "cats", "title": "", "view_count": "", "release_date_before": "", "release_date_after": "2023-01-01"},
+        )
+
+    def test_impossible_dates_are_dropped(self):
+        options = ResponseParser.validate_query_options(
+            {"topic": "cats", "release_date_before": "2023-02-30", "release_date_after": "2023-2-5"}
+        )
+
+        self.assertEqual(options["release_date_before"], "")
+        self.assertEqual(options["release_date_after"], "2023-02-05")
+
+
+class FakeDocuments:
+    # reject_once rows fail once with a 503, invalid rows always fail with a 400, errors are raised by the next calls
+    def __init__(self, reject_once=(), interrupt_at=None, invalid=(), errors=()):
+        self.reject_once = set(reject_once)
+        self.interrupt_at = interrupt_at
+        self.invalid = set(invalid)
+        self.errors = list(errors)
+        self.imported = {}
+        self.calls = 0
+
+    def import_(self, documents, params):
+        self.calls += 1
+        # Stops the import like a Ctrl+C, before the batch holding that document is written
+        if any(document["id"] == self.interrupt_at for document in documents):
+            raise KeyboardInterrupt
+        if self.errors:
+            raise self.errors.pop(0)
+        results = []
+        for document in documents:
+            if document["id"] in self.invalid:
+                results.append({"success": False, "error": "Field `view_count` must be an int64.", "code": 400})
+            elif document["id"] in self.reject_once:
+                self.reject_once.remove(document["id"])
+                results.append({"success": False, "error": "Not ready to accept writes", "code": 503})
+            else:
+                self.imported[document["id"]] = document
+                results.append({"success": True})
+        return results
+
+
+class FakeEmbeddingModel:
+    def __init__(self):
+        self.encoded = []
+
+    def encode(self, texts, **kwargs):
+        self.encoded.extend(texts)
+        return [[float(len(text)), 0.5] for text in texts]
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class HybridSearchTests(SimpleTestCase):
+    def setUp(self):
+        self.embedder = LocalEmbedder("local-model")
+        self.embedder.model = FakeEmbeddingModel()
+        self.service = VideoSearchService()
+        self.service.result_cache = None
+        self.service.embedder = self.embedder
+        self.service.typesense = MagicMock()
+        self.service.typesense.search.return_value = {"hits": []}
+
+    def test_query_embeddings_come_from_the_lru(self):
+        self.embedder.embed_query("TED talks about space")
+        vector = self.embedder.embed_query("  ted talks   about SPACE ")
+
+        self.assertEqual(self.embedder.model.encoded, ["ted talks about space"])
+        self.assertEqual(vector, [21.0, 0.5])
+
+    def test_topic_searches_combine_keywords_and_vectors(self):
+        self.service.find_related_videos({"topic": "space", "view_count": ">1000"})
+
+        search_parameters = self.service.typesense.search.call_args[0][1]
+        self.assertEqual(search_parameters["q"], "space")
+        self.assertTrue(search_parameters["vector_query"].startswith("embedding:([5.0,0.5], k: 100"))
+        self.assertEqual(search_parameters["sort_by"], "_text_match:desc,view_count:desc")
+
+    def test_filter_only_searches_skip_the_vector_query(self):
+        self.service.find_related_videos({"topic": "", "view_count": ">1000"})
+
+        self.assertNotIn("vector_query", self.service.typesense.search.call_args[0][1])
+
+    @override_settings(VECTOR_SEARCH={**settings.VECTOR_SEARCH, "ENABLED": True})
+    def test_documents_are_embedded_at_index_time(self):
+        schema = create_videolists_schema("videolists_1")
+        self.assertIn({"name": "embedding", "type": "float[]", "num_dim": 384, "optional": True}, schema["fields"])
+
+        collection = SimpleNamespace(documents=FakeDocuments())
+        documents = [{"id": "1", "titles": ["Space"], "tags": ["nasa"], "description": "Rockets"}]
+        VideoIndexer(collection, embedder=self.embedder).run("videos.jsonl", documents=documents, resume=False)
+
+        self.assertEqual(collection.documents.imported["1"]["embedding"], [18.0, 0.5])
+        self.assertEqual(self.embedder.model.encoded, ["Space nasa Rockets"])
+
+
+class VideoIndexerTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.directory.name, "videos.jsonl")
+        with open(self.source, "w") as file:
+            for number in range(10):
+                file.write(json.dumps({"id": str(number), "titles": [f"Video {number}"], "view_count": number, "released_date": 0}) + "\n")
+        self.checkpoint = os.path.join(self.directory.name, "videos.checkpoint")
+        self.failures = os.path.join(self.directory.name, "videos.failed.jsonl")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_failed_rows_are_retried(self):
+        collection = SimpleNamespace(documents=FakeDocuments(reject_once={"3"}))
+        indexer = VideoIndexer(collection, batch_size=4, workers=2, checkpoint_path=self.checkpoint)
+        with patch("chatbot.services.video_indexer.time.sleep"):
+            report = indexer.run(self.source)
+
+        self.assertEqual(report.imported, 10)
+        self.assertEqual(report.failed, 0)
+        self.assertEqual(len(collection.documents.imported), 10)
+
+    def read_failures(self):
+        with open(self.failures) as file:
+            return [json.loads(line) for line in file]
+
+    def test_rejected_rows_are_recorded_without_retries(self):
+        collection = SimpleNamespace(documents=FakeDocuments(invalid={"3"}))
+        indexer = VideoIndexer(collection, batch_size=4, failures_path=self.failures)
+        with patch("chatbot.services.video_indexer.time.sleep") as sleep:
+            report = indexer.run(self.source)
+
+        self.assertEqual((report.imported, report.failed), (9, 1))
+        self.assertEqual(collection.documents.calls, 3)
+        sleep.assert_not_called()
+        self.assertEqual([failure["document"]["id"] for failure in self.read_failures()], ["3"])
+
+    def test_only_transient_batch_errors_are_retried(self):
+        errors = [ServiceUnavailable(503, "Not ready"), RequestMalformed(400, "Bad JSON")]
+        collection = SimpleNamespace(documents=FakeDocuments(errors=errors))
+        indexer = VideoIndexer(collection, batch_size=10, workers=1, failures_path=self.failures)
+        with patch("chatbot.services.video_indexer.time.sleep"):
+            report = indexer.run(self.source)
+
+        # The 503 is retried, the 400 that follows sends the whole batch to the failures file
+        self.assertEqual(collection.documents.calls, 2)
+        self.assertEqual((report.imported, report.failed), (0, 10))
+        self.assertEqual(self.read_failures()[0]["error"], "[Errno 400] Bad JSON")
+
+    def test_unparsable_lines_are_recorded_and_skipped(self):
+        with open(self.source, "a") as file:
+            file.write('{"id": "10", "titles": \n')
+
+        collection = SimpleNamespace(documents=FakeDocuments())
+        report = VideoIndexer(collection, batch_size=4, failures_path=self.failures).run(self.source)
+
+        self.assertEqual((report.imported, report.failed), (10, 1))
+        self.assertEqual(report.failed_ids, set())
+        failure = self.read_failures()[0]
+        self.assertEqual((failure["line"], failure["text"]), (11, '{"id": "10", "titles": '))
+
+    def interrupted_import(self):
+        collection = SimpleNamespace(documents=FakeDocuments(interrupt_at="4"))
+        with self.assertRaises(KeyboardInterrupt):
+            VideoIndexer(collection, batch_size=4, workers=1, checkpoint_path=self.checkpoint).run(self.source)
+
+    def test_resumes_from_checkpoint(self):
+        self.interrupted_import()
+
+        collection = SimpleNamespace(documents=FakeDocuments())
+        report = VideoIndexer(collection, batch_size=4, checkpoint_path=self.checkpoint).run(self.source)
+
+        self.assertEqual(report.skipped, 4)
+        self.assertEqual(sorted(collection.documents.imported, key=int), [str(number) for number in range(4, 10)])
+
+    def test_importing_twice_imports_everything_again(self):
+        VideoIndexer(SimpleNamespace(documents=FakeDocuments()), batch_size=4, checkpoint_path=self.checkpoint).run(self.source)
+
+        self.assertFalse(os.path.exists(self.checkpoint))
+        collection = SimpleNamespace(documents=FakeDocuments())
+        report = VideoIndexer(collection, batch_size=4, checkpoint_path=self.checkpoint).run(self.source)
+
+        self.assertEqual(report.skipped, 0)
+        self.assertEqual(len(collection.documents.imported), 10)
+
+    def test_checkpoint_of_a_changed_file_is_ignored(self):
+        self.interrupted_import()
+        with open(self.source, "a") as file:
+            file.write(json.dumps({"id": "10", "titles": ["Video 10"], "view_count": 10, "released_date": 0}) + "\n")
+
+        collection = SimpleNamespace(documents=FakeDocuments())
+        report = VideoIndexer(collection, batch_size=4, checkpoint_path=self.checkpoint).run(self.source)
+
+        self.assertEqual(report.skipped, 0)
+        self.assertEqual(len(collection.documents.imported), 11)
+
+
+def not_found():
+    raise ObjectNotFound("Not found")
+
+
+class FakeCollections(dict):
+    def create(self, schema):
+        self[schema["name"]] = SimpleNamespace(retrieve=lambda: schema, delete=lambda: self.pop(schema["name"]))
+
+    def __missing__(self, name):
+        return SimpleNamespace(retrieve=not_found, delete=not_found)
+
+
+class FakeAliases(dict):
+    def upsert(self, alias, body):
+        self[alias] = SimpleNamespace(retrieve=lambda: body)
+
+    def __missing__(self, alias):
+        return SimpleNamespace(retrieve=not_found)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class TypesenseInitTests(SimpleTestCase):
+    def setUp(self):
+        self.client = SimpleNamespace(collections=FakeCollections(), aliases=FakeAliases())
+        patcher = patch("chatbot.management.commands.typesense_init.TypesenseClient")
+        patcher.start().return_value.client = self.client
+        self.addCleanup(patcher.stop)
+
+    def init(self, *args):
+        output = io.StringIO()
+        call_command("typesense_init", *args, stdout=output)
+        return output.getvalue()
+
+    def test_running_twice_keeps_the_collection(self):
+        self.init()
+        collection = self.client.aliases["videolists"].retrieve()["collection_name"]
+
+        output = self.init()
+
+        self.assertIn("nothing to do", output)
+        self.assertEqual(list(self.client.collections), [collection])
+        self.assertEqual(self.client.aliases["videolists"].retrieve()["collection_name"], collection)
+
+    def test_drop_recreates_the_collection(self):
+        self.client.collections.create({"name": "videolists"})
+
+        self.assertIn("nothing to do", self.init())
+        output = self.init("--drop")
+
+        self.assertIn("Dropped collection videolists", output)
+        collection = self.client.aliases["videolists"].retrieve()["collection_name"]
+        self.assertEqual(list(self.client.collections), [collection])
+        self.assertTrue(collection.startswith("videolists_"))
+
+
+class ChangeTrackerTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.documents = [{"id": str(number), "titles": [f"Video {number}"], "updated_at": number} for number in range(5)]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def changed(self, documents, failed_ids=(), rebuild=False):
+        with ChangeTracker(self.directory.name, rebuild=rebuild) as tracker:
+            changed = list(tracker.filter_changed(documents))
+            tracker.commit(failed_ids)
+        return [document["id"] for document in changed]
+
+    def test_only_changed_documents_are_reindexed(self):
+        self.assertEqual(len(self.changed(self.documents, rebuild=True)), 5)
+        self.assertEqual(self.changed(self.documents), [])
+
+        edited = {"id": "2", "titles": ["Renamed"], "updated_at": 10}
+        self.assertEqual(self.changed(self.documents[:2] + [edited] + self.documents[3:]), ["2"])
+
+    def test_failed_documents_are_retried_next_run(self):
+        documents = [{"id": "1", "titles": ["Video"]}, {"id": "2", "titles": ["Video"]}]
+        self.changed(documents, failed_ids={"2"})
+
+        self.assertEqual(self.changed(documents), ["2"])
+
+
+    def test_documents_missing_from_the_source_are_reported(self):
+        self.changed(self.documents, rebuild=True)
+
+        with ChangeTracker(self.directory.name) as tracker:
+            self.assertEqual(list(tracker.filter_changed(self.documents[:3])), [])
+            missing = sorted(tracker.missing_ids())
+            tracker.commit(deleted_ids=missing)
+
+        self.assertEqual(missing, ["3", "4"])
+        # A deleted document that comes back is indexed again
+        self.assertEqual(self.changed(self.documents), ["3", "4"])
+
+    def test_deletions_go_out_in_chunks(self):
+        collection = SimpleNamespace(documents=MagicMock())
+        collection.documents.delete.return_value = {"num_deleted": 2}
+
+        deleted = delete_documents(collection, ["1", "2", "3", "a,b"], batch_size=2)
+
+        self.assertEqual(deleted, 4)
+        self.assertEqual(
+            [call.args[0]["filter_by"] for call in collection.documents.delete.call_args_list],
+            ["id:[`1`,`2`]", "id:[`3`,`a,b`]"],
+        )
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class ReindexCommandTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.state_dir = os.path.join(self.directory.name, "state")
+        self.source = os.path.join(self.directory.name, "videos.jsonl")
+        self.collections = {"videolists_live": SimpleNamespace(documents=FakeDocuments(), delete=MagicMock())}
+        self.collections["videolists_live"].documents.delete = MagicMock(return_value={"num_deleted": 1})
+        self.client = SimpleNamespace(collections=self.collections)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_source(self, count):
+        with open(self.source, "w") as file:
+            for number in range(count):
+                file.write(json.dumps({"id": str(number), "titles": [f"Video {number}"], "view_count": number, "released_date": 0}) + "\n")
+
+    def reindex(self, mode, swap_alias=None):
+        module = "chatbot.management.commands.typesense_reindex"
+        with patch(f"{module}.TypesenseClient", return_value=SimpleNamespace(client=self.client)), \
+                patch(f"{module}.get_alias_target", return_value="videolists_live"), \
+                patch(f"{module}.create_versioned_collection", return_value="videolists_next"), \
+                patch(f"{module}.swap_alias", side_effect=swap_alias), \
+                patch(f"{module}.bump_collection_epoch"):
+            self.collections["videolists_next"] = SimpleNamespace(documents=FakeDocuments(), delete=MagicMock())
+            call_command("typesense_reindex", self.source, mode=mode, state_dir=self.state_dir, stdout=io.StringIO())
+
+    def test_incremental_runs_delete_documents_removed_from_the_file(self):
+        self.write_source(3)
+        self.reindex("full")
+        self.write_source(2)
+        self.reindex("incremental")
+
+        self.collections["videolists_live"].documents.delete.assert_called_once_with({"filter_by": "id:[`2`]"})
+        # The manifest no longer knows the deleted document
+        with ChangeTracker(self.state_dir) as tracker:
+            list(tracker.filter_changed([]))
+            self.assertEqual(sorted(tracker.missing_ids()), ["0", "1"])
+
+    def test_manifest_is_kept_when_the_alias_swap_fails(self):
+        self.write_source(3)
+        self.reindex("full")
+        self.write_source(5)
+
+        with self.assertRaises(ConnectionError):
+            self.reindex("full", swap_alias=ConnectionError("Typesense is down"))
+
+        # The next incremental run still sends the documents the failed full run indexed
+        self.reindex("incremental")
+        self.assertEqual(sorted(self.collections["videolists_live"].documents.imported), ["3", "4"])
+
+
+class TransportTests(SimpleTestCase):
+    def create_transport(self, **options):
+        defaults = {"timeout": 1, "max_retries": 2, "backoff_base": 0, "failure_threshold": 3}
+        return Transport("test", **{**defaults, **options})
+
+    def test_retries_until_success(self):
+        transport = self.create_transport()
+        calls = iter([ConnectionError("down"), ConnectionError("down"), "ok"])
+
+        def flaky():
+            result = next(calls)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        self.assertEqual(transport.call(flaky), "ok")
+        self.assertEqual(transport.health()["retries"], 2)
+
+    def test_circuit_opens_after_repeated_failures(self):
+        transport = self.create_transport(max_retries=0)
+
+        def down():
+            raise ConnectionError("down")
+
+        for _ in range(3):
+            with self.assertRaises(ConnectionError):
+                transport.call(down)
+        with self.assertRaises(CircuitOpenError):
+            transport.call(down)
+        self.assertEqual(transport.health()["state"], "open")
+
+    def open_circuit(self, transport):
+        transport.breaker.state = transport.breaker.OPEN
+        transport.breaker.opened_at = time.monotonic() - transport.breaker.reset_timeout
+
+    def test_half_open_trial_closes_or_reopens_the_circuit(self):
+        def down():
+            raise ConnectionError("down")
+
+        def not_found():
+            raise ValueError("404")
+
+        def busy():
+            raise TransportBusyError("busy")
+
+        for call, error, state in (
+            (lambda: "ok", None, "closed"),
+            (down, ConnectionError, "open"),
+            (not_found, ValueError, "closed"),
+            (busy, TransportBusyError, "open"),
+        ):
+            with self.subTest(state=state, error=error):
+                transport = self.create_transport(max_retries=0)
+                self.open_circuit(transport)
+                if error is None:
+                    transport.call(call)
+                else:
+                    with self.assertRaises(error):
+                        transport.call(call)
+                self.assertEqual(transport.health()["state"], state)
+
+    def test_half_open_stream_records_its_outcome(self):
+        client = GeminiClient.__new__(GeminiClient)
+        client.admission = None
+        client.transport = self.create_transport(max_retries=0, retry_on=(ConnectionError,))
+        chunk = SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=["x"]))], text="x")
+
+        client.model = MagicMock()
+        client.model.generate_content.return_value = iter([chunk])
+        self.open_circuit(client.transport)
+        self.assertEqual(list(client.stream_content("prompt")), ["x"])
+        self.assertEqual(client.transport.health()["state"], "closed")
+
+        client.model.generate_content.side_effect = ConnectionError("down")
+        self.open_circuit(client.transport)
+        with self.assertRaises(ConnectionError):
+            list(client.stream_content("prompt"))
+        self.assertEqual(client.transport.health()["state"], "open")
+
+    def test_slow_call_times_out(self):
+        transport = self.create_transport(timeout=0.05, max_retries=0)
+
+        with self.assertRaises(TimeoutError):
+            transport.call(time.sleep, 0.5)
+
+    def test_hedged_request_returns_first_success(self):
+        transport = self.create_transport(hedge_after=0.05)
+        delays = iter([0.5, 0])
+
+        def call():
+            time.sleep(next(delays))
+            return "done"
+
+        start = time.perf_counter()
+        self.assertEqual(transport.call(call), "done")
+        self.assertLess(time.perf_counter() - start, 0.4)
+        self.assertEqual(transport.health()["hedges"], 1)
+
+
+@override_settings(FAST_PATH_ENABLED=False)
+class MetricsTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="c@c.com", password="c@c12345")
+        cls.token = AuthToken.objects.create(cls.user)[1]
+
+    @patch.object(ChatAPI, "response_cache", None)
+    @patch.object(ChatAPI, "video_search_service", StubVideoSearchService())
+    def test_stage_timings_are_reported(self):
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token)
+        with patch.object(ChatAPI, "gemini_client", StubGeminiClient(delay=0)):
+            response = self.client.post(reverse("chat"), {"prompt": "can you find me ted talk videos"}, format="json")
+
+        self.assertIn("gemini_initial;dur=", response["Server-Timing"])
+        self.assertIn("parse;dur=", response["Server-Timing"])
+
+        metrics = self.client.get(reverse("metrics")).content.decode()
+        self.assertIn('chatbot_stage_duration_seconds_count{stage="gemini_initial"}', metrics)
+        self.assertIn('chatbot_requests_total{path="chat",status="200"}', metrics)
+
+    @override_settings(METRICS={**settings.METRICS, "ALLOWED_IPS": ("127.0.0.1",), "TOKEN": "scraper-token"})
+    def test_metrics_are_only_served_to_scrapers(self):
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 200)
+        self.assertEqual(self.client.get(reverse("metrics"), REMOTE_ADDR="10.0.0.5").status_code, 403)
+        self.assertEqual(
+            self.client.get(reverse("metrics"), REMOTE_ADDR="10.0.0.5", HTTP_AUTHORIZATION="Bearer wrong").status_code,
+            403,
+        )
+        response = self.client.get(reverse("metrics"), REMOTE_ADDR="10.0.0.5", HTTP_AUTHORIZATION="Bearer scraper-token")
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class BenchmarkHarnessTests(SimpleTestCase):
+    def test_fake_engine_applies_filters_sort_and_fields(self):
+        engine = InMemorySearchEngine(generate_corpus(500))
+
+        results = engine.search(
+            {
+                "q": "cooking",
+                "query_by": "titles, tags, description",
+                "query_by_weight": "3, 2, 1",
+                "filter_by": "view_count:>1000",
+                "sort_by": "view_count:desc",
+                "per_page": 3,
+                "include_fields": "id, titles, view_count",
+            }
+        )
+
+        view_counts = [hit["document"]["view_count"] for hit in results["hits"]]
+        self.assertEqual(len(view_counts), 3)
+        self.assertEqual(view_counts, sorted(view_counts, reverse=True))
+        self.assertTrue(all(count > 1000 for count in view_counts))
+        self.assertEqual(set(results["hits"][0]["document"]), {"id", "titles", "view_count"})
+
+    # Fresh transports, so a circuit opened by an earlier test against an unreachable Typesense isn't inherited
+    @override_settings(FAST_PATH_ENABLED=False)
+    @patch.dict(transports, clear=True)
+    def test_scenarios_run_against_the_fakes(self):
+        model = FakeGenerativeModel(latency=0, tokens_per_second=100000)
+        with FakeTypesenseServer(generate_corpus(200)) as server:
+            views = build_views(model, server.config())
+            results = [run_scenario(name, views, requests=8, concurrency=4) for name in ("wsgi", "asgi")]
+
+        self.assertEqual([result["errors"] for result in results], [0, 0])
+        self.assertEqual(model.calls, 16)
+
+    @override_settings(FAST_PATH_ENABLED=False)
+    @patch.dict(transports, clear=True)
+    def test_extraction_modes_are_scenarios(self):
+        model = FakeGenerativeModel(latency=0, tokens_per_second=100000)
+        with FakeTypesenseServer(generate_corpus(200)) as server:
+            views = build_views(model, server.config())
+            results = [run_scenario(name, views, requests=4, concurrency=2) for name in ("single_call", "two_call")]
+
+        self.assertEqual([result["errors"] for result in results], [0, 0])
+        self.assertEqual([result["gemini_calls_per_request"] for result in results], [1, 2])
+
+    def test_regressions_are_reported(self):
+        baseline = {"results": [{"scenario": "wsgi", "concurrency": 8, "throughput_rps": 100, "p95_ms": 50, "errors": 0}]}
+        slower = {"results": [{"scenario": "wsgi", "concurrency": 8, "throughput_rps": 80, "p95_ms": 52, "errors": 0}]}
+
+        self.assertEqual(find_regressions(slower, baseline, tolerance=0.1), ["wsgi x8: throughput 100 -> 80 rps"])
+        self.assertEqual(find_regressions(slower, baseline, tolerance=0.25), [])
+
+
+class IntentClassifierTests(SimpleTestCase):
+    def setUp(self):
+        self.classifier = IntentClassifier()
+        self.today = date(2024, 10, 29)
+
+    def test_extracts_dates_and_view_counts(self):
+        cases = {
+            "find me videos from 2023": ("", "", "2023-12-31", "2023-01-01"),
+            "show me cooking videos with more than 1000 views": ("cooking", ">1000", "", ""),
+            "search for music videos with over 1.5m views": ("music", ">1500000", "", ""),
+            "can you find me cooking videos that came out last week": ("cooking", "", "2024-10-29", "2024-10-22"),
+            "can you find me videos that came out two years ago": ("", "", "2022-12-31", "2022-01-01"),
+            "can you find me a video that came out on May 12, 2023": ("", "", "2023-05-12", "2023-05-12"),
+            "show me music videos released in March 2022": ("music", "", "2022-03-31", "2022-03-01"),
+        }
+        for prompt, expected in cases.items():
+            with self.subTest(prompt=prompt):
+                options = self.classifier.classify(prompt, today=self.today)["query_options"]
+                self.assertEqual(
+                    (options["topic"], options["view_count"], options["release_date_before"], options["release_date_after"]),
+                    expected,
+                )
+
+    def test_exact_title_request(self):
+        response = self.classifier.classify("can you find me this video 'How to sound smart in your TEDx Talk'")
+
+        self.assertEqual(response["response"], "Here is the video you are looking for.")
+        self.assertEqual(response["query_options"]["title"], "How to sound smart in your TEDx Talk")
+
+    def test_falls_back_to_gemini_when_unsure(self):
+        for prompt, summary in (
+            ("who was the president in 2012?", ""),
+            ("find videos about dogs but not puppies", ""),
+            ("show me more videos like those", "The user is looking for TED talks"),
+            ("show me recent videos about cats", ""),
+            ("show me videos under 5 minutes", ""),
+            ("videos about the 2008 financial crisis", ""),
+            ("the year 1984 novel videos", ""),
+            ("give me a summary of this talks", ""),
+            ("I don't want to watch videos", ""),
+            ("I need a video editor", ""),
+            ("create a video about dogs", ""),
+            ("give me feedback on my video", ""),
+            ("I can't play videos, help", ""),
+            ("video games", ""),
+            ("find me videos about video games", ""),
+            ("videos longer than an hour", ""),
+            ("find videos longer than an hour", ""),
+            ("cooking videos from 2023", ""),
+        ):
+            with self.subTest(prompt=prompt):
+                self.assertIsNone(self.classifier.classify(prompt, summary, today=self.today))
+
+    def test_the_callers_summary_is_kept(self):
+        response = self.classifier.classify("find me cooking videos", "The user likes Italian food.", today=self.today)
+
+        self.assertEqual(
+            response["summary"], "The user likes Italian food. The user is looking for cooking videos: find me cooking videos"
+        )
+
+    @patch.object(ChatAPI, "response_cache", None)
+    @patch.object(ChatAPI, "video_search_service", StubVideoSearchService())
+    def test_fast_path_skips_gemini(self):
+        gemini_client = StubGeminiClient(delay=0)
+        with patch.object(ChatAPI, "gemini_client", gemini_client):
+            response = ChatAPI().post(SimpleNamespace(data={"prompt": "find me cooking videos from 2023"}))
+
+        self.assertEqual(gemini_client.calls, 0)
+        self.assertTrue(response.data["video_results"])
+
+
+class PromptTemplateTests(SimpleTestCase):
+    def test_examples_follow_the_date(self):
+        examples = create_video_search_examples(date(2026, 3, 10))
+
+        self.assertIn("two years ago': release_date_before:'2024-12-31', release_date_after:'2024-01-01'", examples)
+        self.assertIn("last week': release_date_before:'2026-03-10', release_date_after:'2026-03-03'", examples)
+
+    def test_examples_are_built_when_the_prompt_is_rendered(self):
+        with patch("chatbot.services.prompts.date") as fake_date:
+            fake_date.today.return_value = date(2030, 1, 15)
+            prompt = Prompts.create_video_search_query_prompt("", "find me videos from two years ago")
+            fake_date.today.return_value = date(2031, 1, 15)
+            next_year_prompt = Prompts.create_video_search_query_prompt("", "find me videos from two years ago")
+
+        self.assertIn("two years ago': release_date_before:'2028-12-31'", prompt)
+        self.assertIn("Today's date: 2030-01-15", prompt.request)
+        self.assertIn("two years ago': release_date_before:'2029-12-31'", next_year_prompt)
+        self.assertNotIn("{video_search_examples}", next_year_prompt)
+
+    def test_static_instructions_come_first(self):
+        prompt = Prompts.create_combined_prompt("show me lasagna recipes", "The user wants recipes")
+
+        self.assertTrue(prompt.startswith(Prompts.COMBINED_TEMPLATE.instructions))
+        self.assertEqual(str(prompt), Prompts.COMBINED_TEMPLATE.instructions + prompt.request)
+        self.assertIn(date.today().isoformat(), prompt.request)
+        self.assertIn("show me lasagna recipes", prompt.request)
+        self.assertNotIn("show me lasagna recipes", Prompts.COMBINED_TEMPLATE.instructions)
+
+    @override_settings(GEMINI_PROMPT_TOKEN_BUDGET=1500)
+    def test_summary_is_cut_to_the_budget(self):
+        prompt = Prompts.create_initial_prompt("find me cooking videos", "recipes " * 5000)
+
+        self.assertLessEqual(count_tokens(prompt), 1500)
+        self.assertIn("recipes", prompt.request)
+        self.assertIn("find me cooking videos", prompt.request)
+
+
+class WarmableClient:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.warmed_up = False
+
+    def warm_up(self):
+        if self.fail:
+            raise ConnectionError("node is down")
+        self.warmed_up = True
+
+
+class LazyClientTests(SimpleTestCase):
+    def setUp(self):
+        patcher = patch.dict(clients)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_builds_once_on_first_use(self):
+        built = []
+
+        def build():
+            time.sleep(0.05)
+            built.append(1)
+            return object()
+
+        lazy = LazyClient("test", build)
+        self.assertEqual(built, [])
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(lazy.get())) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(built, [1])
+        self.assertEqual(len(set(map(id, results))), 1)
+
+    def test_rebuilt_in_a_forked_worker(self):
+        lazy = LazyClient("test", object)
+        parent = lazy.get()
+        with patch("chatbot.utils.lazy_client.os.getpid", return_value=-1):
+            self.assertIsNot(lazy.get(), parent)
+
+    def test_reads_like_the_client_on_a_view(self):
+        class View:
+            client = LazyClient("test", "chatbot.services.intent_classifier.IntentClassifier")
+
+        view = View()
+        self.assertIsInstance(view.client, IntentClassifier)
+        self.assertIs(View.client, view.client)
+        view.client = "replacement"
+        self.assertEqual(view.client, "replacement")
+
+    def test_warm_up_carries_on_after_a_failure(self):
+        LazyClient("failing", lambda: WarmableClient(fail=True))
+        working = LazyClient("working", WarmableClient)
+
+        with self.assertLogs("chatbot.utils.lazy_client", "WARNING"):
+            warm_up_clients(["failing", "working"])
+        self.assertTrue(working.get().warmed_up)
+
+        with self.assertRaises(ImproperlyConfigured):
+            warm_up_clients(["unknown"])
+
+    def test_import_profile_summary(self):
+        output = (
+            "import time: self [us] | cumulative | imported package\n"
+            "import time:       150 |        150 |   vertexai._utils\n"
+            "import time:      2000 |       2150 | vertexai\n"
+            "import time:       500 |        500 | chatbot.views\n"
+        )
+
+        entries = parse_importtime(output)
+        summary = summarize_imports(entries, top=1)
+
+        self.assertEqual(entries[0], ("vertexai._utils", 0.00015, 0.00015))
+        self.assertEqual(summary["modules"], 3)
+        self.assertEqual(summary["import_ms"], 2.65)
+        self.assertEqual(summary["packages"], [{"package": "vertexai", "ms": 2.15}])
+
+
+def make_admission_controller(rate_per_minute=600, burst=1, max_queue=10, max_wait=5):
+    tiers = {
+        "staff": Tier("staff", 600, 10, 0, max_wait),
+        "default": Tier("default", 600, 2, 1, max_wait),
+    }
+    return AdmissionController(rate_per_minute, burst, max_queue, tiers)
+
+
+def make_user(pk, groups=(), is_staff=False):
+    user = SimpleNamespace(pk=pk, is_staff=is_staff, groups=MagicMock())
+    user.groups.filter.return_value.values_list.return_value = list(groups)
+    return user
+
+
+class AdmissionControllerTests(SimpleTestCase):
+    def test_queued_calls_are_admitted_by_priority(self):
+        admission = make_admission_controller()
+        admission.admit()
+        order = []
+
+        def admit(user):
+            admission.admit(admission.ticket(user))
+            order.append(user.pk)
+
+        threads = [
+            threading.Thread(target=admit, args=(make_user("regular"),)),
+            threading.Thread(target=admit, args=(make_user("staff", is_staff=True),)),
+        ]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.02)
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(order, ["staff", "regular"])
+
+    def test_rejects_fast_when_the_deadline_cannot_be_met(self):
+        admission = make_admission_controller(rate_per_minute=60, max_wait=0.5)
+        admission.admit()
+        ticket = admission.ticket(make_user(1))
+
+        start = time.perf_counter()
+        with self.assertRaises(AdmissionRejected) as raised:
+            admission.admit(ticket)
+
+        self.assertLess(time.perf_counter() - start, 0.1)
+        self.assertEqual(raised.exception.retry_after, 1)
+        self.assertEqual(admission.queue, [])
+        # The user's token is given back, the call never used any quota
+        self.assertEqual(admission.user_buckets.get(1).tokens, 2)
+
+    def test_a_slow_first_call_does_not_use_up_the_second_calls_wait(self):
+        admission = make_admission_controller(rate_per_minute=6000, burst=2, max_wait=0.05)
+        ticket = admission.ticket(make_user(1))
+
+        admission.admit(ticket)
+        # The first Gemini call of the request takes longer than MAX_WAIT_SECONDS
+        time.sleep(0.1)
+        admission.admit(ticket)
+
+        self.assertEqual(admission.queue, [])
+
+    def test_expired_calls_are_dropped_before_using_quota(self):
+        # A token every 0.1s, and calls must start within 0.15s
+        admission = make_admission_controller(max_wait=0.15)
+        admission.admit()
+        outcome = {}
+
+        def admit(user):
+            try:
+                admission.admit(admission.ticket(user))
+                outcome[user.pk] = "admitted"
+            except AdmissionRejected:
+                outcome[user.pk] = "rejected"
+
+        threads = [
+            threading.Thread(target=admit, args=(make_user("regular"),)),
+            threading.Thread(target=admit, args=(make_user("staff", is_staff=True),)),
+        ]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.02)
+        for thread in threads:
+            thread.join()
+
+        # The staff call jumped the queue and took the next token, the regular one expired before the one after
+        self.assertEqual(outcome, {"staff": "admitted", "regular": "rejected"})
+        self.assertEqual(admission.queue, [])
+        self.assertLess(admission.bucket.tokens, 1)
+
+    def test_user_over_their_rate_gets_retry_after(self):
+        admission = make_admission_controller(rate_per_minute=6000, burst=100)
+        user = make_user(1)
+        admission.admit(admission.ticket(user))
+        admission.admit(admission.ticket(user))
+
+        with self.assertRaises(AdmissionRejected) as raised:
+            admission.admit(admission.ticket(user))
+        self.assertGreaterEqual(raised.exception.retry_after, 1)
+        # Other users are unaffected
+        admission.admit(admission.ticket(make_user(2)))
+
+    def test_full_queue_evicts_the_lowest_priority_call(self):
+        admission = make_admission_controller(rate_per_minute=60, max_queue=1, max_wait=10)
+        admission.admit()
+        regular = admission.ticket(make_user("regular"))
+        outcome = []
+
+        def admit():
+            try:
+                admission.admit(regular)
+            except AdmissionRejected:
+                outcome.append("rejected")
+
+        thread = threading.Thread(target=admit)
+        thread.start()
+        time.sleep(0.02)
+        with patch.object(admission, "poll", return_value=None):
+            with self.assertRaises(AdmissionRejected):
+                admission.admit(admission.ticket(make_user("staff", is_staff=True)))
+        thread.join()
+
+        self.assertEqual(outcome, ["rejected"])
+
+    def test_tier_from_groups(self):
+        admission = make_admission_controller()
+
+        self.assertEqual(admission.tier_for(make_user(1, groups=["staff"])).name, "staff")
+        self.assertEqual(admission.tier_for(make_user(2, is_staff=True)).name, "staff")
+        self.assertEqual(admission.tier_for(make_user(3, groups=["other"])).name, "default")
+
+    def test_admit_async(self):
+        admission = make_admission_controller()
+
+        async def admit_twice():
+            await admission.admit_async()
+            await admission.admit_async()
+
+        start = time.perf_counter()
+        asyncio.run(admit_twice())
+        # The second call waited for the next token (0.1s at 600 per minute)
+        self.assertGreater(time.perf_counter() - start, 0.05)
+
+    def test_quota_errors_from_vertex_drain_the_bucket(self):
+        client = GeminiClient.__new__(GeminiClient)
+        client.model = MagicMock()
+        client.admission = make_admission_controller(burst=10)
+        client.transport = MagicMock()
+        client.transport.call.side_effect = google_exceptions.ResourceExhausted("quota")
+
+        with self.assertRaises(AdmissionRejected):
+            client.generate_content("find me cooking videos")
+        self.assertLess(client.admission.bucket.tokens, 1)
+
+    def test_rejections_are_answered_with_429(self):
+        response = ChatAPI().handle_exception(AdmissionRejected("Gemini call rejected", retry_after=3))
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "3")
@@ -1,6 +1,12 @@
 from django.urls import path
-from .views import ChatAPI
+from .views import ChatAPI, ChatStreamAPI, AsyncChatAPI, ChatBatchAPI, ResponseCacheStatsAPI, TransportHealthAPI, metrics_view
 
 urlpatterns = [
     path('chat/', ChatAPI.as_view(), name='chat'),
+    path('chat/stream/', ChatStreamAPI.as_view(), name='chat-stream'),
+    path('chat/async/', AsyncChatAPI.as_view(), name='chat-async'),
+    path('chat/batch/', ChatBatchAPI.as_view(), name='chat-batch'),
+    path('chat/cache-stats/', ResponseCacheStatsAPI.as_view(), name='chat-cache-stats'),
+    path('chat/transport-health/', TransportHealthAPI.as_view(), name='chat-transport-health'),
+    path('metrics/', metrics_view, name='metrics'),
 ]
@@ -0,0 +1,8 @@
+from itertools import islice
+
+
+# Splits an iterable into lists of up to `size` items, without reading more than one batch ahead
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
@@ -0,0 +1,79 @@
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.urls import get_resolver
+from django.utils.module_loading import import_string
+
+from chatbot.utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+client_startup = registry.gauge(
+    "chatbot_client_startup_seconds",
+    "Time the current worker took to build each client (init) and to open its connections (warm_up)",
+    labels=("client", "phase"),
+)
+
+clients = {}
+
+
+# A client built the first time it is used in a process, instead of when its module is imported. The factory can be
+# a dotted path so the client's own module (e.g. Vertex AI) isn't imported either until then. Instances are keyed by
+# pid like the Typesense session, so forked workers never share one built before the fork. Used as a class
+# attribute it reads like the client itself, and a view instance can still replace it (tests, benchmarks).
+class LazyClient:
+    def __init__(self, name, factory):
+        self.name = name
+        self.factory = factory
+        self.instances = {}
+        self.lock = threading.Lock()
+        clients[name] = self
+
+    def __get__(self, instance, owner):
+        return self.get()
+
+    def get(self):
+        pid = os.getpid()
+        if pid not in self.instances:
+            with self.lock:
+                if pid not in self.instances:
+                    start = time.perf_counter()
+                    factory = import_string(self.factory) if isinstance(self.factory, str) else self.factory
+                    client = factory()
+                    self.instances.clear()
+                    self.instances[pid] = client
+                    client_startup.set(time.perf_counter() - start, client=self.name, phase="init")
+        return self.instances[pid]
+
+    # Clients that have something to open in advance (connections, models) do it in a warm_up method
+    def warm_up(self):
+        client = self.get()
+        warm_up = getattr(client, "warm_up", None)
+        if warm_up is not None:
+            warm_up()
+
+
+# Called from the WSGI/ASGI entry points when a worker boots. A client that can't be warmed up only logs a warning,
+# it will be built (or fail) again on its first request like without warm-up.
+def warm_up_clients(names=None):
+    if names is None:
+        if not settings.CLIENT_WARM_UP["ENABLED"]:
+            return
+        names = settings.CLIENT_WARM_UP["CLIENTS"]
+
+    # Loading the URLconf imports the views, which declare their clients. The first request would do it anyway.
+    get_resolver().url_patterns
+    for name in names:
+        if name not in clients:
+            raise ImproperlyConfigured(f"CLIENT_WARM_UP has an unknown client: {name}")
+        start = time.perf_counter()
+        try:
+            clients[name].warm_up()
+        except Exception as error:
+            logger.warning("Could not warm up the %s client: %s", name, error)
+            continue
+        client_startup.set(time.perf_counter() - start, client=name, phase="warm_up")
@@ -0,0 +1,210 @@
+import bisect
+import contextvars
+import json
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+trace_logger = logging.getLogger("chatbot.trace")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    def set(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self.lock:
+            self.values[key] = value
+
+    def render(self):
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self.values[key] = (counts, total + value)
+
+    def average(self, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self.lock:
+            counts, total = self.values.get(key, ((), 0.0))
+            count = sum(counts)
+        return total / count if count else 0.0
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += count
+                    labels = format_labels(self.labels + ("le",), key + (bound,))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = format_labels(self.labels, key)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+# Process-wide registry rendered in the Prometheus text format. Collectors are callbacks that refresh gauges
+# from other components (caches, transports) right before a scrape.
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def add_collector(self, collector):
+        with self.lock:
+            self.collectors.append(collector)
+
+    def render(self):
+        for collector in list(self.collectors):
+            collector()
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+stage_duration = registry.histogram(
+    "chatbot_stage_duration_seconds", "Time spent in each stage of a chat request", labels=("stage",)
+)
+gemini_tokens = registry.counter(
+    "chatbot_gemini_tokens_total", "Tokens billed by Gemini", labels=("type",)
+)
+requests_total = registry.counter(
+    "chatbot_requests_total", "Chat requests handled", labels=("path", "status")
+)
+
+
+# Stage timings of the request being handled, read by the Server-Timing header and the sampled trace log
+class RequestTimings:
+    def __init__(self, sampled=False):
+        self.sampled = sampled
+        self.stages = []
+        self.tokens = {}
+        self.start = time.perf_counter()
+
+    def add(self, name, duration):
+        self.stages.append((name, duration))
+
+    def server_timing_header(self):
+        return ", ".join(f"{name};dur={duration * 1000:.1f}" for name, duration in self.stages)
+
+    def trace(self, path, status_code):
+        return {
+            "path": path,
+            "status": status_code,
+            "total_ms": round((time.perf_counter() - self.start) * 1000, 2),
+            "stages": [{"stage": name, "ms": round(duration * 1000, 2)} for name, duration in self.stages],
+            "tokens": self.tokens,
+        }
+
+
+current_timings = contextvars.ContextVar("chatbot_request_timings", default=None)
+
+
+def start_request():
+    timings = RequestTimings(sampled=random.random() < settings.METRICS["TRACE_SAMPLE_RATE"])
+    current_timings.set(timings)
+    return timings
+
+
+def finish_request(timings, path, status_code):
+    requests_total.inc(path=path, status=status_code)
+    if timings.sampled:
+        trace_logger.info(json.dumps(timings.trace(path, status_code)))
+    current_timings.set(None)
+
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        stage_duration.observe(duration, stage=name)
+        timings = current_timings.get()
+        if timings is not None:
+            timings.add(name, duration)
+
+
+def record_gemini_usage(response):
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    counts = {
+        "prompt": getattr(usage, "prompt_token_count", 0) or 0,
+        "completion": getattr(usage, "candidates_token_count", 0) or 0,
+        # Part of the prompt tokens Gemini served from its implicit prefix cache, billed at the reduced rate
+        "cached": getattr(usage, "cached_content_token_count", 0) or 0,
+    }
+    timings = current_timings.get()
+    for token_type, count in counts.items():
+        gemini_tokens.inc(count, type=token_type)
+        if timings is not None and timings.sampled:
+            timings.tokens[token_type] = timings.tokens.get(token_type, 0) + count
@@ -1,17 +1,190 @@
 import json
 import re
+from datetime import date
+
+from chatbot.utils.metrics import registry, stage
+
+parsed_responses = registry.counter(
+    "chatbot_parsed_responses_total",
+    "Gemini responses by how they were parsed (json, text when there was no JSON object, invalid)",
+    labels=("result",),
+)
+
+INTENTS = ("find video", "find podcast", "others")
+QUERY_OPTION_FIELDS = ("topic", "title", "view_count", "release_date_before", "release_date_after")
+DATE_PATTERN = re.compile(r"^(\d{4})-(\d{1,2})-(\d{1,2})$")
+VIEW_COUNT_PATTERN = re.compile(r"^(>=|<=|>|<)?\d+$")
+
+
+class ResponseFormatError(Exception):
+    pass
+
+
+# Pulls the first complete JSON object out of text that arrives in chunks, with or without ```json fences or
+# prose around it. feed() returns the object as soon as its closing brace arrives, so a stream can be abandoned
+# there instead of paying for whatever Gemini generates after it. Balanced candidates that aren't valid JSON
+# (e.g. "{ topic: string }" echoed from the prompt) are skipped and scanning resumes after their opening brace.
+class JSONObjectExtractor:
+    def __init__(self):
+        self.text = ""
+        self.position = 0
+        self.start = None
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.result = None
+
+    @property
+    def done(self):
+        return self.result is not None
+
+    def feed(self, chunk):
+        if self.done:
+            return self.result
+        self.text += chunk
+
+        while self.position < len(self.text):
+            if self.start is None:
+                start = self.text.find("{", self.position)
+                if start == -1:
+                    self.position = len(self.text)
+                    return None
+                self.start, self.depth, self.position = start, 0, start
+
+            char = self.text[self.position]
+            self.position += 1
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char == "{":
+                self.depth += 1
+            elif char == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    candidate = self.text[self.start:self.position]
+                    try:
+                        value = json.loads(candidate)
+                    except json.JSONDecodeError:
+                        value = None
+                    if isinstance(value, dict):
+                        self.result = value
+                        return value
+                    self.position, self.start = self.start + 1, None
+        return None
 
 
 class ResponseParser:
-    # Convert the JSON response from Gemini into a python object so that we can use the data
+    # Convert the JSON response from Gemini into a python object so that we can use the data. The fields are
+    # checked against what the views expect; a reply without any JSON object is treated as a plain text answer.
     def convert_to_python_object(self, response):
-        match = re.search(r"```json\n(.*?)\n```", response.text, re.DOTALL)
-
-        if match:
-            json_content = match.group(1)
-            try:
-                return json.loads(json_content)
-            except json.JSONDecodeError:
-                return {"error", "Invalid JSON format"}
-        else:
-            return response.text
+        with stage("parse"):
+            data = self.extract_object(response.text)
+            if data is None:
+                if not response.text.strip():
+                    parsed_responses.inc(result="invalid")
+                    raise ResponseFormatError("Gemini returned an empty response")
+                parsed_responses.inc(result="text")
+                return {"intent": "others", "summary": "", "response": response.text.strip()}
+            validated = self.validate_response(data)
+            parsed_responses.inc(result="json")
+            return validated
+
+    # For the query options prompt, which answers with the options object itself
+    def convert_to_query_options(self, response):
+        with stage("parse"):
+            data = self.extract_object(response.text)
+            if data is None:
+                parsed_responses.inc(result="invalid")
+                raise ResponseFormatError("Gemini didn't return a query options object")
+            parsed_responses.inc(result="json")
+            return self.validate_query_options(data)
+
+    @staticmethod
+    def extract_object(text):
+        data = JSONObjectExtractor().feed(text)
+        if data is None:
+            # An unmatched brace before the object keeps the extractor from ever closing it, try every opening brace
+            decoder = json.JSONDecoder()
+            for match in re.finditer(r"{", text):
+                try:
+                    value, _ = decoder.raw_decode(text, match.start())
+                except json.JSONDecodeError:
+                    continue
+                if isinstance(value, dict):
+                    return value
+        return data
+
+    @staticmethod
+    def validate_response(data):
+        if not isinstance(data.get("response"), str):
+            parsed_responses.inc(result="invalid")
+            raise ResponseFormatError("The response field is missing from Gemini's reply")
+
+        intent = data.get("intent")
+        intent = intent.strip().lower() if isinstance(intent, str) else ""
+        summary = data.get("summary")
+        query_options = data.get("query_options")
+        return {
+            "intent": intent if intent in INTENTS else "others",
+            "summary": summary if isinstance(summary, str) else "",
+            "response": data["response"],
+            "query_options": (
+                ResponseParser.validate_query_options(query_options) if isinstance(query_options, dict) else None
+            ),
+        }
+
+    # Every option ends up a string. Values Typesense can't use (a date that isn't a real Year-Month-Day, a view count
+    # that isn't a number with an optional comparison) are dropped instead of failing the search.
+    @staticmethod
+    def validate_query_options(data):
+        options = {}
+        for field in QUERY_OPTION_FIELDS:
+            value = data.get(field)
+            if isinstance(value, bool) or value is None:
+                value = ""
+            elif isinstance(value, (int, float)):
+                value = str(int(value))
+            elif not isinstance(value, str):
+                value = ""
+            value = value.strip()
+
+            if field == "view_count":
+                value = re.sub(r"[\s,]", "", value)
+                value = value if VIEW_COUNT_PATTERN.match(value) else ""
+            elif field.startswith("release_date"):
+                value = ResponseParser.validate_date(value)
+            options[field] = value
+        return options
+
+    # "2023-2-5" becomes "2023-02-05". Dates that don't exist ("2023-02-30") are dropped like any other bad value.
+    @staticmethod
+    def validate_date(value):
+        match = DATE_PATTERN.match(value)
+        if not match:
+            return ""
+        year, month, day = match.groups()
+        try:
+            return date.fromisoformat(f"{year}-{month:0>2}-{day:0>2}").isoformat()
+        except ValueError:
+            return ""
+
+    # While a response is still streaming in, pull out the part of a string field generated so far,
+    # e.g. the "response" text of '```json\n{"intent": "others", "response": "Here are so'
+    @staticmethod
+    def extract_partial_field(text, field):
+        match = re.search(rf'"{field}"\s*:\s*"((?:[^"\\]|\\.)*)', text)
+        if not match:
+            return ""
+        value = match.group(1)
+        # Don't decode half of an escape sequence, it will be complete in the next chunk
+        value = re.sub(r"\\(u[0-9a-fA-F]{0,3})?$", "", value)
+        try:
+            return json.loads(f'"{value}"')
+        except json.JSONDecodeError:
+            return ""
@@ -0,0 +1,179 @@
+import asyncio
+import hashlib
+import threading
+import time
+import weakref
+
+from django.conf import settings
+from django.core.cache import caches
+
+from chatbot.utils.metrics import registry
+
+flight_calls = registry.counter(
+    "chatbot_single_flight_calls_total",
+    "Coalesced calls by role (leader ran the call, follower shared an in-process call, remote shared another worker's)",
+    labels=("flight", "role"),
+)
+coalescing_ratio = registry.gauge(
+    "chatbot_single_flight_coalescing_ratio",
+    "Fraction of calls that shared another call's result instead of running their own",
+    labels=("flight",),
+)
+
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# Identical concurrent calls share one in-flight execution: the first caller for a key (the leader) runs it, the
+# others wait and get its result or its exception. Keys only live while the call runs, this is not a cache.
+# Errors in `unshared_errors` belong to the leader (its admission quota), a follower runs the call itself instead.
+# Followers stop waiting with a TimeoutError after `wait_timeout` seconds, or the `timeout` given to the call.
+#
+# With `shared`, the leader also takes a lock in a Django cache (e.g. Redis) so one call runs across all workers.
+# Leaders of other workers poll for the result it stores for `result_ttl` seconds and run the call themselves if
+# it doesn't show up within `lock_timeout`. Results go through `encode`/`decode` on the way, they must pickle.
+class SingleFlight:
+    def __init__(
+        self, name, shared=False, cache_alias="default", lock_timeout=30, poll_interval=0.05, result_ttl=10,
+        encode=None, decode=None, wait_timeout=30, unshared_errors=(),
+    ):
+        self.name = name
+        self.shared = shared
+        self.cache_alias = cache_alias
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self.result_ttl = result_ttl
+        self.encode = encode or (lambda result: result)
+        self.decode = decode or (lambda value: value)
+        self.wait_timeout = wait_timeout
+        self.unshared_errors = tuple(unshared_errors)
+        self.calls = {}
+        self.tasks = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+        self.total = 0
+        self.coalesced = 0
+
+    @classmethod
+    def from_settings(cls, name, encode=None, decode=None, unshared_errors=()):
+        config = settings.SINGLE_FLIGHT
+        if not config["ENABLED"]:
+            return None
+        return cls(
+            name,
+            shared=config["SHARED"],
+            cache_alias=config["CACHE_ALIAS"],
+            lock_timeout=config["LOCK_TIMEOUT_SECONDS"],
+            poll_interval=config["POLL_INTERVAL_SECONDS"],
+            result_ttl=config["RESULT_TTL_SECONDS"],
+            encode=encode,
+            decode=decode,
+            wait_timeout=config["WAIT_TIMEOUT_SECONDS"],
+            unshared_errors=unshared_errors,
+        )
+
+    def do(self, key, call, timeout=None):
+        deadline = time.monotonic() + (self.wait_timeout if timeout is None else timeout)
+        while True:
+            with self.lock:
+                pending = self.calls.get(key)
+                leader = pending is None
+                if leader:
+                    pending = self.calls[key] = Call()
+            if leader:
+                break
+
+            self.record("follower")
+            if not pending.done.wait(max(0, deadline - time.monotonic())):
+                raise TimeoutError(f"{self.name} call is still running, stopped waiting for it")
+            if isinstance(pending.error, self.unshared_errors):
+                continue
+            if pending.error is not None:
+                raise pending.error
+            return pending.result
+
+        try:
+            pending.result = self.run_shared(key, call) if self.shared else self.run(call)
+        except Exception as error:
+            pending.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            pending.done.set()
+        return pending.result
+
+    # Coalesces coroutines on the running event loop. `call` returns a new coroutine, only the leader's is awaited.
+    # The call is shielded so a cancelled leader (or a follower that stops waiting) doesn't cancel it for the
+    # others. No shared mode here: polling a cache lock would hold up the loop, and one ASGI process already serves
+    # most concurrent requests.
+    async def do_async(self, key, call, timeout=None):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (self.wait_timeout if timeout is None else timeout)
+        tasks = self.tasks.setdefault(loop, {})
+        while True:
+            task = tasks.get(key)
+            if task is None:
+                self.record("leader")
+                task = tasks[key] = asyncio.ensure_future(call())
+                task.add_done_callback(lambda _: tasks.pop(key, None))
+                return await asyncio.shield(task)
+
+            self.record("follower")
+            try:
+                return await asyncio.wait_for(asyncio.shield(task), max(0, deadline - loop.time()))
+            except self.unshared_errors:
+                continue
+
+    def run(self, call):
+        self.record("leader")
+        return call()
+
+    def run_shared(self, key, call):
+        cache = caches[self.cache_alias]
+        digest = hashlib.sha256(repr(key).encode()).hexdigest()
+        lock_key = f"single-flight:{self.name}:{digest}:lock"
+        result_key = f"single-flight:{self.name}:{digest}:result"
+
+        if not cache.add(lock_key, 1, timeout=self.lock_timeout):
+            # Another worker is running it, the result is stored before its lock is released
+            deadline = time.monotonic() + self.lock_timeout
+            while time.monotonic() < deadline:
+                value = cache.get(result_key)
+                if value is None and cache.get(lock_key) is None:
+                    value = cache.get(result_key)
+                    if value is None:
+                        break
+                if value is not None:
+                    self.record("remote")
+                    return self.decode(value)
+                time.sleep(self.poll_interval)
+            return self.run(call)
+
+        try:
+            result = self.run(call)
+            if result is not None:
+                cache.set(result_key, self.encode(result), timeout=self.result_ttl)
+            return result
+        finally:
+            cache.delete(lock_key)
+
+    def record(self, role):
+        flight_calls.inc(flight=self.name, role=role)
+        with self.lock:
+            self.total += 1
+            if role != "leader":
+                self.coalesced += 1
+            ratio = self.coalesced / self.total
+        coalescing_ratio.set(round(ratio, 4), flight=self.name)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "calls": self.total,
+                "coalesced": self.coalesced,
+                "coalescing_ratio": round(self.coalesced / self.total, 4) if self.total else 0.0,
+            }
@@ -0,0 +1,63 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+# Thread-safe in-process cache with a TTL and least-recently-used eviction once max_entries
+# (or max_bytes, when a sizeof function is given) is exceeded
+class TTLCache:
+    def __init__(self, max_entries=1000, ttl=300, max_bytes=None, sizeof=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at, _ = entry
+            if expires_at < time.monotonic():
+                self.remove(key)
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        size = self.sizeof(value) if self.sizeof else 0
+        with self.lock:
+            self.remove(key)
+            self.entries[key] = (value, expires_at, size)
+            self.size += size
+            while len(self.entries) > self.max_entries or (
+                self.max_bytes and self.size > self.max_bytes and len(self.entries) > 1
+            ):
+                self.remove(next(iter(self.entries)))
+
+    def delete(self, key):
+        with self.lock:
+            self.remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def values(self):
+        now = time.monotonic()
+        with self.lock:
+            return [value for value, expires_at, _ in self.entries.values() if expires_at >= now]
+
+    # Callers must hold the lock
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def __len__(self):
+        return len(self.entries)
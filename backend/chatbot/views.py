@@ -1,22 +1,79 @@
-from chatbot.utils.response_parser import ResponseParser
-from chatbot.clients.gemini_client import GeminiClient
-from chatbot.services.video_search import VideoSearchService
+from chatbot.utils.response_parser import JSONObjectExtractor, ResponseFormatError, ResponseParser
+from chatbot.clients.admission import AdmissionRejected, current_ticket, start_admission, ticket_for
+from chatbot.clients.transport import TransportUnavailable, call_deadline, transports_health
+from chatbot.utils.metrics import registry, stage, stage_duration
+from chatbot.services.intent_classifier import IntentClassifier, may_be_search
 from chatbot.services.prompts import Prompts
+from chatbot.services.response_cache import CachedResponse, ResponseCache, response_key
+from chatbot.services.batch_chat import BatchChatProcessor
+from chatbot.services.conversation_store import ConversationStore
+from chatbot.services.search_collections import is_search_intent
+from chatbot.utils.lazy_client import LazyClient
+from chatbot.utils.single_flight import SingleFlight
 
+import asyncio
+import hmac
+import json
 import re
+import time
 
-from rest_framework import status, permissions
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from knox.auth import TokenAuthentication
+from rest_framework import exceptions, status, permissions
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+NO_RESULTS_MESSAGE = "Sorry, we couldn't find what you were looking for."
+TOO_MANY_REQUESTS_MESSAGE = "Too many requests, please try again shortly"
+
+# Built on first use in each worker (see chatbot.utils.lazy_client), importing the views doesn't load Vertex AI
+# or need GCP and Typesense settings
+lazy_gemini_client = LazyClient("gemini", "chatbot.clients.gemini_client.GeminiClient")
+lazy_video_search_service = LazyClient("video_search", "chatbot.services.video_search.VideoSearchService")
+
+
+def service_unavailable(exc):
+    return Response(
+        {"error": "The service is temporarily unavailable, please try again shortly"},
+        status=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+def too_many_requests(exc):
+    return Response(
+        {"error": TOO_MANY_REQUESTS_MESSAGE},
+        status=status.HTTP_429_TOO_MANY_REQUESTS,
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+# How long a follower of a coalesced Gemini generation waits: as long as its own call could have taken
+def gemini_deadline():
+    ticket = current_ticket.get()
+    admission_wait = ticket.tier.max_wait if ticket is not None else 0
+    return admission_wait + call_deadline("gemini")
+
 
 class ChatAPI(APIView):
     permission_classes = [
         permissions.IsAuthenticated,
     ]
-    gemini_client = GeminiClient()
+    gemini_client = lazy_gemini_client
     parse_response = ResponseParser()
-    video_search_service = VideoSearchService()
+    video_search_service = lazy_video_search_service
+    response_cache = ResponseCache.from_settings(embed=lambda text: lazy_gemini_client.get().embed(text))
+    intent_classifier = IntentClassifier()
+    conversation_store = ConversationStore.from_settings()
+    # Shared across workers as text, followers in other workers get a CachedResponse. A leader rejected by
+    # admission control used up its own quota, its followers try with theirs.
+    gemini_flight = SingleFlight.from_settings(
+        "gemini", encode=lambda response: response.text, decode=CachedResponse, unshared_errors=(AdmissionRejected,)
+    )
 
     def post(self, request):
         user_prompt = request.data.get("prompt")
@@ -27,8 +84,19 @@ class ChatAPI(APIView):
                 {"error": "No prompt provided"}, status=status.HTTP_400_BAD_REQUEST
             )
 
-        prompt = Prompts.create_initial_prompt(user_prompt, chat_summary)
-        gemini_response = self.gemini_client.send_message(prompt)
+        conversation = self.load_conversation(request)
+        if conversation is not None:
+            return self.converse(conversation, user_prompt)
+
+        fast_path_response = self.classify_locally(user_prompt, chat_summary)
+        if fast_path_response is not None:
+            return self.build_response(fast_path_response, user_prompt)
+
+        prompt = self.create_prompt(user_prompt, chat_summary)
+        with stage("gemini_initial"):
+            gemini_response = self.send_prompt(
+                prompt, user_prompt, chat_summary, session_key=self.get_session_key(request)
+            )
 
         if gemini_response:
             formatted_response = self.parse_response.convert_to_python_object(
@@ -42,30 +110,479 @@ class ChatAPI(APIView):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR,
             )
 
-    def build_response(self, formatted_response, user_prompt):
+    # Requests with a conversation_id keep their state server-side, the summary sent by the client is ignored
+    def load_conversation(self, request):
+        conversation_id = request.data.get("conversation_id")
+        if self.conversation_store is None or not conversation_id:
+            return None
+        return self.conversation_store.load(request.user.pk, conversation_id)
+
+    # Only the new request and the compact conversation state go to Gemini, and no summary is generated
+    def converse(self, conversation, user_prompt):
+        context = conversation.context()
+        formatted_response = self.classify_locally(user_prompt, context)
+
+        if formatted_response is None:
+            with stage("prompt_build"):
+                prompt = Prompts.create_conversation_prompt(user_prompt, context)
+            with stage("gemini_initial"):
+                # Kept apart from stateless requests in the response cache, the prompt and response shape differ
+                gemini_response = self.send_prompt(prompt, user_prompt, f"[conversation] {context}")
+            if not gemini_response:
+                return Response(
+                    {"error": "There was an error in generating a response"},
+                    status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                )
+            formatted_response = self.parse_response.convert_to_python_object(gemini_response)
+
+        formatted_response["summary"] = context
+        return self.build_response(formatted_response, user_prompt, conversation)
+
+    # Gemini calls made for this request are admitted under the user's tier (see chatbot.clients.admission)
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        start_admission(request.user)
+
+    # An open circuit or saturated backend fails fast with a 503 instead of holding the request thread, and a
+    # call that got no Gemini quota in time with a 429
+    def handle_exception(self, exc):
+        if isinstance(exc, AdmissionRejected):
+            return too_many_requests(exc)
+        if isinstance(exc, TransportUnavailable):
+            return service_unavailable(exc)
+        if isinstance(exc, ResponseFormatError):
+            return Response(
+                {"error": "There was an error in generating a response"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            )
+        return super().handle_exception(exc)
+
+    # Simple requests ("cooking videos from 2023") are answered by local rules without calling Gemini
+    @classmethod
+    def classify_locally(cls, user_prompt, chat_summary):
+        if not settings.FAST_PATH_ENABLED:
+            return None
+        with stage("fast_path"):
+            return cls.intent_classifier.classify(user_prompt, chat_summary)
+
+    # Single-call mode asks for the Typesense query options in the same generation as the intent
+    @staticmethod
+    def create_prompt(user_prompt, chat_summary):
+        with stage("prompt_build"):
+            if settings.GEMINI_SINGLE_CALL_EXTRACTION:
+                return Prompts.create_combined_prompt(user_prompt, chat_summary)
+            return Prompts.create_initial_prompt(user_prompt, chat_summary)
+
+    def send_prompt(self, prompt, user_prompt, chat_summary, session_key=None):
+        # Pooled sessions depend on their history, so only stateless calls are cached and coalesced
+        if session_key is not None:
+            return self.gemini_client.send_message(prompt, session_key=session_key)
+        if self.gemini_flight is None:
+            return self.generate(prompt, user_prompt, chat_summary)
+        # Concurrent identical requests (a trending topic) share one cache lookup and Gemini generation
+        return self.gemini_flight.do(
+            response_key(user_prompt, chat_summary),
+            lambda: self.generate(prompt, user_prompt, chat_summary),
+            timeout=gemini_deadline(),
+        )
+
+    def generate(self, prompt, user_prompt, chat_summary):
+        if self.response_cache is None:
+            return self.gemini_client.send_message(prompt)
+        return self.response_cache.get_or_generate(
+            user_prompt, chat_summary, lambda: self.gemini_client.send_message(prompt)
+        )
+
+    # Only conversations that send a conversation_id get a pooled chat session, everything else is stateless.
+    # The conversation store owns conversations while it is enabled, the session pool is only used without it.
+    def get_session_key(self, request):
+        conversation_id = request.data.get("conversation_id")
+        if self.conversation_store is not None or not conversation_id:
+            return None
+        return f"{request.user.pk}:{conversation_id}"
+
+    def build_response(self, formatted_response, user_prompt, conversation=None):
+        response_data = self.create_response_data(formatted_response)
+        query_options = None
+
         intent = formatted_response.get("intent", "")
-        summary = formatted_response.get("summary", "")
-        text_response = formatted_response.get("response")
+        if is_search_intent(intent):
+            query_options = formatted_response.get("query_options")
+            if not query_options:
+                query_options = self.get_typesense_query_options(
+                    response_data["summary"], user_prompt
+                )
+            video_results = self.video_search_service.find_related_results(intent, query_options)
+            self.add_video_results(response_data, video_results)
+
+        if conversation is not None:
+            self.conversation_store.add_turn(
+                conversation, user_prompt, formatted_response.get("intent", ""), query_options
+            )
+            response_data["summary"] = conversation.context()
+            response_data["conversation_id"] = conversation.id
+
+        return Response(response_data, status=status.HTTP_200_OK)
 
-        response_data = {
-            "summary": summary,
+    @staticmethod
+    def create_response_data(formatted_response):
+        return {
+            "summary": formatted_response.get("summary", ""),
             "text_response": re.sub(
-                r"\n.*", "", text_response, flags=re.DOTALL
+                r"\n.*", "", formatted_response.get("response"), flags=re.DOTALL
             ),  # Need to clean the text response because gemini will sometimes provide extra information.
             "video_results": [],
         }
-        if intent == "find video":
-            query_options = self.get_typesense_query_options(summary, user_prompt)
-            video_results = self.video_search_service.find_related_videos(query_options)
+
+    @staticmethod
+    def add_video_results(response_data, video_results):
+        if len(video_results) == 0:
+            response_data["text_response"] = NO_RESULTS_MESSAGE
+        response_data["video_results"] = video_results
+
+    def get_typesense_query_options(self, summary, user_prompt):
+        prompt = Prompts.create_video_search_query_prompt(summary, user_prompt)
+        with stage("gemini_query_options"):
+            generate_query_options = self.gemini_client.send_message(prompt)
+        return self.parse_response.convert_to_query_options(generate_query_options)
+
+
+# Streaming variant of ChatAPI using server-sent events. The text of the reply is pushed as Gemini generates it
+# ("token" events), then the parsed "message" (summary + text_response), and finally "video_results" once the
+# Typesense search is done, so the client isn't waiting on the slowest stage before showing anything.
+class ChatStreamAPI(ChatAPI):
+    def post(self, request):
+        user_prompt = request.data.get("prompt")
+        chat_summary = request.data.get("summary", "")
+
+        if not user_prompt:
+            return Response(
+                {"error": "No prompt provided"}, status=status.HTTP_400_BAD_REQUEST
+            )
+
+        response = StreamingHttpResponse(
+            self.stream_events(user_prompt, chat_summary), content_type="text/event-stream"
+        )
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"  # Stop nginx from buffering the whole stream
+        return response
+
+    def stream_events(self, user_prompt, chat_summary):
+        try:
+            yield from self.generate_events(user_prompt, chat_summary)
+        except AdmissionRejected as exc:
+            yield self.format_event(
+                "error", {"error": TOO_MANY_REQUESTS_MESSAGE, "retry_after": exc.retry_after}
+            )
+        except Exception:
+            yield self.format_event(
+                "error", {"error": "There was an error in generating a response"}
+            )
+
+    def generate_events(self, user_prompt, chat_summary):
+        formatted_response = self.classify_locally(user_prompt, chat_summary)
+        if formatted_response is None:
+            formatted_response = yield from self.stream_generation(user_prompt, chat_summary)
+            if formatted_response is None:
+                return
+
+        response_data = self.create_response_data(formatted_response)
+        yield self.format_event(
+            "message",
+            {"summary": response_data["summary"], "text_response": response_data["text_response"]},
+        )
+
+        intent = formatted_response.get("intent", "")
+        if is_search_intent(intent):
+            query_options = formatted_response.get("query_options")
+            if not query_options:
+                query_options = self.get_typesense_query_options(
+                    response_data["summary"], user_prompt
+                )
+            video_results = self.video_search_service.find_related_results(intent, query_options)
+            event = {"video_results": video_results}
             if len(video_results) == 0:
-                response_data["text_response"] = (
-                    "Sorry, we couldn't find what you were looking for."
+                event["text_response"] = NO_RESULTS_MESSAGE
+            yield self.format_event("video_results", event)
+
+        yield self.format_event("done", {})
+
+    # Streams the reply text as "token" events and returns the parsed response (None after an error event)
+    def stream_generation(self, user_prompt, chat_summary):
+        gemini_response = None
+        if self.response_cache is not None:
+            gemini_response, vector = self.response_cache.lookup(user_prompt, chat_summary)
+
+        if gemini_response is None:
+            start = time.perf_counter()
+            text, streamed = "", ""
+            extractor = JSONObjectExtractor()
+            stream = self.gemini_client.stream_content(self.create_prompt(user_prompt, chat_summary))
+            try:
+                for chunk in stream:
+                    text += chunk
+                    partial = self.parse_response.extract_partial_field(text, "response")
+                    if len(partial) > len(streamed) and partial.startswith(streamed):
+                        yield self.format_event("token", {"text": partial[len(streamed):]})
+                        streamed = partial
+                    # Anything Gemini generates after the JSON object is thrown away, so stop the generation there
+                    if extractor.feed(chunk) is not None:
+                        break
+            finally:
+                stream.close()
+            # The stream spans several yields, so it's observed directly rather than through stage()
+            stage_duration.observe(time.perf_counter() - start, stage="gemini_stream")
+
+            if not text:
+                yield self.format_event(
+                    "error", {"error": "There was an error in generating a response"}
                 )
-            response_data["video_results"] = video_results
+                return None
 
-        return Response(response_data, status=status.HTTP_200_OK)
+            gemini_response = CachedResponse(text)
+            if self.response_cache is not None:
+                self.response_cache.set(
+                    user_prompt, chat_summary, gemini_response, time.perf_counter() - start, vector
+                )
 
-    def get_typesense_query_options(self, summary, user_prompt):
+        return self.parse_response.convert_to_python_object(gemini_response)
+
+    @staticmethod
+    def format_event(event, data):
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+# Async variant of ChatAPI for ASGI deployments. Gemini and Typesense are awaited instead of blocking a worker
+# thread, so one process can hold hundreds of in-flight chats. DRF's APIView is sync only, hence the plain Django view.
+class AsyncChatAPI(View):
+    authentication = TokenAuthentication()
+    gemini_client = lazy_gemini_client
+    parse_response = ChatAPI.parse_response
+    video_search_service = lazy_video_search_service
+    response_cache = ChatAPI.response_cache
+    gemini_flight = ChatAPI.gemini_flight
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def post(self, request):
+        user = await self.authenticate(request)
+        if not user:
+            return JsonResponse(
+                {"detail": "Authentication credentials were not provided."},
+                status=status.HTTP_401_UNAUTHORIZED,
+            )
+        # Looking up the user's tier may query their groups
+        current_ticket.set(await sync_to_async(ticket_for)(user))
+
+        try:
+            data = json.loads(request.body or b"{}")
+        except json.JSONDecodeError:
+            return JsonResponse(
+                {"error": "Invalid JSON body"}, status=status.HTTP_400_BAD_REQUEST
+            )
+
+        user_prompt = data.get("prompt")
+        chat_summary = data.get("summary", "")
+
+        if not user_prompt:
+            return JsonResponse(
+                {"error": "No prompt provided"}, status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            response_data = await self.generate_response(user_prompt, chat_summary)
+        except AdmissionRejected as exc:
+            response = JsonResponse({"error": TOO_MANY_REQUESTS_MESSAGE}, status=status.HTTP_429_TOO_MANY_REQUESTS)
+            response["Retry-After"] = str(exc.retry_after)
+            return response
+        except TransportUnavailable as exc:
+            response = JsonResponse(
+                {"error": "The service is temporarily unavailable, please try again shortly"},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            )
+            response["Retry-After"] = str(exc.retry_after)
+            return response
+        except ResponseFormatError:
+            response_data = None
+
+        if response_data is None:
+            return JsonResponse(
+                {"error": "There was an error in generating a response"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            )
+        return JsonResponse(response_data, status=status.HTTP_200_OK)
+
+    async def authenticate(self, request):
+        try:
+            result = await sync_to_async(self.authentication.authenticate)(request)
+        except exceptions.AuthenticationFailed:
+            return None
+        return result[0] if result else None
+
+    async def generate_response(self, user_prompt, chat_summary):
+        fast_path_response = ChatAPI.classify_locally(user_prompt, chat_summary)
+        if fast_path_response is not None:
+            return await self.complete_response(fast_path_response, user_prompt)
+
+        prompt = ChatAPI.create_prompt(user_prompt, chat_summary)
+
+        # In two-call mode the query options are requested alongside the intent (using the summary the client sent)
+        # instead of after it, but only for prompts that can lead to a search. The speculative call is cancelled
+        # if the request turns out not to be a video search, and always awaited so it can't outlive the request.
+        query_options_task = None
+        if not settings.GEMINI_SINGLE_CALL_EXTRACTION and may_be_search(user_prompt, chat_summary):
+            query_options_task = asyncio.create_task(
+                self.get_typesense_query_options(chat_summary, user_prompt)
+            )
+
+        try:
+            with stage("gemini_initial"):
+                gemini_response = await self.send_prompt(prompt, user_prompt, chat_summary)
+
+            if not gemini_response:
+                return None
+
+            formatted_response = self.parse_response.convert_to_python_object(gemini_response)
+            return await self.complete_response(formatted_response, user_prompt, query_options_task)
+        finally:
+            if query_options_task:
+                query_options_task.cancel()
+                await asyncio.gather(query_options_task, return_exceptions=True)
+
+    async def complete_response(self, formatted_response, user_prompt, query_options_task=None):
+        response_data = ChatAPI.create_response_data(formatted_response)
+
+        intent = formatted_response.get("intent", "")
+        # An unused speculative query options call is cancelled by generate_response
+        if not is_search_intent(intent):
+            return response_data
+
+        query_options = formatted_response.get("query_options")
+        if not query_options:
+            query_options = await (
+                query_options_task
+                or self.get_typesense_query_options(response_data["summary"], user_prompt)
+            )
+
+        video_results = await self.video_search_service.find_related_results_async(intent, query_options)
+        ChatAPI.add_video_results(response_data, video_results)
+
+        return response_data
+
+    async def send_prompt(self, prompt, user_prompt, chat_summary):
+        if self.gemini_flight is None:
+            return await self.generate(prompt, user_prompt, chat_summary)
+        return await self.gemini_flight.do_async(
+            response_key(user_prompt, chat_summary),
+            lambda: self.generate(prompt, user_prompt, chat_summary),
+            timeout=gemini_deadline(),
+        )
+
+    async def generate(self, prompt, user_prompt, chat_summary):
+        if self.response_cache is None:
+            return await self.gemini_client.generate_content_async(prompt)
+
+        # Cache lookups can hit the Django cache or the embedding model, keep them off the event loop
+        cached_response, vector = await sync_to_async(
+            self.response_cache.lookup, thread_sensitive=False
+        )(user_prompt, chat_summary)
+        if cached_response is not None:
+            return cached_response
+
+        start = time.perf_counter()
+        gemini_response = await self.gemini_client.generate_content_async(prompt)
+        if gemini_response:
+            await sync_to_async(self.response_cache.set, thread_sensitive=False)(
+                user_prompt, chat_summary, gemini_response, time.perf_counter() - start, vector
+            )
+        return gemini_response
+
+    async def get_typesense_query_options(self, summary, user_prompt):
         prompt = Prompts.create_video_search_query_prompt(summary, user_prompt)
-        generate_query_options = self.gemini_client.send_message(prompt)
-        return self.parse_response.convert_to_python_object(generate_query_options)
+        with stage("gemini_query_options"):
+            generate_query_options = await self.gemini_client.generate_content_async(prompt)
+        return self.parse_response.convert_to_query_options(generate_query_options)
+
+
+# Batch variant of ChatAPI for offline jobs (playlist generation, QA evaluation). Takes {"items": [{prompt, summary}]}
+# and streams one NDJSON line per item, in input order, as soon as its window is done. See BatchChatProcessor.
+class ChatBatchAPI(ChatAPI):
+    def post(self, request):
+        items = request.data.get("items")
+
+        if not isinstance(items, list) or not items:
+            return Response(
+                {"error": "No items provided"}, status=status.HTTP_400_BAD_REQUEST
+            )
+        if len(items) > settings.BATCH_CHAT["MAX_ITEMS"]:
+            return Response(
+                {"error": f"A batch can contain at most {settings.BATCH_CHAT['MAX_ITEMS']} items"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        lines = (json.dumps(result) + "\n" for result in BatchChatProcessor(self).process(items))
+        response = StreamingHttpResponse(lines, content_type="application/x-ndjson")
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+
+class ResponseCacheStatsAPI(APIView):
+    permission_classes = [
+        permissions.IsAdminUser,
+    ]
+
+    def get(self, request):
+        if ChatAPI.response_cache is None:
+            return Response({"enabled": False}, status=status.HTTP_200_OK)
+        return Response(
+            {"enabled": True, **ChatAPI.response_cache.stats()}, status=status.HTTP_200_OK
+        )
+
+
+class TransportHealthAPI(APIView):
+    permission_classes = [
+        permissions.IsAdminUser,
+    ]
+
+    def get(self, request):
+        return Response(transports_health(), status=status.HTTP_200_OK)
+
+
+def collect_component_metrics():
+    if ChatAPI.response_cache is not None:
+        for name, value in ChatAPI.response_cache.stats().items():
+            response_cache_stats.set(value, stat=name)
+    for name, health in transports_health().items():
+        for stat, value in health.items():
+            if stat == "state":
+                value = {"closed": 0, "half_open": 1, "open": 2}[value]
+            transport_stats.set(value, transport=name, stat=stat)
+
+
+response_cache_stats = registry.gauge(
+    "chatbot_response_cache", "Gemini response cache counters", labels=("stat",)
+)
+transport_stats = registry.gauge(
+    "chatbot_transport", "Outbound transport health (state: 0 closed, 1 half open, 2 open)", labels=("transport", "stat")
+)
+registry.add_collector(collect_component_metrics)
+
+
+# Scrapers are recognised by their address or a bearer token, they don't have a user account
+def metrics_view(request):
+    config = settings.METRICS
+    if not config["ENABLED"]:
+        raise Http404
+    if not is_metrics_scraper(request, config):
+        return HttpResponse("Forbidden", status=status.HTTP_403_FORBIDDEN, content_type="text/plain")
+    return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4")
+
+
+def is_metrics_scraper(request, config):
+    if request.META.get("REMOTE_ADDR") in config["ALLOWED_IPS"]:
+        return True
+    token = config.get("TOKEN")
+    authorization = request.META.get("HTTP_AUTHORIZATION", "")
+    return bool(token) and hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode())
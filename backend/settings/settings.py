@@ -30,6 +30,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'chatbot',
 ]
 
 MIDDLEWARE = [
@@ -40,6 +41,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'chatbot.middleware.ServerTimingMiddleware',
 ]
 
 ROOT_URLCONF = 'settings.urls'
@@ -71,6 +73,30 @@ DATABASES = {
     }
 }
 
+# 'default' is per process (local memory). 'shared' holds the state every worker and management command must see:
+# collection epochs, conversations, cross-worker single-flight locks and the 'django' response cache. It is Redis
+# when config.ini has a [Redis] URL, otherwise the database (run `manage.py createcachetable` once). Workers refuse
+# to start when something that has to be shared points at a local-memory cache (see chatbot.checks).
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': config['Redis']['URL'],
+    } if config.has_option('Redis', 'URL') else {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'chatbot_shared_cache',
+    },
+}
+
+# The epoch of each Typesense collection is kept in the CACHE_ALIAS cache (shared between processes). Workers reuse
+# an epoch they read for REFRESH_SECONDS, so a re-index reaches their search caches at most that late.
+COLLECTION_EPOCH = {
+    'CACHE_ALIAS': 'shared',
+    'REFRESH_SECONDS': 1,
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -113,16 +139,223 @@ STATIC_URL = 'static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# HOST can be a comma separated list of nodes for failover
 TYPESENSE_CONFIG = {
     'api_key': config['Typesense']['API_KEY'],
     'nodes': [{
-        'host': config['Typesense']['HOST'],
+        'host': host.strip(),
         'port': config['Typesense']['PORT'],
         'protocol': config['Typesense']['PROTOCOL']
-    }],
-    'connection_timeout_seconds': 2
+    } for host in config['Typesense']['HOST'].split(',')],
+    'connection_timeout_seconds': 2,
+    'num_retries': 2,
+    'retry_interval_seconds': 0.1,
+    'healthcheck_interval_seconds': 15,
 }
 
 GCP_VERTEX_AI_REGION = config['GCP']['VERTEX_AI_REGION']
 GCP_PROJECT_ID = config['GCP']['PROJECT_ID']
-GCP_VERTEX_AI_MODEL = config['GCP']['VERTEX_AI_MODEL']
\ No newline at end of file
+GCP_VERTEX_AI_MODEL = config['GCP']['VERTEX_AI_MODEL']
+
+# Ask Gemini for the intent and the Typesense query options in one generation.
+# Set to False to fall back to the original two-call flow (initial prompt, then video search query prompt).
+GEMINI_SINGLE_CALL_EXTRACTION = True
+
+# Upper bound (estimated at ~4 characters per token) on a prompt's input tokens, the summary is cut to fit
+GEMINI_PROMPT_TOKEN_BUDGET = 1500
+
+# Gemini calls are stateless by default. Setting a pool size keeps a chat session per user/conversation_id
+# (least recently used sessions are evicted) with its history trimmed to the token budget below. The pool is only
+# used while CONVERSATION_STORE is disabled, otherwise the store keeps every conversation that sends an id.
+GEMINI_SESSION_POOL_SIZE = 0
+GEMINI_SESSION_MAX_HISTORY_TOKENS = 4000
+
+# Cache for the first Gemini call of a chat, keyed on the normalised (prompt, summary, template version).
+# BACKEND is 'memory' (per process), 'django' (the CACHE_ALIAS entry of CACHES, shared between workers) or None to disable.
+# Setting SEMANTIC_THRESHOLD (cosine similarity, e.g. 0.95) also reuses responses for near-identical prompts using EMBEDDING_MODEL.
+# That costs an embedding call per lookup, and a scan of the last SEMANTIC_MAX_ENTRIES prompt embeddings held in memory.
+GEMINI_RESPONSE_CACHE = {
+    'BACKEND': 'memory',
+    'CACHE_ALIAS': 'shared',
+    'TTL_SECONDS': 3600,
+    'MAX_ENTRIES': 10000,
+    'SEMANTIC_THRESHOLD': None,
+    'SEMANTIC_MAX_ENTRIES': 2000,
+    'EMBEDDING_MODEL': 'text-embedding-004',
+}
+
+# Typesense collections (or aliases) searched per intent, see chatbot.services.search_collections. An intent served by
+# several collections searches all of them in one multi_search and the results are merged by rank, WEIGHT favouring
+# a collection. SEARCH_CUTOFF_MS makes Typesense return what it found so far when a collection's search runs long,
+# so one slow index can't hold up the response. FACETS marks collections indexed with the FILTER_FACETS fields.
+# A collection that doesn't exist in Typesense yet (e.g. podcasts, which no command creates) is left out of searches.
+SEARCH_COLLECTIONS = {
+    'videolists': {
+        'INTENTS': ('find video', 'find podcast'),
+        'QUERY_BY': 'titles, tags, description',
+        'QUERY_BY_WEIGHT': '3, 2, 1',
+        'SEARCH_CUTOFF_MS': 200,
+        'WEIGHT': 1.0,
+        'FACETS': True,
+    },
+    'podcasts': {
+        'INTENTS': ('find podcast',),
+        'QUERY_BY': 'titles, tags, description',
+        'QUERY_BY_WEIGHT': '3, 2, 1',
+        'SEARCH_CUTOFF_MS': 200,
+        'WEIGHT': 2.0,
+        'FACETS': False,
+    },
+}
+
+# In-process cache of Typesense video results keyed on the normalised search parameters.
+# Entries are dropped on re-index (see chatbot.services.collection_epoch). Set MAX_ENTRIES to 0 to disable.
+VIDEO_SEARCH_CACHE = {
+    'TTL_SECONDS': 300,
+    'MAX_ENTRIES': 5000,
+    'MAX_BYTES': 50 * 1024 * 1024,
+}
+
+# Call policy for outbound requests (see chatbot.clients.transport). Each call gets TIMEOUT_SECONDS, failures are
+# retried MAX_RETRIES times with jittered exponential backoff, and HEDGE_AFTER_SECONDS (None to disable) starts a
+# second identical request when the first is slow. After FAILURE_THRESHOLD consecutive failures the circuit opens
+# for RESET_TIMEOUT_SECONDS and calls fail fast. MAX_CONCURRENCY caps in-flight calls per worker process.
+TRANSPORTS = {
+    'typesense': {
+        'TIMEOUT_SECONDS': 2,
+        'MAX_RETRIES': 2,
+        'BACKOFF_BASE_SECONDS': 0.05,
+        'BACKOFF_MAX_SECONDS': 1,
+        'HEDGE_AFTER_SECONDS': 0.3,
+        'FAILURE_THRESHOLD': 5,
+        'RESET_TIMEOUT_SECONDS': 30,
+        'MAX_CONCURRENCY': 64,
+        'POOL_SIZE': 32,
+    },
+    'gemini': {
+        'TIMEOUT_SECONDS': 30,
+        'MAX_RETRIES': 2,
+        'BACKOFF_BASE_SECONDS': 0.5,
+        'BACKOFF_MAX_SECONDS': 8,
+        'HEDGE_AFTER_SECONDS': None,
+        'FAILURE_THRESHOLD': 5,
+        'RESET_TIMEOUT_SECONDS': 30,
+        'MAX_CONCURRENCY': 64,
+    },
+}
+
+# Prometheus-style metrics are served at chatbot/metrics/. Stage timings are always recorded (and returned in the
+# Server-Timing header), a TRACE_SAMPLE_RATE fraction of requests also logs a full trace to the chatbot.trace logger.
+# The endpoint shows the same cache and transport stats as the admin-only APIs, so it only answers scrapers from
+# ALLOWED_IPS, or sending `Authorization: Bearer <TOKEN>` (the [Metrics] TOKEN of config.ini, if set).
+METRICS = {
+    'ENABLED': True,
+    'TRACE_SAMPLE_RATE': 0.01,
+    'ALLOWED_IPS': ('127.0.0.1', '::1'),
+    'TOKEN': config.get('Metrics', 'TOKEN', fallback=None),
+}
+
+# Answer explicit, self-contained searches ("find me cooking videos from 2023") with local rules instead of Gemini.
+# Anything else (questions, negations, making or fixing a video, conditions the rules don't understand) goes to the model.
+FAST_PATH_ENABLED = True
+
+# In-process index of normalised video titles -> document ids, so "find me this video '<title>'" skips full-text
+# search. Built at warm-up (CLIENT_WARM_UP) or in a background thread on the first title request, which use full-text
+# search until it is ready. Reloaded after every re-index (collection epoch) or MAX_AGE_SECONDS; a failed load is
+# retried after RETRY_SECONDS.
+TITLE_INDEX = {
+    'ENABLED': True,
+    'MAX_AGE_SECONDS': 3600,
+    'RETRY_SECONDS': 30,
+}
+
+# Batch chat endpoint (chat/batch/) and the chat_batch command. CONCURRENCY caps Gemini calls in flight per batch,
+# WINDOW_SIZE items share one Typesense multi_search and are streamed back together.
+BATCH_CHAT = {
+    'MAX_ITEMS': 1000,
+    'CONCURRENCY': 8,
+    'WINDOW_SIZE': 50,
+}
+
+# Hybrid keyword + vector search. Documents get an 'embedding' field at index time from a local sentence-transformers
+# MODEL (CPU, pip install sentence-transformers), and queries are embedded through an in-process LRU.
+# Enabling it needs a full re-index (typesense_reindex --mode full) so the collection has the embedding field.
+# ALPHA weighs the vector score against the keyword score, DISTANCE_THRESHOLD drops unrelated neighbours.
+VECTOR_SEARCH = {
+    'ENABLED': False,
+    'MODEL': 'sentence-transformers/all-MiniLM-L6-v2',
+    'DIMENSIONS': 384,
+    'BATCH_SIZE': 64,
+    'K': 100,
+    'ALPHA': 0.3,
+    'DISTANCE_THRESHOLD': 0.6,
+    'QUERY_CACHE_SIZE': 10000,
+    'QUERY_CACHE_TTL_SECONDS': 86400,
+}
+
+# Server-side conversation state for requests that send a conversation_id: the last MAX_TURNS requests (truncated
+# to MAX_PROMPT_CHARS) and the latest search entities, stored in the CACHE_ALIAS cache for TTL_SECONDS.
+# Those requests use a shorter prompt without summary generation, and the client no longer needs to send 'summary'.
+# While enabled it owns those conversations and GEMINI_SESSION_POOL_SIZE is ignored.
+CONVERSATION_STORE = {
+    'ENABLED': True,
+    'CACHE_ALIAS': 'shared',
+    'TTL_SECONDS': 24 * 60 * 60,
+    'MAX_TURNS': 5,
+    'MAX_PROMPT_CHARS': 200,
+}
+
+# Bucketed copies of released_date and view_count (release_year, release_month as YYYYMM, view_tier) are written at
+# index time. With ENABLED, date and view count filters become equality matches on them and ranges are only kept
+# for the partial months/tiers at the edges (needs Typesense 0.25+ for || across fields). Enable it after a
+# `typesense_reindex --mode full`, and reindex again whenever VIEW_TIER_BOUNDS changes.
+FILTER_FACETS = {
+    'ENABLED': False,
+    'VIEW_TIER_BOUNDS': (1000, 10000, 100000, 1000000, 10000000),
+}
+
+# Single-flight coalescing of identical concurrent Gemini generations and video searches (chatbot.utils.single_flight).
+# Within a worker it works across threads (and on the ASGI event loop). SHARED also coalesces across workers through
+# a lock in the CACHE_ALIAS cache, which has to be shared between them (e.g. Redis). Followers of another worker's
+# call poll for its result every POLL_INTERVAL_SECONDS, for at most LOCK_TIMEOUT_SECONDS, before running it themselves.
+# Followers in the same worker give up after WAIT_TIMEOUT_SECONDS. Gemini followers instead wait as long as their own
+# call could have taken (their admission wait, then every attempt of the gemini transport), and run the call
+# themselves when the leader was rejected by admission control, since that was the leader's quota and not theirs.
+SINGLE_FLIGHT = {
+    'ENABLED': True,
+    'SHARED': False,
+    'CACHE_ALIAS': 'shared',
+    'LOCK_TIMEOUT_SECONDS': 30,
+    'POLL_INTERVAL_SECONDS': 0.05,
+    'RESULT_TTL_SECONDS': 10,
+    'WAIT_TIMEOUT_SECONDS': 10,
+}
+
+# The Gemini client and the video search service are built on first use in each worker (chatbot.utils.lazy_client).
+# With ENABLED, wsgi.py / asgi.py build CLIENTS when the worker boots and open their connections (Vertex AI channel,
+# Typesense keep-alive, title index, local embedding model) so the first requests don't pay for it. A client that
+# fails to warm up only logs a warning. manage.py commands and tests don't go through these entry points.
+CLIENT_WARM_UP = {
+    'ENABLED': False,
+    'CLIENTS': ('gemini', 'video_search'),
+}
+
+# Admission control for Gemini calls (chatbot.clients.admission). RATE_PER_MINUTE/BURST is this worker process's
+# share of the Vertex AI quota (the project quota divided by the number of workers), calls beyond it wait in a
+# queue of at most MAX_QUEUE ordered by tier PRIORITY (lowest first). Each user also gets RATE_PER_MINUTE/BURST
+# of their tier: the first tier one of their groups is named after, 'staff' for staff users, otherwise DEFAULT_TIER.
+# A call that can't start within MAX_WAIT_SECONDS of asking for quota is rejected with a 429 and Retry-After
+# before it uses any quota. Size the rates to the project's quota before enabling it.
+GEMINI_ADMISSION = {
+    'ENABLED': False,
+    'RATE_PER_MINUTE': 120,
+    'BURST': 10,
+    'MAX_QUEUE': 100,
+    'MAX_USERS': 10000,
+    'DEFAULT_TIER': 'default',
+    'TIERS': {
+        'staff': {'RATE_PER_MINUTE': 120, 'BURST': 20, 'PRIORITY': 0, 'MAX_WAIT_SECONDS': 15},
+        'premium': {'RATE_PER_MINUTE': 60, 'BURST': 10, 'PRIORITY': 1, 'MAX_WAIT_SECONDS': 10},
+        'default': {'RATE_PER_MINUTE': 20, 'BURST': 5, 'PRIORITY': 2, 'MAX_WAIT_SECONDS': 5},
+    },
+}
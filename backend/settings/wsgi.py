@@ -14,3 +14,13 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings.settings')
 
 application = get_wsgi_application()
+
+# Refuses to start a worker that would keep the collection epochs and conversations to itself
+from chatbot.checks import ensure_shared_caches  # noqa: E402
+
+ensure_shared_caches()
+
+# Builds the chat clients and opens their connections now instead of on the worker's first request (CLIENT_WARM_UP)
+from chatbot.utils.lazy_client import warm_up_clients  # noqa: E402
+
+warm_up_clients()